@@ -0,0 +1,48 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+from aiohttp import web
+
+class FakeCarbonAPI:
+    '''
+    Local stand-in for the Electricity Maps latest carbon intensity endpoint, with a configurable response
+    latency and failure rate (failures answer 503 Service Unavailable). Point ElectricityMapAPI.BASE_URL at
+    latest_url once started.
+    '''
+    def __init__(self, latency_sec=0.05, failure_rate=0.0, intensity=300.0, seed=0, host="127.0.0.1", port=0):
+        self.latency_sec = latency_sec
+        self.failure_rate = failure_rate
+        self.intensity = intensity
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._runner = None
+        self.app = web.Application()
+        self.app.router.add_get("/latest", self._latest)
+
+    @property
+    def latest_url(self) -> str:
+        return f"http://{self.host}:{self.port}/latest"
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _latest(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency_sec)
+        if self._random.random() < self.failure_rate:
+            self.failures += 1
+            raise web.HTTPServiceUnavailable()
+        updated_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return web.json_response({"zone": request.query.get("zone"), "carbonIntensity": self.intensity, "updatedAt": updated_at})
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import math
+import random
+import struct
+from kasa.protocol import TPLinkSmartHomeProtocol
+
+KASA_PORT = 9999
+STRIP_PLUGS = 6
+
+def loopback_hosts(n) -> list:
+    '''
+    n distinct loopback addresses, 127.0.0.2 upwards. Linux routes all of 127.0.0.0/8 to the loopback interface,
+    on macOS each address has to be aliased first (ifconfig lo0 alias 127.0.0.2 up).
+    '''
+    return [f"127.0.{(i + 2) // 256}.{(i + 2) % 256}" for i in range(n)]
+
+class SimulatedDevice:
+    '''
+    One simulated HS110 plug (or HS300 strip with STRIP_PLUGS plugs) answering the Kasa local protocol: each request
+    is a 4 byte big endian length followed by the json payload XOR "encrypted" with the autokey cipher, the
+    response is framed the same way. Only get_sysinfo and the emeter module are supported, every other module
+    answers with an error so python-kasa stops querying it after the first update, as it does for real
+    devices which lack a module.
+    '''
+    def __init__(self, host, port=KASA_PORT, strip=False, seed=0, response_delay_sec=0.0):
+        self.host = host
+        self.port = port
+        self.strip = strip
+        self.response_delay_sec = response_delay_sec
+        self.requests = 0
+        self._random = random.Random(seed)
+        #power of every plug (one for a plug) oscillates around a base draw so readings change between cycles
+        outlets = STRIP_PLUGS if strip else 1
+        self._base_watts = [self._random.uniform(0.0, 200.0) for _ in range(outlets)]
+        self._phase = [self._random.uniform(0.0, 2 * math.pi) for _ in range(outlets)]
+        self._server = None
+        #connection handler tasks, so close() can end them before the loop shuts down
+        self._connections = {}
+        self.alias = f"sim-{host}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            #closing the client connections ends their handlers with an IncompleteReadError
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def sysinfo(self) -> dict:
+        sysinfo = {"alias": self.alias, "dev_name": "Smart Wi-Fi Plug With Energy Monitoring", "feature": "TIM:ENE",
+                   "mic_type": "IOT.SMARTPLUGSWITCH", "mac": _mac(self.host), "deviceId": f"SIM{self.host}", "hwId": "SIM",
+                   "sw_ver": "1.0.0 Build 000000 Rel.000000", "hw_ver": "1.0", "rssi": -40, "led_off": 0, "err_code": 0}
+        if self.strip:
+            sysinfo.update(model="HS300(US)", children=[{"id": f"{sysinfo['deviceId']}{i:02d}", "alias": f"plug{i}", "state": 1,
+                                                         "on_time": 0, "next_action": {"type": -1}} for i in range(STRIP_PLUGS)])
+        else:
+            sysinfo.update(model="HS110(EU)", relay_state=1, on_time=0, active_mode="none", icon_hash="", updating=0)
+        return sysinfo
+
+    def realtime(self, outlet=0) -> dict:
+        self._phase[outlet] += 0.1
+        power = max(self._base_watts[outlet] * (1.0 + 0.1 * math.sin(self._phase[outlet])), 0.0)
+        return {"power": power, "voltage": 230.0, "current": power / 230.0, "total": 0.0, "err_code": 0}
+
+    def respond(self, request: dict) -> dict:
+        outlet = 0
+        context = request.get("context")
+        if context is not None and self.strip:
+            outlet = int(context["child_ids"][0][-2:])
+        response = {}
+        for module, commands in request.items():
+            if module == "context":
+                continue
+            if module == "system" and "get_sysinfo" in commands:
+                response[module] = {"get_sysinfo": self.sysinfo()}
+            elif module == "emeter":
+                response[module] = {"get_realtime": self.realtime(outlet), "get_daystat": {"day_list": [], "err_code": 0},
+                                    "get_monthstat": {"month_list": [], "err_code": 0}}
+            else:
+                response[module] = {"err_code": -1, "err_msg": "module not support"}
+        return response
+
+    async def _serve(self, reader, writer):
+        handler = asyncio.current_task()
+        self._connections[handler] = writer
+        try:
+            while True:
+                length = struct.unpack(">I", await reader.readexactly(4))[0]
+                request = json.loads(TPLinkSmartHomeProtocol.decrypt(await reader.readexactly(length)))
+                self.requests += 1
+                if self.response_delay_sec:
+                    await asyncio.sleep(self.response_delay_sec)
+                writer.write(TPLinkSmartHomeProtocol.encrypt(json.dumps(self.respond(request))))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.pop(handler, None)
+            writer.close()
+
+class KasaSimulator:
+    '''
+    A fleet of SimulatedDevice, one per loopback address, every strip_every-th device is a strip.
+    '''
+    def __init__(self, devices, port=KASA_PORT, strip_every=10, seed=0, response_delay_sec=0.0):
+        self.devices = [SimulatedDevice(host, port, strip=strip_every > 0 and i % strip_every == strip_every - 1, seed=seed + i,
+                                        response_delay_sec=response_delay_sec)
+                        for i, host in enumerate(loopback_hosts(devices))]
+
+    def records(self) -> list:
+        '''Device registry records of the fleet, for KasaMonitor.connect_known_devices.'''
+        return [{"host": device.host, "port": device.port} for device in self.devices]
+
+    @property
+    def plugs(self) -> int:
+        '''Number of readings per cycle.'''
+        return sum(STRIP_PLUGS if device.strip else 1 for device in self.devices)
+
+    async def start(self):
+        await asyncio.gather(*[device.start() for device in self.devices])
+
+    async def close(self):
+        await asyncio.gather(*[device.close() for device in self.devices])
+
+def run_simulator(devices, port, strip_every, seed, response_delay_sec, ready, stop):
+    '''
+    Process entry point: serve the fleet on its own event loop, so serving the devices doesn't compete with the
+    monitor under test for its loop, until stop (a multiprocessing Event) is set. ready is set once listening.
+    '''
+    async def serve():
+        simulator = KasaSimulator(devices, port, strip_every, seed, response_delay_sec)
+        await simulator.start()
+        ready.set()
+        try:
+            while not stop.is_set():
+                await asyncio.sleep(0.1)
+        finally:
+            await simulator.close()
+
+    asyncio.run(serve())
+
+def _mac(host):
+    return ":".join(["50", "c7"] + [f"{int(octet):02x}" for octet in host.split(".")])
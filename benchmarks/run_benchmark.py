@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+'''
+End to end benchmark of the monitor: a simulated Kasa fleet on loopback (in its own process), a fake carbon
+intensity api and a real storage backend, driven through KasaMonitor.monitor_energy_use_continuously.
+
+    python -m benchmarks.run_benchmark --fleet_sizes 10,100,1000,5000 --storage file
+    python -m benchmarks.run_benchmark --storage database --db_host localhost --db_name scratch ...
+
+Reports cycles/sec, per-cycle latency percentiles and rows/sec for every fleet size, --output also writes the
+report as json so runs can be compared.
+
+The database is never taken from the monitor's DB_* settings, it has to be given with the --db_* options or the
+BENCH_DB_* environment variables. The simulated readings (devices sim-*) are deleted again after every fleet size.
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from datetime import timedelta
+import asyncpg
+import numpy as np
+from dotenv import load_dotenv, find_dotenv
+from kasa_carbon.interfaces.metrics_sink import MetricsSink
+from kasa_carbon.modules.kasa_monitor import KasaMonitor
+from kasa_carbon.modules.electricitymaps_api import ElectricityMapAPI
+from kasa_carbon.modules import file_storage, columnar_storage, database
+from benchmarks.kasa_simulator import loopback_hosts, run_simulator, KASA_PORT
+from benchmarks.fake_carbon_api import FakeCarbonAPI
+
+class RecordingMetrics(MetricsSink):
+    '''Keeps every observation (labels are ignored) so the report can compute exact percentiles.'''
+    def __init__(self):
+        self.observations = {}
+        self.counters = {}
+
+    def observe(self, name, value, labels=None):
+        self.observations.setdefault(name, []).append(value)
+
+    def increment(self, name, amount=1, labels=None):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value, labels=None):
+        pass
+
+    def percentiles(self, name, percentiles=(50, 95, 99)) -> dict:
+        values = self.observations.get(name)
+        if not values:
+            return {f"p{p}": None for p in percentiles}
+        return {f"p{p}": float(value) for p, value in zip(percentiles, np.percentile(values, percentiles))}
+
+async def run_fleet(devices, storage, workdir, duration_sec=10.0, delay=0.001, strip_every=10, device_delay_sec=0.0,
+                    carbon_latency_sec=0.05, carbon_failure_rate=0.0, carbon_cache_expiry_sec=1800, db_config=None,
+                    max_concurrent_polls=32, device_timeout_sec=5.0, port=KASA_PORT) -> dict:
+    '''
+    Benchmark one fleet size.
+
+    Args:
+        devices (int): Simulated devices, every strip_every-th is a strip.
+        storage (str): 'file', 'columnar' or 'database'.
+        workdir (str): Directory for the file/columnar storage and the carbon cache file.
+        duration_sec (float): How long the monitor runs.
+        delay (float): Monitor tick interval, small values run cycles back to back.
+        device_delay_sec (float): Simulated device response time.
+        carbon_latency_sec (float): Fake carbon api response time.
+        carbon_failure_rate (float): Fraction of fake carbon api requests which fail.
+        carbon_cache_expiry_sec (float): Carbon cache expiry, 0 looks the intensity up every cycle.
+        db_config (dict): asyncpg connection arguments for the database storage, the simulated readings are deleted afterwards.
+
+    Returns:
+        dict: The fleet's results.
+    '''
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Event(), context.Event()
+    simulator = context.Process(target=run_simulator, args=(devices, port, strip_every, 0, device_delay_sec, ready, stop), daemon=True)
+    simulator.start()
+    fake_api = FakeCarbonAPI(latency_sec=carbon_latency_sec, failure_rate=carbon_failure_rate)
+    await fake_api.start()
+    co2_api = None
+    monitored = False
+    try:
+        if not await asyncio.to_thread(ready.wait, 60):
+            raise RuntimeError("the simulated fleet didn't start listening within 60 seconds")
+
+        co2_api = ElectricityMapAPI(em_api_key="benchmark", clear_cache=True)
+        co2_api.BASE_URL = fake_api.latest_url
+        co2_api.cache.expiry = timedelta(seconds=carbon_cache_expiry_sec)
+        metrics = RecordingMetrics()
+        kasa = KasaMonitor(api_key=None, local_grid_id="DE", co2_api=co2_api, rediscovery_interval_sec=None, metrics=metrics,
+                           max_concurrent_polls=max_concurrent_polls, device_timeout_sec=device_timeout_sec)
+
+        connect_start = time.perf_counter()
+        connected = await kasa.connect_known_devices([{"host": host, "port": port} for host in loopback_hosts(devices)])
+        connect_sec = time.perf_counter() - connect_start
+
+        if storage == "file":
+            store = file_storage.FileStorage(os.path.join(workdir, f"energy_usage_{devices}.csv"))
+        elif storage == "columnar":
+            store = columnar_storage.ColumnarStorage(os.path.join(workdir, f"energy_usage_columns_{devices}"))
+        else:
+            store = database.Database(db_config)
+            await store.connect()
+
+        start = time.perf_counter()
+        monitored = True
+        await kasa.monitor_energy_use_continuously(store, delay, timeout=duration_sec)
+        elapsed = time.perf_counter() - start
+    finally:
+        if storage == "database" and monitored:
+            await delete_simulated_readings(db_config)
+        if co2_api is not None:
+            await co2_api.close()
+        await fake_api.close()
+        stop.set()
+        await asyncio.to_thread(simulator.join, 10)
+
+    cycles = len(metrics.observations.get("cycle_seconds", []))
+    rows = int(sum(metrics.observations.get("batch_size", [])))
+    return {"devices": devices, "connected": connected, "storage": storage, "connect_sec": connect_sec, "cycles": cycles,
+            "cycles_per_sec": cycles / elapsed, "rows": rows, "rows_per_sec": rows / elapsed,
+            "cycle_sec": metrics.percentiles("cycle_seconds"), "poll_sec": metrics.percentiles("poll_seconds"),
+            "carbon_lookup_sec": metrics.percentiles("carbon_lookup_seconds"), "write_sec": metrics.percentiles("write_seconds"),
+            "device_poll_failures": metrics.counters.get("device_poll_failures_total", 0),
+            "carbon_requests": fake_api.requests, "carbon_failures": fake_api.failures}
+
+async def delete_simulated_readings(db_config):
+    '''Delete the simulated fleet's readings (devices sim-*) and rebuild the rollup buckets they were counted in.'''
+    conn = await asyncpg.connect(**db_config)
+    try:
+        start, end = await conn.fetchrow("""
+            WITH deleted AS (DELETE FROM energy_usage WHERE device LIKE 'sim-%' RETURNING timestamp)
+            SELECT min(timestamp), max(timestamp) FROM deleted""")
+        if start is not None:
+            try:
+                await conn.execute("SELECT refresh_energy_usage_rollups($1, $2)", start, end)
+            except asyncpg.exceptions.UndefinedFunctionError:
+                #created by an older sql/01_init.sql without rollups
+                pass
+    finally:
+        await conn.close()
+
+def raise_open_file_limit(devices):
+    #each simulated device holds a listening and an accepted socket and the monitor a client socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 3 * devices + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+
+def format_result(result) -> str:
+    def ms(percentiles):
+        return "/".join("-" if value is None else f"{value * 1000:.1f}" for value in percentiles.values())
+    return (f"{result['devices']:>6} devices ({result['connected']} connected, {result['rows'] // max(result['cycles'], 1)} rows/cycle): "
+            f"{result['cycles_per_sec']:.2f} cycles/s, {result['rows_per_sec']:.0f} rows/s, "
+            f"cycle p50/p95/p99 {ms(result['cycle_sec'])} ms (poll {ms(result['poll_sec'])}, write {ms(result['write_sec'])}), "
+            f"{result['device_poll_failures']} poll failures")
+
+async def main():
+    load_dotenv(find_dotenv())
+
+    parser = argparse.ArgumentParser(description='kasa-carbon benchmark with a simulated fleet')
+    parser.add_argument("--fleet_sizes", default="10,100,1000,5000", help="Comma separated numbers of simulated devices")
+    parser.add_argument("--storage", choices=["file", "columnar", "database"], default="file", help="Storage backend written to")
+    parser.add_argument("--duration_sec", default=10.0, type=float, help="How long the monitor runs per fleet size")
+    parser.add_argument("--delay", default=0.001, type=float, help="Monitor tick interval in seconds, the default runs cycles back to back")
+    parser.add_argument("--strip_every", default=10, type=int, help="Every n-th simulated device is a 6 plug strip, 0 for plugs only")
+    parser.add_argument("--device_delay_sec", default=0.0, type=float, help="Response time of the simulated devices")
+    parser.add_argument("--carbon_latency_sec", default=0.05, type=float, help="Response time of the fake carbon api")
+    parser.add_argument("--carbon_failure_rate", default=0.0, type=float, help="Fraction of fake carbon api requests which fail")
+    parser.add_argument("--carbon_cache_expiry_sec", default=1800, type=float, help="Carbon intensity cache expiry, 0 looks it up every cycle")
+    parser.add_argument("--max_concurrent_polls", default=32, type=int, help="Maximum number of devices polled at the same time")
+    parser.add_argument("--device_timeout_sec", default=5.0, type=float, help="Timeout in seconds for polling a single device")
+    parser.add_argument("--port", default=KASA_PORT, type=int, help="Port the simulated devices listen on")
+    parser.add_argument("--output", default=None, help="Also write the report to this json file")
+    #deliberately not the monitor's DB_* settings, so a benchmark can't write into the production database by default
+    parser.add_argument("--db_host", default=os.getenv("BENCH_DB_HOST"), help="Scratch database host")
+    parser.add_argument("--db_port", default=os.getenv("BENCH_DB_PORT"), type=int, help="Scratch database port")
+    parser.add_argument("--db_user", default=os.getenv("BENCH_DB_USER"), help="Scratch database user")
+    parser.add_argument("--db_password", default=os.getenv("BENCH_DB_PASSWORD"), help="Scratch database password")
+    parser.add_argument("--db_name", default=os.getenv("BENCH_DB_NAME"), help="Scratch database name")
+    args = parser.parse_args()
+    if args.storage == "database" and (args.db_host is None or args.db_name is None):
+        parser.error("--storage database requires --db_host and --db_name (or BENCH_DB_HOST and BENCH_DB_NAME)")
+
+    fleet_sizes = [int(size) for size in args.fleet_sizes.split(",")]
+    raise_open_file_limit(max(fleet_sizes))
+    db_config = {"user": args.db_user, "password": args.db_password, "database": args.db_name, "host": args.db_host, "port": args.db_port}
+    output = os.path.abspath(args.output) if args.output is not None else None
+    cwd = os.getcwd()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="kasa-carbon-benchmark-") as workdir:
+        #the carbon client keeps its cache file in the working directory
+        os.chdir(workdir)
+        try:
+            for devices in fleet_sizes:
+                result = await run_fleet(devices, args.storage, workdir, duration_sec=args.duration_sec, delay=args.delay,
+                                         strip_every=args.strip_every, device_delay_sec=args.device_delay_sec,
+                                         carbon_latency_sec=args.carbon_latency_sec, carbon_failure_rate=args.carbon_failure_rate,
+                                         carbon_cache_expiry_sec=args.carbon_cache_expiry_sec, db_config=db_config,
+                                         max_concurrent_polls=args.max_concurrent_polls, device_timeout_sec=args.device_timeout_sec,
+                                         port=args.port)
+                print(format_result(result))
+                results.append(result)
+        finally:
+            #leave the temporary directory before it's removed, also when a run fails
+            os.chdir(cwd)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -20,4 +20,30 @@ class CarbonAPI(ABC):
         :param grid_id: The ID of the grid.
         :return: The current CO2 emission rate per kWh.
         """
-        pass
\ No newline at end of file
+        pass
+
+    async def get_co2_history_by_gridid(self, grid_id: str, start, end) -> list:
+        """
+        Get the historical CO2 emission rate per kWh for a grid between two times. Clients which support the
+        carbon backfill must override this, the default raises NotImplementedError.
+
+        :param grid_id: The ID of the grid.
+        :param start: The (timezone aware) start of the range.
+        :param end: The (timezone aware) end of the range.
+        :return: A list of (datetime, gCO2e/kWh) tuples in time order.
+        """
+        raise NotImplementedError(f"{type(self).__name__} doesn't support historical carbon intensity")
+
+    def cache_stats(self) -> dict:
+        """
+        Get the statistics of the client's intensity cache, for instrumentation.
+
+        :return: A dict with at least hits, misses and hit_ratio, or None if the client doesn't cache.
+        """
+        return None
+
+    async def close(self):
+        """
+        Release any resources (e.g. http sessions) held by the api client.
+        """
+        pass
@@ -1,15 +1,124 @@
 from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
 from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.usage_aggregation import BucketAggregator, TotalsAggregator
 
 class DatastoreAPI(ABC):
     @abstractmethod
     async def write_usage(self, energy_usage: EnergyUsage) -> None:
         pass
 
+    async def write_usage_batch(self, energy_usages: list) -> None:
+        '''
+        Write a batch of readings (typically one monitor cycle), either a list of EnergyUsage or a ReadingBatch.
+        Stores which can write several rows in one round trip should override this, the default writes the
+        readings one at a time.
+        '''
+        for energy_usage in energy_usages:
+            await self.write_usage(energy_usage)
+
+    async def write_usage_batch_idempotent(self, energy_usages) -> None:
+        '''
+        Write a batch which may already have been written in part, e.g. when replaying a spool after a failure.
+        Stores keyed by (device, timestamp) should override this to skip readings they already hold, the
+        default writes the whole batch.
+        '''
+        await self.write_usage_batch(energy_usages)
+
+    def take_unflushed(self) -> list:
+        '''
+        Remove and return the readings the store has accepted but not stored yet (e.g. a write-behind buffer), as
+        rows in EnergyUsage.KEYS order, so a caller can keep them elsewhere when the store fails. The default
+        returns an empty list for stores which write through.
+        '''
+        return []
+
     @abstractmethod
     async def read_usage(self, last_n=10, columns="*"):
         pass
 
+    async def read_usage_range(self, start, end) -> list:
+        '''
+        Read every reading with start <= timestamp < end.
+
+        Returns:
+            list: EnergyUsage objects ordered by timestamp.
+        '''
+        energy_usages = [energy_usage async for energy_usage in self.iter_usage(start, end)]
+        energy_usages.sort(key=lambda energy_usage: energy_usage.timestamp)
+        return energy_usages
+
+    def iter_usage(self, start: datetime = None, end: datetime = None, devices: list = None, columns="*"):
+        '''
+        Stream the readings with start <= timestamp < end without loading them all into memory.
+
+        Args:
+            start (datetime, optional): Start of the range, unbounded if None.
+            end (datetime, optional): End (exclusive) of the range, unbounded if None.
+            devices (list, optional): Only return readings of these devices.
+            columns: "*" or a list of EnergyUsage.keys() to read, other attributes are left as None.
+
+        Returns:
+            An async iterator of EnergyUsage objects in the order they were stored, which is timestamp order
+            for readings written by the monitor.
+
+        Stores which support range reads must override this, read_usage_range, aggregate_usage and usage_totals
+        build on it. The default raises NotImplementedError.
+        '''
+        raise NotImplementedError(f"{type(self).__name__} doesn't support reading a range of readings")
+
+    async def aggregate_usage(self, start: datetime, end: datetime, bucket: timedelta, agg="avg", devices: list = None) -> list:
+        '''
+        Aggregate readings per device into fixed size time buckets aligned to the unix epoch.
+
+        Args:
+            start (datetime): Start of the range.
+            end (datetime): End (exclusive) of the range.
+            bucket (timedelta): Bucket size.
+            agg (str): How power_draw_watts and grid_carbon_intensity_gco2perkwhr are aggregated, one of
+                'avg', 'min', 'max' or 'sum'. avg_emitted_mgco2e is always summed.
+            devices (list, optional): Only aggregate these devices.
+
+        Returns:
+            list: dicts with device, bucket (bucket start), samples, power_draw_watts, avg_emitted_mgco2e and
+            grid_carbon_intensity_gco2perkwhr, ordered by bucket then device.
+
+        Stores which can aggregate where the data lives should override this, the default streams iter_usage.
+        '''
+        aggregator = BucketAggregator(bucket, agg)
+        async for energy_usage in self.iter_usage(start, end, devices):
+            aggregator.add(energy_usage.device, energy_usage.timestamp, energy_usage.power_draw_watts,
+                           energy_usage.avg_emitted_mgco2e, energy_usage.grid_carbon_intensity_gco2perkwhr)
+        return aggregator.rows()
+
+    async def usage_totals(self, start: datetime, end: datetime, devices: list = None) -> dict:
+        '''
+        Per device totals over a time range. Each reading's power is counted for the time since the device's
+        previous reading in the range, so the first reading of a device adds no energy.
+
+        Returns:
+            dict: {device: {"samples": int, "energy_wh": float, "emitted_mgco2e": float or None}}
+
+        Stores which can aggregate where the data lives should override this, the default streams iter_usage.
+        '''
+        aggregator = TotalsAggregator()
+        chunk = []
+        async for energy_usage in self.iter_usage(start, end, devices):
+            chunk.append(energy_usage)
+            if len(chunk) >= 10000:
+                aggregator.add_usages(chunk)
+                chunk = []
+        aggregator.add_usages(chunk)
+        return aggregator.totals
+
+    async def update_carbon_batch(self, energy_usages: list) -> None:
+        '''
+        Overwrite avg_emitted_mgco2e and grid_carbon_intensity_gco2perkwhr of existing readings, matched by
+        device and timestamp, in as few writes as the store allows. Stores which support the carbon backfill
+        must override this, the default raises NotImplementedError.
+        '''
+        raise NotImplementedError(f"{type(self).__name__} doesn't support updating the carbon data of stored readings")
+
     @abstractmethod
     async def close(self):
         pass
\ No newline at end of file
@@ -0,0 +1,33 @@
+from abc import ABC, abstractmethod
+
+class MetricsSink(ABC):
+    '''
+    Receives the monitor's instrumentation. Names are plain metric names (e.g. "write_seconds") and labels an
+    optional dict of label name to value, implementations decide how to aggregate and export them.
+    '''
+    @abstractmethod
+    def observe(self, name: str, value: float, labels: dict = None) -> None:
+        '''
+        Record one observation of a distribution, e.g. a latency in seconds or a batch size.
+        '''
+        pass
+
+    @abstractmethod
+    def increment(self, name: str, amount: float = 1, labels: dict = None) -> None:
+        '''
+        Add amount to a counter.
+        '''
+        pass
+
+    @abstractmethod
+    def set_gauge(self, name: str, value: float, labels: dict = None) -> None:
+        '''
+        Set a value which can go up and down, e.g. a cache hit ratio.
+        '''
+        pass
+
+    def close(self):
+        '''
+        Flush and release any resources held by the sink.
+        '''
+        pass
@@ -3,27 +3,65 @@
 import asyncio
 import argparse
 import os
-from kasa_carbon.modules import kasa_monitor, database, file_storage
+from datetime import datetime, timezone, timedelta
+from kasa_carbon.modules import kasa_monitor, database, file_storage, columnar_storage, carbon_backfill, sharded_monitor, multi_site, deadband_storage, spool_storage, grafana_display, metrics as pipeline_metrics
 from dotenv import load_dotenv, find_dotenv
 
 async def main():
     load_dotenv(find_dotenv())
 
     parser = argparse.ArgumentParser(description='kasa-carbon arguments')
-    parser.add_argument('--storage', choices=['database', 'file'], default='database', help='Storage method')
+    parser.add_argument('--storage', choices=['database', 'file', 'columnar'], default='database', help='Storage method')
     parser.add_argument('--file-path', default='energy_usage.csv', help='File path for file storage')
     parser.add_argument('--file-mode', choices=['append', 'overwrite'], default='append', help='File mode for file storage append will continuously append and overwrite will only keep the most recent value')
+    parser.add_argument('--file-buffer-size', default=64 * 1024, type=int, help='Write buffer size in bytes for file storage')
+    parser.add_argument('--file-durability', choices=file_storage.FileStorage.DURABILITY_POLICIES, default='cycle', help='When file storage flushes buffered rows: every cycle, every --file-flush-rows rows, every --file-flush-interval-sec seconds or fsync every cycle')
+    parser.add_argument('--file-flush-rows', default=1000, type=int, help='Rows between flushes for the rows durability policy')
+    parser.add_argument('--file-flush-interval-sec', default=5.0, type=float, help='Seconds between flushes for the interval durability policy')
+    parser.add_argument('--file-rotate-bytes', default=None, type=int, help='Start a new file storage segment once the file reaches this many bytes')
+    parser.add_argument('--file-rotate-period', choices=list(file_storage.FileStorage.ROTATION_PERIODS), default=None, help='Start a new file storage segment every hour or day')
+    parser.add_argument('--file-compression', choices=['gzip', 'zstd'], default=None, help='Compress closed file storage segments')
+    parser.add_argument('--file-max-segments', default=None, type=int, help='Number of closed file storage segments to keep')
+    parser.add_argument('--columnar-dir', default='energy_usage_columns', help='Directory for columnar storage')
     parser.add_argument("--db_host", default=os.getenv("DB_HOST"), help="Database host")
     parser.add_argument("--db_port", default=os.getenv("DB_PORT"), type=int, help="Database port")
     parser.add_argument("--db_user", default=os.getenv("DB_USER"), help="Database user")
     parser.add_argument("--db_password", default=os.getenv("DB_PASSWORD"), help="Database password")
     parser.add_argument("--db_name", default=os.getenv("DB_NAME"), help="Database name")
+    parser.add_argument("--db_min_pool_size", default=1, type=int, help="Minimum number of pooled database connections")
+    parser.add_argument("--db_max_pool_size", default=10, type=int, help="Maximum number of pooled database connections")
+    parser.add_argument("--db_batch_size", default=1, type=int, help="Number of buffered readings which triggers a database write")
+    parser.add_argument("--db_flush_interval_sec", default=None, type=float, help="Maximum age in seconds of buffered readings before they are written")
+    parser.add_argument("--db_max_buffer_size", default=10000, type=int, help="Maximum number of buffered readings before writers wait for a flush")
     parser.add_argument("--db_view_user", default=os.getenv("DB_VIEW_USER"), help="Database view user")
+    parser.add_argument("--spool_dir", default=None, help="Spool readings to this directory while the storage is failing (or slower than --write_timeout_sec) and replay them once it recovers")
+    parser.add_argument("--spool_max_mb", default=256, type=float, help="Maximum disk use of the spool in megabytes")
+    parser.add_argument("--spool_overflow", choices=spool_storage.SpoolStorage.OVERFLOW_POLICIES, default="drop_oldest", help="Readings dropped when the spool is full")
+    parser.add_argument("--write_timeout_sec", default=None, type=float, help="Latency budget of a storage write, slower writes are spooled (requires --spool_dir)")
+    parser.add_argument("--deadband_watts", default=None, type=float, help="Only store a device's reading when its power moved more than this many watts since its last stored reading (or a heartbeat is due)")
+    parser.add_argument("--deadband_relative", default=None, type=float, help="Relative deadband for power and grid intensity, e.g. 0.05 to ignore changes under 5%%")
+    parser.add_argument("--deadband_intensity", default=0.0, type=float, help="Grid intensity deadband in gCO2e/kWh when a deadband is enabled")
+    parser.add_argument("--heartbeat_mins", default=10, type=float, help="Store a reading per device at least this often when a deadband is enabled")
+    parser.add_argument("--http_port", default=None, type=int, help="Serve the latest readings as JSON (/readings) and Prometheus metrics (/metrics) on this port")
+    parser.add_argument("--http_host", default="127.0.0.1", help="Address the readings server listens on")
+    parser.add_argument("--profile_cycles", default=None, type=int, help="Profile the first n monitor cycles with a sampling profiler and write the stacks to --profile_path")
+    parser.add_argument("--profile_path", default="kasa_carbon_profile.folded", help="Output of --profile_cycles in the folded stack format read by flamegraph.pl and speedscope")
     parser.add_argument("--em_api_key", default=os.getenv("EM_API_KEY"), help="API key")
     parser.add_argument("--em_cache_expiry_mins", default=os.getenv("EM_CACHE_EXPIRY_MINS"), type=int, help="Carbon Data cache expiry in minutes")
     parser.add_argument("--local_lat", default=os.getenv("LOCAL_LAT"), type=float, help="Local latitude")
     parser.add_argument("--local_lon", default=os.getenv("LOCAL_LON"), type=float, help="Local longitude")
+    parser.add_argument("--local_grid_id", default=os.getenv("LOCAL_GRID_ID"), help="Local grid zone id, used instead of latitude/longitude if set")
     parser.add_argument("--update_interval_sec", default=15, type=int, help="Update interval in seconds")
+    parser.add_argument("--max_concurrent_polls", default=32, type=int, help="Maximum number of devices polled at the same time")
+    parser.add_argument("--device_timeout_sec", default=5.0, type=float, help="Timeout in seconds for polling a single device")
+    parser.add_argument("--sites_config", default=None, help="JSON file of sites (device groups each in their own grid zone) monitored together, see kasa_carbon/modules/multi_site.py")
+    parser.add_argument("--workers", default=1, type=int, help="Number of processes polling devices, each polls a shard of the device registry")
+    parser.add_argument("--device_registry", default="kasa_devices.json", help="File recording known devices so startup connects to them directly instead of waiting on a broadcast discovery")
+    parser.add_argument("--rediscovery_interval_sec", default=300, type=float, help="Interval in seconds of the background discovery of new and removed devices")
+    parser.add_argument("--missing_intensity", choices=kasa_monitor.KasaMonitor.MISSING_INTENSITY_POLICIES, default="null", help="When the grid intensity is unavailable store readings without carbon data (null, can be backfilled later) or use the last known intensity (last)")
+    parser.add_argument("--backfill_start", default=None, type=datetime.fromisoformat, help="Instead of monitoring, recompute carbon data of stored readings from this (ISO) time using historical grid intensity, requires --local_grid_id")
+    parser.add_argument("--backfill_end", default=None, type=datetime.fromisoformat, help="End (ISO) time of the backfill, defaults to now")
+    parser.add_argument("--backfill_all", action="store_true", help="Backfill every reading rather than only readings without carbon data")
 
 
     args = parser.parse_args()
@@ -54,15 +92,95 @@ async def main():
         "host": args.db_host,
         "port": args.db_port,
     }
-    kasa = kasa_monitor.KasaMonitor(api_key = API_KEY, local_lon=LOCAL_LON, local_lat=LOCAL_LAT, co2_api_provider=API_TYPE, em_cache_expiry_mins=EM_CACHE_EXPIRY_MINS)
+    monitor_kwargs = dict(api_key = API_KEY, local_lon=LOCAL_LON, local_lat=LOCAL_LAT, local_grid_id=args.local_grid_id, co2_api_provider=API_TYPE, em_cache_expiry_mins=EM_CACHE_EXPIRY_MINS,
+                          max_concurrent_polls=args.max_concurrent_polls, device_timeout_sec=args.device_timeout_sec,
+                          missing_intensity=args.missing_intensity, registry_path=args.device_registry,
+                          rediscovery_interval_sec=args.rediscovery_interval_sec)
+    #timings of every pipeline stage, printed with the status and served on /metrics
+    metrics = pipeline_metrics.InMemoryMetrics()
+    if args.profile_cycles is not None and (args.sites_config is not None or args.workers > 1):
+        parser.error("--profile_cycles requires a single site and worker")
+    if args.sites_config is not None:
+        #one monitor per site sharing the carbon client (and storage), --local_* and --device_registry come from the config
+        sites = multi_site.MultiSiteMonitor(multi_site.load_sites_config(args.sites_config), api_key=API_KEY, em_cache_expiry_mins=EM_CACHE_EXPIRY_MINS,
+                                            max_concurrent_polls=args.max_concurrent_polls, device_timeout_sec=args.device_timeout_sec,
+                                            missing_intensity=args.missing_intensity, rediscovery_interval_sec=args.rediscovery_interval_sec, metrics=metrics)
+        co2_api = sites.co2_api
+    elif args.workers > 1:
+        #the sharded monitor owns the writer side KasaMonitor, the workers build their own
+        sharded = sharded_monitor.ShardedMonitor(args.workers, monitor_kwargs, metrics=metrics)
+        kasa = sharded.monitor
+        co2_api = kasa.co2_api
+    else:
+        kasa = kasa_monitor.KasaMonitor(**monitor_kwargs, metrics=metrics, profile_cycles=args.profile_cycles, profile_path=args.profile_path)
+        co2_api = kasa.co2_api
 
     if args.storage == 'file':
-        storage = file_storage.FileStorage(args.file_path, args.file_mode)
+        storage = file_storage.FileStorage(args.file_path, args.file_mode, buffer_size=args.file_buffer_size, durability=args.file_durability,
+                                           flush_rows=args.file_flush_rows, flush_interval_sec=args.file_flush_interval_sec,
+                                           rotate_bytes=args.file_rotate_bytes, rotate_period=args.file_rotate_period,
+                                           compression=args.file_compression, max_segments=args.file_max_segments)
+    elif args.storage == 'columnar':
+        storage = columnar_storage.ColumnarStorage(args.columnar_dir)
     else: #database is default
-        storage = database.Database(db_config)
+        storage = database.Database(db_config, min_pool_size=args.db_min_pool_size, max_pool_size=args.db_max_pool_size,
+                                    batch_size=args.db_batch_size, flush_interval_sec=args.db_flush_interval_sec,
+                                    max_buffer_size=args.db_max_buffer_size)
+        #open the pooled connections up front rather than on the first write
+        try:
+            await storage.connect()
+        except Exception as e:
+            if args.spool_dir is None:
+                raise
+            #the pool is created on the first successful write, readings are spooled until then
+            print(f"Couldn't connect to the database, spooling readings to {args.spool_dir}: {e!r}")
+
+    spool = None
+    if args.spool_dir is not None:
+        storage = spool = spool_storage.SpoolStorage(storage, args.spool_dir, max_bytes=int(args.spool_max_mb * 1024 * 1024),
+                                                     overflow=args.spool_overflow, write_timeout_sec=args.write_timeout_sec)
+
+    if args.deadband_watts is not None or args.deadband_relative is not None:
+        #only write readings which changed (or are due a heartbeat), the suppressed readings' emissions are carried forward
+        storage = deadband_storage.DeadbandStorage(storage, power_abs_watts=args.deadband_watts or 0.0, power_rel=args.deadband_relative or 0.0,
+                                                   intensity_abs=args.deadband_intensity, intensity_rel=args.deadband_relative or 0.0,
+                                                   heartbeat=timedelta(minutes=args.heartbeat_mins))
+
+    if args.backfill_start is not None:
+        if args.local_grid_id is None:
+            parser.error("--backfill_start requires --local_grid_id")
+        backfill_start = args.backfill_start if args.backfill_start.tzinfo else args.backfill_start.replace(tzinfo=timezone.utc)
+        backfill_end = args.backfill_end or datetime.now(timezone.utc)
+        backfill_end = backfill_end if backfill_end.tzinfo else backfill_end.replace(tzinfo=timezone.utc)
+        try:
+            if spool is not None:
+                #readings spooled by a previous run have to be stored before they can be backfilled
+                replayed = await spool.drain()
+                if replayed:
+                    print(f"Replayed {replayed} spooled readings.")
+            updated = await carbon_backfill.backfill_emissions(storage, co2_api, args.local_grid_id, backfill_start, backfill_end,
+                                                               interval_sec=UPDATE_INTERVAL_SEC, only_missing=not args.backfill_all)
+            print(f"Backfilled carbon data for {updated} readings.")
+        finally:
+            await storage.close()
+            await co2_api.close()
+        return
+
+    if spool is not None:
+        #readings spooled by a previous run are replayed in the background while the monitor starts
+        spool.start_replay()
 
     # Monitor energy use continuously in a subthread to avoid blocking the main thread
-    energy_use_task = asyncio.create_task(kasa.monitor_energy_use_continuously(storage, delay=UPDATE_INTERVAL_SEC))
+    recent_readings = sites.recent_readings if args.sites_config is not None else kasa.recent_readings
+    if args.http_port is not None:
+        display = grafana_display.GrafanaDisplay(recent_readings, host=args.http_host, port=args.http_port, metrics=metrics)
+        await display.start()
+    if args.sites_config is not None:
+        energy_use_task = asyncio.create_task(sites.run(storage, delay=UPDATE_INTERVAL_SEC))
+    elif args.workers > 1:
+        energy_use_task = asyncio.create_task(sharded.run(storage, delay=UPDATE_INTERVAL_SEC))
+    else:
+        energy_use_task = asyncio.create_task(kasa.monitor_energy_use_continuously(storage, delay=UPDATE_INTERVAL_SEC))
     
     while True:
         if energy_use_task.done():
@@ -70,8 +188,16 @@ async def main():
         else:
             print("The energy monitoring task is still running.")
 
-        # view the current database values
-        print(await storage.read_usage())
+        # view the latest readings published by the monitor, this doesn't touch the storage
+        for device, energy_usage in recent_readings.latest().items():
+            stats = recent_readings.stats(device)
+            print(f"{device}: {energy_usage.power_draw_watts} W (min/avg/max {stats['min_power_draw_watts']}/{stats['avg_power_draw_watts']:.1f}/{stats['max_power_draw_watts']} W "
+                  f"over {stats['samples']} samples), {energy_usage.avg_emitted_mgco2e} mgCO2e, {energy_usage.grid_carbon_intensity_gco2perkwhr} gCO2e/kWh")
+
+        cycle_seconds = metrics.histogram("cycle_seconds")
+        if cycle_seconds is not None:
+            print(f"Cycle time p50/p95 {cycle_seconds.quantile(0.5):.3f}/{cycle_seconds.quantile(0.95):.3f} s over {cycle_seconds.count} cycles, "
+                  f"{metrics.counter('overrun_ticks_total')} overrun ticks")
 
         # Wait for next update
         await asyncio.sleep(UPDATE_INTERVAL_SEC)
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+import numpy as np
+from kasa_carbon.interfaces.carbon_api import CarbonAPI
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.modules.emissions import trapezoidal_mgco2e, previous_values, seconds_since_previous
+
+async def backfill_emissions(store: DatastoreAPI, carbon_api: CarbonAPI, grid_id: str, start: datetime, end: datetime,
+                             interval_sec: float, chunk=timedelta(days=1), only_missing=True) -> int:
+    '''
+    Recompute grid_carbon_intensity_gco2perkwhr and avg_emitted_mgco2e of stored readings from historical intensity.
+
+    The intensity history for the whole range is fetched up front in bulk and each reading takes the most recent
+    historical value at or before its timestamp. Like the monitor, a reading's emissions integrate power with the
+    trapezoidal rule between the device's previous reading and this one. Readings are then processed one chunk of time at a time: the
+    emissions of a chunk are computed in one vectorized pass and written back with a single update_carbon_batch.
+
+    Args:
+        store (DatastoreAPI): The store holding the readings.
+        carbon_api (CarbonAPI): Source of the intensity history.
+        grid_id (str): The grid the readings were taken in.
+        start (datetime): Start of the range to backfill.
+        end (datetime): End (exclusive) of the range to backfill.
+        interval_sec (float): Nominal sample interval, used for the first reading of each device where there is no previous reading.
+        chunk (timedelta): Amount of time read and updated at once.
+        only_missing (bool): Only update readings which don't have an intensity yet, otherwise recompute every reading.
+
+    Returns:
+        int: The number of readings updated.
+    '''
+    #intensity is reported hourly for the start of each hour, so look back an hour to cover the first readings
+    history = await carbon_api.get_co2_history_by_gridid(grid_id, start - timedelta(hours=1), end)
+    history_times = np.array([point[0].timestamp() for point in history], dtype=np.float64)
+    history_values = np.array([point[1] for point in history], dtype=np.float64)
+
+    #timestamp and power of the previous reading of each device, carried across chunks
+    previous_times = {}
+    previous_power = {}
+    updated = 0
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk, end)
+        energy_usages = await store.read_usage_range(chunk_start, chunk_end)
+        chunk_start = chunk_end
+        if not energy_usages:
+            continue
+
+        times = np.array([energy_usage.timestamp.timestamp() for energy_usage in energy_usages], dtype=np.float64)
+        power = np.array([energy_usage.power_draw_watts for energy_usage in energy_usages], dtype=np.float64)
+        current = np.array([np.nan if energy_usage.grid_carbon_intensity_gco2perkwhr is None else energy_usage.grid_carbon_intensity_gco2perkwhr
+                            for energy_usage in energy_usages], dtype=np.float64)
+        devices = [energy_usage.device for energy_usage in energy_usages]
+        intervals = seconds_since_previous(devices, times, previous_times, default=interval_sec)
+        #the first reading of a device falls back to constant power
+        start_power = previous_values(devices, times, power, previous_power)
+        start_power = np.where(np.isnan(start_power), power, start_power)
+
+        intensity = _lookup(history_times, history_values, times)
+        emitted = trapezoidal_mgco2e(power, start_power, intervals, intensity)
+
+        selected = ~np.isnan(intensity)
+        if only_missing:
+            selected &= np.isnan(current)
+        for row in np.flatnonzero(selected):
+            energy_usages[row].grid_carbon_intensity_gco2perkwhr = float(intensity[row])
+            energy_usages[row].avg_emitted_mgco2e = float(emitted[row])
+        updates = [energy_usages[row] for row in np.flatnonzero(selected)]
+        if updates:
+            await store.update_carbon_batch(updates)
+            updated += len(updates)
+    return updated
+
+def _lookup(history_times, history_values, times):
+    #most recent historical value at or before each time, NaN before the first one
+    if len(history_times) == 0:
+        return np.full(len(times), np.nan)
+    index = np.searchsorted(history_times, times, side="right") - 1
+    return np.where(index >= 0, history_values[np.clip(index, 0, None)], np.nan)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+
+class CarbonCache:
+    '''
+    Bounded LRU cache of carbon intensity values keyed by location, persisted to a json file.
+
+    Entries expire expiry after they were fetched. Once the cache holds max_size entries the least recently
+    used entry is evicted. Writes to the file happen behind the caller's back: put() schedules a save in a
+    worker thread and the file is replaced atomically (temp file plus rename) so it's never left half written.
+    '''
+    def __init__(self, path, expiry: timedelta, max_size=1024):
+        self.path = path
+        self.expiry = expiry
+        self.max_size = max_size
+        #key -> (value, fetched_at), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        #expired entries served while they are refreshed (stale-while-revalidate)
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._save_task = None
+        self._dirty = False
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                cache = json.load(f)
+            # Convert the timestamps from strings to datetime objects
+            for key, value in cache.items():
+                self.entries[key] = (value[0], datetime.fromisoformat(value[1]))
+            self._evict()
+
+    def get(self, key, stale=False):
+        '''
+        Look up an entry and count the hit, stale hit or miss.
+
+        Args:
+            key (str): The location key.
+            stale (bool): Also return an expired entry, counted as a stale hit, for callers which serve it
+                while it is refreshed.
+
+        Returns:
+            tuple: (value, fetched_at) or None if there is no entry or it has expired (and stale is False).
+        '''
+        entry = self.entries.get(key)
+        expired = entry is not None and self.is_expired(entry)
+        if entry is None or (expired and not stale):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        if expired:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def peek(self, key):
+        '''Return the entry for key even if it has expired, without counting it as a hit or miss.'''
+        return self.entries.get(key)
+
+    def is_expired(self, entry) -> bool:
+        return datetime.now(timezone.utc) - entry[1] >= self.expiry
+
+    def put(self, key, value, fetched_at=None):
+        self.entries[key] = (value, fetched_at or datetime.now(timezone.utc))
+        self.entries.move_to_end(key)
+        self._evict()
+        self.save_later()
+
+    def clear(self):
+        self.entries.clear()
+        self.save()
+
+    def stats(self) -> dict:
+        '''hit_ratio is the share of lookups answered from the cache, fresh or stale, stale_hits says how many were stale.'''
+        lookups = self.hits + self.stale_hits + self.misses
+        return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.entries), "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else None}
+
+    def save(self):
+        self._write(self._snapshot())
+
+    def save_later(self):
+        '''Persist the cache in a worker thread. Saves requested while one is running are folded into one more save.'''
+        self._dirty = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            #no event loop, e.g. called during setup, just write synchronously
+            self.save()
+            self._dirty = False
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_while_dirty())
+
+    async def flush(self):
+        '''Wait for any pending save to finish.'''
+        if self._save_task is not None:
+            await self._save_task
+            self._save_task = None
+
+    async def _save_while_dirty(self):
+        while self._dirty:
+            self._dirty = False
+            await asyncio.to_thread(self._write, self._snapshot())
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _snapshot(self):
+        # Convert the timestamps from datetime objects to strings
+        return {key: [value[0], value[1].isoformat()] for key, value in self.entries.items()}
+
+    def _write(self, snapshot):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, self.path)
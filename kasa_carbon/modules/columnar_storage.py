@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timezone, timedelta
+import numpy as np
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import ReadingBatch
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.modules.usage_aggregation import BucketAggregator, TotalsAggregator
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+class ColumnarStorage(DatastoreAPI):
+    '''
+    Append-only columnar store. Every column is a packed array of fixed-width values in its own file and
+    device names are stored once in a dictionary, each row referencing its device by id:
+
+        devices.json                              device names, the index is the device id
+        device_id.bin                             uint32
+        timestamp.bin                             int64 microseconds since the unix epoch (UTC)
+        power_draw_watts.bin                      float32
+        avg_emitted_mgco2e.bin                    float32, NaN for missing values
+        grid_carbon_intensity_gco2perkwhr.bin     float32, NaN for missing values
+
+    read_columns() maps the column files with numpy.memmap so analysis code reads them without parsing or copying.
+    '''
+    COLUMNS = {
+        "device_id": np.dtype("<u4"),
+        "timestamp": np.dtype("<i8"),
+        "power_draw_watts": np.dtype("<f4"),
+        "avg_emitted_mgco2e": np.dtype("<f4"),
+        "grid_carbon_intensity_gco2perkwhr": np.dtype("<f4"),
+    }
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.devices = []
+        if os.path.exists(self._devices_path()):
+            with open(self._devices_path(), 'r') as f:
+                self.devices = json.load(f)
+        self.device_ids = {device: i for i, device in enumerate(self.devices)}
+        self._files = None
+        self._lock = asyncio.Lock()
+        self.rows = self._repair()
+
+    async def write_usage(self, energy_usage: EnergyUsage) -> None:
+        await self.write_usage_batch([energy_usage])
+
+    async def write_usage_batch(self, energy_usages: list) -> None:
+        batch = ReadingBatch.from_energy_usages(energy_usages)
+        async with self._lock:
+            await asyncio.to_thread(self._append, batch)
+
+    async def read_usage(self, last_n=10, columns="*"):
+        '''
+        Read the last_n rows, oldest first.
+
+        Returns:
+            list: EnergyUsage objects, columns not included in columns are left as None.
+        '''
+        async with self._lock:
+            if self._files is not None:
+                await asyncio.to_thread(self._flush)
+        keys = EnergyUsage.keys() if columns == "*" else list(columns)
+        data = self.read_columns()
+        start = max(0, self.rows - last_n)
+        return [EnergyUsage.from_dict({key: self._value(data, key, row) for key in keys}) for row in range(start, self.rows)]
+
+    async def read_usage_range(self, start, end) -> list:
+        async with self._lock:
+            if self._files is not None:
+                await asyncio.to_thread(self._flush)
+        data = self.read_columns()
+        rows = np.flatnonzero(self._range_mask(data, start, end))
+        rows = rows[np.argsort(data["timestamp"][rows], kind="stable")]
+        return [EnergyUsage(energy_usage_dict={key: self._value(data, key, row) for key in EnergyUsage.keys()}) for row in rows]
+
+    async def iter_usage(self, start=None, end=None, devices=None, columns="*", chunk_rows=65536):
+        '''
+        Stream readings in storage order. The columns are filtered chunk_rows rows at a time through the memory
+        maps so only one chunk of each column is paged in at once.
+        '''
+        keys = EnergyUsage.keys() if columns == "*" else list(columns)
+        for data, rows in await self._chunks(start, end, devices, chunk_rows):
+            for row in rows:
+                yield EnergyUsage.from_dict({key: self._value(data, key, row) for key in keys})
+
+    async def aggregate_usage(self, start, end, bucket, agg="avg", devices=None) -> list:
+        aggregator = BucketAggregator(bucket, agg)
+        for data, rows in await self._chunks(start, end, devices):
+            aggregator.add_arrays(data["device_id"][rows], data["timestamp"][rows], data["power_draw_watts"][rows],
+                                  data["avg_emitted_mgco2e"][rows], data["grid_carbon_intensity_gco2perkwhr"][rows])
+        return aggregator.rows(self.devices)
+
+    async def usage_totals(self, start, end, devices=None) -> dict:
+        aggregator = TotalsAggregator()
+        for data, rows in await self._chunks(start, end, devices):
+            aggregator.add_arrays(data["device_id"][rows], data["timestamp"][rows] / 1e6,
+                                  data["power_draw_watts"][rows], data["avg_emitted_mgco2e"][rows])
+        return {self.devices[device_id]: total for device_id, total in aggregator.totals.items()}
+
+    async def update_carbon_batch(self, energy_usages: list) -> None:
+        if not energy_usages:
+            return
+        async with self._lock:
+            if self._files is not None:
+                await asyncio.to_thread(self._flush)
+            await asyncio.to_thread(self._update_in_place, energy_usages)
+
+    def read_columns(self) -> dict:
+        '''
+        Map every column file read only. The arrays share memory with the files (no parsing or copying) and
+        are only valid for the rows written before the call.
+
+        Returns:
+            dict: numpy arrays keyed by column name, plus "devices" with the device dictionary.
+        '''
+        data = {"devices": list(self.devices)}
+        for column, dtype in self.COLUMNS.items():
+            if self.rows == 0:
+                data[column] = np.empty(0, dtype=dtype)
+            else:
+                data[column] = np.memmap(self._column_path(column), dtype=dtype, mode='r', shape=(self.rows,))
+        return data
+
+    async def close(self):
+        async with self._lock:
+            if self._files is not None:
+                await asyncio.to_thread(self._close_files)
+
+    async def _chunks(self, start, end, devices, chunk_rows=65536):
+        #lazily yields (data, selected rows) for consecutive slices of the rows written before the call
+        async with self._lock:
+            if self._files is not None:
+                await asyncio.to_thread(self._flush)
+        data = self.read_columns()
+        device_ids = None
+        if devices is not None:
+            device_ids = np.array([self.device_ids[device] for device in devices if device in self.device_ids], dtype=self.COLUMNS["device_id"])
+        return ((data, chunk_start + np.flatnonzero(self._chunk_mask(data, chunk_start, chunk_start + chunk_rows, start, end, device_ids)))
+                for chunk_start in range(0, self.rows, chunk_rows))
+
+    def _chunk_mask(self, data, chunk_start, chunk_end, start, end, device_ids):
+        chunk = {column: data[column][chunk_start:chunk_end] for column in ("timestamp", "device_id")}
+        mask = self._range_mask(chunk, start, end)
+        if device_ids is not None:
+            mask &= np.isin(chunk["device_id"], device_ids)
+        return mask
+
+    def _range_mask(self, data, start, end):
+        mask = np.ones(len(data["timestamp"]), dtype=bool)
+        if start is not None:
+            mask &= data["timestamp"] >= (start - EPOCH) // timedelta(microseconds=1)
+        if end is not None:
+            mask &= data["timestamp"] < (end - EPOCH) // timedelta(microseconds=1)
+        return mask
+
+    def _update_in_place(self, energy_usages):
+        #fixed width columns can be updated in place through a writable memory map
+        if self.rows == 0:
+            return
+        start = min(energy_usage.timestamp for energy_usage in energy_usages)
+        end = max(energy_usage.timestamp for energy_usage in energy_usages) + timedelta(microseconds=1)
+        timestamps = np.memmap(self._column_path("timestamp"), dtype=self.COLUMNS["timestamp"], mode='r', shape=(self.rows,))
+        device_ids = np.memmap(self._column_path("device_id"), dtype=self.COLUMNS["device_id"], mode='r', shape=(self.rows,))
+        rows = np.flatnonzero(self._range_mask({"timestamp": timestamps}, start, end))
+        index = {(int(device_ids[row]), int(timestamps[row])): row for row in rows}
+
+        emitted = np.memmap(self._column_path("avg_emitted_mgco2e"), dtype=self.COLUMNS["avg_emitted_mgco2e"], mode='r+', shape=(self.rows,))
+        intensity = np.memmap(self._column_path("grid_carbon_intensity_gco2perkwhr"), dtype=self.COLUMNS["grid_carbon_intensity_gco2perkwhr"], mode='r+', shape=(self.rows,))
+        for energy_usage in energy_usages:
+            device_id = self.device_ids.get(energy_usage.device)
+            row = index.get((device_id, (energy_usage.timestamp - EPOCH) // timedelta(microseconds=1)))
+            if row is None:
+                continue
+            emitted[row] = np.nan if energy_usage.avg_emitted_mgco2e is None else energy_usage.avg_emitted_mgco2e
+            intensity[row] = np.nan if energy_usage.grid_carbon_intensity_gco2perkwhr is None else energy_usage.grid_carbon_intensity_gco2perkwhr
+        emitted.flush()
+        intensity.flush()
+
+    def _value(self, data, key, row):
+        if key == "device":
+            return data["devices"][data["device_id"][row]]
+        if key == "timestamp":
+            return EPOCH + timedelta(microseconds=int(data["timestamp"][row]))
+        value = float(data[key][row])
+        return None if np.isnan(value) else value
+
+    def _append(self, batch: ReadingBatch):
+        if self._files is None:
+            self._files = {column: open(self._column_path(column), 'ab') for column in self.COLUMNS}
+
+        new_devices = False
+        device_ids = []
+        for device in batch.devices:
+            if device not in self.device_ids:
+                self.device_ids[device] = len(self.devices)
+                self.devices.append(device)
+                new_devices = True
+            device_ids.append(self.device_ids[device])
+        if new_devices:
+            #the dictionary has to be on disk before any row referencing a new id
+            self._save_devices()
+
+        values = {
+            "device_id": device_ids,
+            "timestamp": [(timestamp - EPOCH) // timedelta(microseconds=1) for timestamp in batch.timestamps],
+            "power_draw_watts": batch.power_draw_watts,
+            "avg_emitted_mgco2e": batch.avg_emitted_mgco2e,
+            "grid_carbon_intensity_gco2perkwhr": batch.grid_carbon_intensity_gco2perkwhr,
+        }
+        for column, dtype in self.COLUMNS.items():
+            self._files[column].write(np.asarray(values[column], dtype=dtype).tobytes())
+        self._flush()
+        self.rows += len(batch)
+
+    def _flush(self):
+        for f in self._files.values():
+            f.flush()
+
+    def _close_files(self):
+        for f in self._files.values():
+            f.close()
+        self._files = None
+
+    def _repair(self):
+        #a crash part way through an append can leave the columns with different lengths, trim them to the shortest
+        rows = None
+        for column, dtype in self.COLUMNS.items():
+            path = self._column_path(column)
+            column_rows = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+            rows = column_rows if rows is None else min(rows, column_rows)
+        for column, dtype in self.COLUMNS.items():
+            path = self._column_path(column)
+            if os.path.exists(path) and os.path.getsize(path) != rows * dtype.itemsize:
+                os.truncate(path, rows * dtype.itemsize)
+        return rows
+
+    def _save_devices(self):
+        temp_path = self._devices_path() + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.devices, f)
+        os.replace(temp_path, self._devices_path())
+
+    def _column_path(self, column):
+        return os.path.join(self.directory, column + ".bin")
+
+    def _devices_path(self):
+        return os.path.join(self.directory, "devices.json")
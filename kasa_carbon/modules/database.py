@@ -1,45 +1,311 @@
 import asyncio
 import asyncpg
+import logging
+import time
+from datetime import timezone
 from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import as_rows
+from kasa_carbon.modules.usage_aggregation import check_aggregate
 from kasa_carbon.interfaces.datastore_api import DatastoreAPI
 
+#errors which indicate the connection (rather than the query) is bad, e.g. because the server restarted
+_CONNECTION_ERRORS = (asyncpg.exceptions.PostgresConnectionError, asyncpg.exceptions.OperatorInterventionError,
+                      asyncpg.InterfaceError, OSError)
+
+#errors after which a flush is worth retrying. Anything else (a bad value, missing permissions or table) would fail
+#every retry, so the batch is dropped instead of blocking the buffer
+_TRANSIENT_ERRORS = _CONNECTION_ERRORS + (asyncpg.exceptions.TransactionRollbackError, asyncpg.exceptions.InsufficientResourcesError)
+
+_LOGGER = logging.getLogger(__name__)
+
 class Database(DatastoreAPI):
-    def __init__(self, db_config):
+    UPDATE_CARBON_SQL_QUERY = """
+        UPDATE energy_usage AS e
+        SET avg_emitted_mgco2e = u.avg_emitted_mgco2e, grid_carbon_intensity_gco2perkwhr = u.grid_carbon_intensity_gco2perkwhr
+        FROM unnest($1::varchar[], $2::timestamptz[], $3::real[], $4::real[])
+            AS u(device, timestamp, avg_emitted_mgco2e, grid_carbon_intensity_gco2perkwhr)
+        WHERE e.device = u.device AND e.timestamp = u.timestamp"""
+
+    #idempotent bulk insert, readings which are already stored (same device and timestamp) are skipped. The rollup
+    #trigger only sees the rows which were actually inserted so replaying a batch doesn't double count it
+    INSERT_IGNORE_SQL_QUERY = """
+        INSERT INTO energy_usage (device, timestamp, power_draw_watts, avg_emitted_mgco2e, grid_carbon_intensity_gco2perkwhr)
+        SELECT * FROM unnest($1::varchar[], $2::timestamptz[], $3::real[], $4::real[], $5::real[])
+        ON CONFLICT (device, timestamp) DO NOTHING"""
+
+    #each reading's power counts for the time since the device's previous reading, like its avg_emitted_mgco2e
+    USAGE_TOTALS_SQL_QUERY = """
+        SELECT device, count(*) AS samples,
+            coalesce(sum(power_draw_watts * extract(epoch FROM timestamp - previous_timestamp)) / 3600.0, 0) AS energy_wh,
+            sum(avg_emitted_mgco2e) AS emitted_mgco2e
+        FROM (
+            SELECT device, timestamp, power_draw_watts, avg_emitted_mgco2e,
+                lag(timestamp) OVER (PARTITION BY device ORDER BY timestamp) AS previous_timestamp
+            FROM energy_usage{where}
+        ) AS readings
+        GROUP BY device"""
+
+    def __init__(self, db_config, min_pool_size=1, max_pool_size=10, batch_size=1, flush_interval_sec=None, max_buffer_size=10000,
+                 manage_partitions=True):
+        '''
+        Args:
+            db_config (dict): asyncpg connection arguments.
+            min_pool_size (int): Number of connections opened when the pool is created.
+            max_pool_size (int): Maximum number of pooled connections.
+            batch_size (int): Number of buffered readings which triggers a flush. The default of 1 writes every reading straight through.
+            flush_interval_sec (float, optional): Flush once the oldest buffered reading is this old, even if batch_size hasn't been reached.
+            max_buffer_size (int): Writers wait for a flush to drain the buffer once it holds this many readings.
+            manage_partitions (bool): Create the monthly energy_usage partition for a month before its first write
+                (see sql/01_init.sql). Turned off automatically for databases created before the table was partitioned.
+        '''
         self.db_config = db_config
-        self.conn = None
+        self.min_pool_size = min_pool_size
+        self.max_pool_size = max_pool_size
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.max_buffer_size = max_buffer_size
+        self.pool = None
+        #serializes pool creation so concurrent first callers share one pool
+        self._connect_lock = asyncio.Lock()
+        #write-behind buffer of reading records (tuples in EnergyUsage.keys() order)
+        self.buffer = []
+        self._buffer_started = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        #readings dropped because the database rejected them
+        self.dropped_rows = 0
+        self.manage_partitions = manage_partitions
+        #(year, month) of the partitions known to exist
+        self._partitions = set()
+        #the insert query text never changes so asyncpg prepares it once per pooled connection and reuses it
+        self.insert_sql_query = self._generate_insert_sql_query()
+
+    async def connect(self):
+        '''
+        Create the connection pool if it doesn't exist yet. Creating the pool opens min_pool_size connections
+        so calling this at startup warms the pool before the first write.
+        '''
+        if self.pool is None:
+            async with self._connect_lock:
+                if self.pool is None:
+                    self.pool = await asyncpg.create_pool(**self.db_config, min_size=self.min_pool_size, max_size=self.max_pool_size)
+        return self.pool
 
     async def write_usage(self, energy_usage: EnergyUsage) -> None:
-        self.conn = await asyncpg.connect(**self.db_config)
-        try:
-            energy_usage_dict = energy_usage.get_dict()
-            sql_query = self._generate_insert_sql_query(energy_usage)
-            await self.conn.execute(sql_query, *energy_usage_dict.values())
-        finally:
-            await self.close()
+        await self.write_usage_batch([energy_usage])
+
+    async def write_usage_batch(self, energy_usages: list) -> None:
+        #backpressure, don't accept more readings until a flush has drained the buffer
+        while len(self.buffer) >= self.max_buffer_size:
+            await self.flush()
+
+        if not self.buffer:
+            self._buffer_started = time.monotonic()
+        self.buffer.extend(as_rows(energy_usages))
+
+        buffer_expired = self.flush_interval_sec is not None and self._buffer_age() >= self.flush_interval_sec
+        if len(self.buffer) >= self.batch_size or buffer_expired:
+            await self.flush()
+        elif self.flush_interval_sec is not None and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def flush(self):
+        '''
+        Write all buffered readings. A single reading goes through the prepared insert, anything larger is
+        bulk loaded with COPY in one round trip. If some of the readings are already stored (e.g. replayed from a
+        spool while they were buffered) the batch is written with the idempotent insert instead. If the write
+        fails with a transient error (see _TRANSIENT_ERRORS), or the flush is cancelled, the readings stay buffered
+        for the next flush. A batch which fails with any other error is logged and dropped, and the error raised.
+        '''
+        async with self._flush_lock:
+            if not self.buffer:
+                return
+            records, self.buffer = self.buffer, []
+            self._buffer_started = None
+            try:
+                await self._ensure_partitions(record[1] for record in records)
+                try:
+                    if len(records) == 1:
+                        await self._run(lambda conn: conn.execute(self.insert_sql_query, *records[0]))
+                    else:
+                        await self._run(lambda conn: conn.copy_records_to_table("energy_usage", records=records, columns=EnergyUsage.KEYS))
+                except asyncpg.exceptions.UniqueViolationError:
+                    await self._insert_ignore(records)
+            except _TRANSIENT_ERRORS + (asyncio.CancelledError,):
+                self.buffer = records + self.buffer
+                self._buffer_started = time.monotonic()
+                raise
+            except Exception as e:
+                self.dropped_rows += len(records)
+                _LOGGER.error("The database rejected %d buffered readings, dropping them: %r. Readings: %r", len(records), e, records)
+                raise
+
+    async def write_usage_batch_idempotent(self, energy_usages) -> None:
+        '''
+        Insert the readings in one statement, bypassing the write-behind buffer, and skip the ones already stored.
+        '''
+        records = as_rows(energy_usages)
+        if records:
+            await self._ensure_partitions(record[1] for record in records)
+            await self._insert_ignore(records)
+
+    def take_unflushed(self) -> list:
+        records, self.buffer = self.buffer, []
+        self._buffer_started = None
+        return records
 
     async def read_usage(self, last_n=10, columns="*"):
-        self.conn = await asyncpg.connect(**self.db_config)
+        #buffered readings are written first so a read sees everything written before it
+        await self.flush()
+        sql_query = self._generate_select_sql_query(columns=columns)
+        return await self._run(lambda conn: conn.fetch(sql_query, last_n))
+
+    async def read_usage_range(self, start, end) -> list:
+        await self.flush()
+        records = await self._run(lambda conn: conn.fetch(
+            "SELECT * FROM energy_usage WHERE timestamp >= $1 AND timestamp < $2 ORDER BY timestamp", start, end))
+        return [EnergyUsage(energy_usage_dict=dict(record)) for record in records]
+
+    async def iter_usage(self, start=None, end=None, devices=None, columns="*", prefetch=1000):
+        '''
+        Stream readings in timestamp order through a server-side cursor, only prefetch rows are held in memory
+        at a time. The cursor keeps a pooled connection (and a read transaction) until the iteration finishes.
+        '''
+        await self.flush()
+        columns_str = ', '.join(self._check_columns(columns))
+        where, args = self._generate_where_clause(start, end, devices)
+        sql_query = f"SELECT {columns_str} FROM energy_usage{where} ORDER BY timestamp"
+        pool = await self.connect()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                async for record in conn.cursor(sql_query, *args, prefetch=prefetch):
+                    yield EnergyUsage.from_dict(dict(record))
+
+    async def aggregate_usage(self, start, end, bucket, agg="avg", devices=None) -> list:
+        check_aggregate(agg)
+        await self.flush()
+        where, args = self._generate_where_clause(start, end, devices, first_arg=2)
+        #date_bin with the unix epoch as origin gives the same buckets as the other stores
+        sql_query = f"""
+            SELECT device, date_bin($1::interval, timestamp, TIMESTAMPTZ '1970-01-01 00:00:00+00') AS bucket, count(*) AS samples,
+                {agg}(power_draw_watts) AS power_draw_watts, sum(avg_emitted_mgco2e) AS avg_emitted_mgco2e,
+                {agg}(grid_carbon_intensity_gco2perkwhr) AS grid_carbon_intensity_gco2perkwhr
+            FROM energy_usage{where}
+            GROUP BY 1, 2
+            ORDER BY 2, 1"""
+        records = await self._run(lambda conn: conn.fetch(sql_query, bucket, *args))
+        return [dict(record) for record in records]
+
+    async def usage_totals(self, start, end, devices=None) -> dict:
+        await self.flush()
+        where, args = self._generate_where_clause(start, end, devices)
+        records = await self._run(lambda conn: conn.fetch(self.USAGE_TOTALS_SQL_QUERY.format(where=where), *args))
+        return {record["device"]: {"samples": record["samples"], "energy_wh": float(record["energy_wh"]),
+                                   "emitted_mgco2e": record["emitted_mgco2e"]} for record in records}
+
+    async def update_carbon_batch(self, energy_usages: list) -> None:
+        #make sure buffered readings exist before updating them, then update the whole batch in one statement
+        await self.flush()
+        columns = list(zip(*[(energy_usage.device, energy_usage.timestamp, energy_usage.avg_emitted_mgco2e,
+                              energy_usage.grid_carbon_intensity_gco2perkwhr) for energy_usage in energy_usages]))
+        if columns:
+            await self._run(lambda conn: conn.execute(self.UPDATE_CARBON_SQL_QUERY, *columns))
+            if self.manage_partitions:
+                #the rollups only track inserts so rebuild the buckets the updated readings fall in
+                await self._run(lambda conn: conn.execute("SELECT refresh_energy_usage_rollups($1, $2)", min(columns[1]), max(columns[1])))
+
+    async def close(self):
+        if self._flush_task is not None:
+            task, self._flush_task = self._flush_task, None
+            #holding the lock lets an in-flight periodic flush finish, the task is only cancelled while it waits
+            async with self._flush_lock:
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
         try:
-            sql_query = self._generate_select_sql_query(last_n, columns=columns)
-            result = await self.conn.fetch(sql_query)
+            if self.buffer:
+                await self.flush()
         finally:
-            await self.close()
-        return result
+            if self.pool is not None:
+                await self.pool.close()
+                self.pool = None
 
-    async def close(self):
-        if self.conn is not None and not self.conn.is_closed():
-            await self.conn.close()
-            self.conn = None
-
-    def _generate_insert_sql_query(self, energy_usage: EnergyUsage):
-        energy_usage_dict = energy_usage.get_dict()
-        columns = ', '.join(energy_usage_dict.keys())
-        values = ', '.join(['$' + str(i) for i in range(1, len(energy_usage_dict) + 1)])
+    async def _ensure_partitions(self, timestamps):
+        if not self.manage_partitions:
+            return
+        months = {}
+        for timestamp in timestamps:
+            utc = timestamp.astimezone(timezone.utc)
+            months.setdefault((utc.year, utc.month), utc)
+        for month, timestamp in months.items():
+            if month in self._partitions:
+                continue
+            try:
+                await self._run(lambda conn: conn.execute("SELECT ensure_energy_usage_partition($1)", timestamp))
+            except asyncpg.exceptions.UndefinedFunctionError:
+                _LOGGER.warning("energy_usage isn't partitioned (created by an older sql/01_init.sql), not managing partitions")
+                self.manage_partitions = False
+                return
+            self._partitions.add(month)
+
+    def _buffer_age(self):
+        if self._buffer_started is None:
+            return 0.0
+        return time.monotonic() - self._buffer_started
+
+    async def _flush_periodically(self):
+        #flushes readings which have been buffered for flush_interval_sec without reaching batch_size
+        while True:
+            await asyncio.sleep(self.flush_interval_sec)
+            if self._buffer_age() >= self.flush_interval_sec:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    _LOGGER.warning("Failed to flush buffered energy usage: %r", e)
+
+    async def _insert_ignore(self, records):
+        columns = [list(column) for column in zip(*records)]
+        await self._run(lambda conn: conn.execute(self.INSERT_IGNORE_SQL_QUERY, *columns))
+
+    async def _run(self, operation):
+        '''
+        Run operation(conn) on a pooled connection. If the connection turns out to be broken (e.g. the server
+        restarted) the pool's idle connections are expired and the operation is retried once on a fresh connection.
+        '''
+        pool = await self.connect()
+        try:
+            async with pool.acquire() as conn:
+                return await operation(conn)
+        except _CONNECTION_ERRORS:
+            await pool.expire_connections()
+            async with pool.acquire() as conn:
+                return await operation(conn)
+
+    def _generate_insert_sql_query(self, energy_usage: EnergyUsage = None):
+        keys = energy_usage.get_dict().keys() if energy_usage is not None else EnergyUsage.KEYS
+        columns = ', '.join(keys)
+        values = ', '.join(['$' + str(i) for i in range(1, len(keys) + 1)])
         return f"INSERT INTO energy_usage ({columns}) VALUES ({values})"
 
-    def _generate_select_sql_query(self, last_n, columns="*"):
+    def _generate_select_sql_query(self, columns="*"):
+        columns_str = ', '.join(self._check_columns(columns))
+        return f"SELECT {columns_str} FROM energy_usage ORDER BY timestamp DESC LIMIT $1"
+
+    def _generate_where_clause(self, start=None, end=None, devices=None, first_arg=1):
+        #the values are always passed as query arguments, never interpolated
+        conditions = []
+        args = []
+        for condition, value in (("timestamp >= ${}", start), ("timestamp < ${}", end), ("device = ANY(${}::varchar[])", devices)):
+            if value is not None:
+                conditions.append(condition.format(first_arg + len(args)))
+                args.append(list(value) if condition.startswith("device") else value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return where, args
+
+    def _check_columns(self, columns):
+        #column names are interpolated into the query so only accept the table's own columns
         if columns == "*":
-            columns_str = "*"
-        else:
-            columns_str = ', '.join(columns)
-        return f"SELECT {columns_str} FROM energy_usage ORDER BY timestamp DESC LIMIT {last_n}"
\ No newline at end of file
+            return EnergyUsage.keys()
+        unknown = set(columns) - set(EnergyUsage.keys())
+        if unknown:
+            raise ValueError(f"Unknown columns {sorted(unknown)}")
+        return list(columns)
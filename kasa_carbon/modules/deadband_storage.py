@@ -0,0 +1,126 @@
+from datetime import timedelta
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import ReadingBatch, as_rows
+
+class DeadbandStorage(DatastoreAPI):
+    '''
+    Write suppression in front of another store. A device's reading is only written when its power or the grid
+    intensity moves beyond the deadband since the device's last written reading, or when heartbeat has passed
+    since then. A value moves beyond the deadband when |new - last| > max(absolute, relative * |last|).
+
+    Emissions aren't lost: the emissions of suppressed readings are added to the next written reading. When a
+    change ends a run of suppressed readings the last suppressed reading is written first (carrying the run's
+    emissions), so every stored row's power holds, within the deadband, for the whole time since the device's
+    previous stored row. usage_totals integrates energy that way, and the backfill's trapezoidal rule between
+    stored rows stays within the deadband of it.
+    '''
+    def __init__(self, store: DatastoreAPI, power_abs_watts=0.0, power_rel=0.0, intensity_abs=0.0, intensity_rel=0.0,
+                 heartbeat=timedelta(minutes=10)):
+        '''
+        Args:
+            store (DatastoreAPI): The store written to.
+            power_abs_watts (float): Absolute power deadband in watts.
+            power_rel (float): Relative power deadband, e.g. 0.05 for 5%.
+            intensity_abs (float): Absolute grid intensity deadband in gCO2e/kWh.
+            intensity_rel (float): Relative grid intensity deadband.
+            heartbeat (timedelta): Write a reading at least this often per device even if nothing changed.
+        '''
+        self.store = store
+        self.power_abs_watts = power_abs_watts
+        self.power_rel = power_rel
+        self.intensity_abs = intensity_abs
+        self.intensity_rel = intensity_rel
+        self.heartbeat = heartbeat
+        #device -> last written row, and device -> (last suppressed row, emissions of all suppressed rows since the last write)
+        self._written = {}
+        self._held = {}
+        self.received_rows = 0
+        self.written_rows = 0
+
+    async def write_usage(self, energy_usage: EnergyUsage) -> None:
+        await self.write_usage_batch([energy_usage])
+
+    async def write_usage_batch(self, energy_usages) -> None:
+        rows = []
+        for row in as_rows(energy_usages):
+            rows.extend(self._filter(row))
+        self.received_rows += len(energy_usages)
+        await self._write(rows)
+
+    async def write_usage_batch_idempotent(self, energy_usages) -> None:
+        #a replayed batch has already been through the deadband when it was first written
+        await self.store.write_usage_batch_idempotent(energy_usages)
+
+    async def flush(self):
+        '''Write the held (suppressed) reading of every device so the stored emissions are complete.'''
+        rows = [_with_emitted(row, emitted) for row, emitted in self._held.values()]
+        for row in rows:
+            self._written[row[0]] = row
+        self._held = {}
+        await self._write(rows)
+
+    @property
+    def suppressed_rows(self) -> int:
+        '''Number of readings which weren't written.'''
+        return self.received_rows - self.written_rows
+
+    async def read_usage(self, last_n=10, columns="*"):
+        return await self.store.read_usage(last_n, columns)
+
+    async def read_usage_range(self, start, end) -> list:
+        return await self.store.read_usage_range(start, end)
+
+    def iter_usage(self, start=None, end=None, devices=None, columns="*"):
+        return self.store.iter_usage(start, end, devices, columns)
+
+    async def aggregate_usage(self, start, end, bucket, agg="avg", devices=None) -> list:
+        return await self.store.aggregate_usage(start, end, bucket, agg, devices)
+
+    async def usage_totals(self, start, end, devices=None) -> dict:
+        return await self.store.usage_totals(start, end, devices)
+
+    async def update_carbon_batch(self, energy_usages: list) -> None:
+        await self.store.update_carbon_batch(energy_usages)
+
+    async def close(self):
+        await self.flush()
+        await self.store.close()
+
+    async def _write(self, rows):
+        self.written_rows += len(rows)
+        if rows:
+            await self.store.write_usage_batch(ReadingBatch(*zip(*rows)))
+
+    def _filter(self, row):
+        #returns the rows to write for a new reading
+        device = row[0]
+        last = self._written.get(device)
+        held = self._held.pop(device, None)
+        if last is None or self._changed(last, row):
+            rows = [_with_emitted(*held), row] if held is not None else [row]
+        else:
+            emitted = _add(held[1] if held is not None else None, row[3])
+            if row[1] - last[1] < self.heartbeat:
+                self._held[device] = (row, emitted)
+                return []
+            rows = [_with_emitted(row, emitted)]
+        self._written[device] = rows[-1]
+        return rows
+
+    def _changed(self, last, row):
+        return (_beyond(last[2], row[2], self.power_abs_watts, self.power_rel)
+                or _beyond(last[4], row[4], self.intensity_abs, self.intensity_rel))
+
+def _beyond(last, value, absolute, relative):
+    if last is None or value is None:
+        return (last is None) != (value is None)
+    return abs(value - last) > max(absolute, relative * abs(last))
+
+def _add(total, value):
+    if value is None:
+        return total
+    return value if total is None else total + value
+
+def _with_emitted(row, emitted):
+    return row[:3] + (emitted,) + row[4:]
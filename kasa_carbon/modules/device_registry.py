@@ -0,0 +1,49 @@
+import json
+import os
+from kasa import SmartStrip
+
+class DeviceRegistry:
+    '''
+    The devices seen on the network, persisted to a json file so the monitor can connect straight to known hosts
+    at startup instead of waiting on a broadcast discovery:
+
+        {"<host>": {"host": ..., "port": ..., "alias": ..., "model": ..., "children": [<plug aliases>]}}
+
+    The file is replaced atomically (temp file plus rename) so it's never left half written.
+    '''
+    def __init__(self, path):
+        self.path = path
+        #host -> record
+        self.devices = {}
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.devices = json.load(f)
+
+    def hosts(self) -> list:
+        return list(self.devices)
+
+    def update(self, host, device):
+        '''
+        Record a connected device, returns True if the record changed.
+        '''
+        record = {
+            "host": host,
+            "port": getattr(device, "port", None),
+            "alias": device.alias,
+            "model": device.model,
+            "children": [plug.alias for plug in device.children] if isinstance(device, SmartStrip) else [],
+        }
+        changed = self.devices.get(host) != record
+        self.devices[host] = record
+        return changed
+
+    def remove(self, host):
+        return self.devices.pop(host, None) is not None
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.devices, f, indent=2)
+        os.replace(temp_path, self.path)
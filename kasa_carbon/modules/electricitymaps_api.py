@@ -1,46 +1,67 @@
 
+import asyncio
+import logging
 import aiohttp
 from kasa_carbon.interfaces.carbon_api import CarbonAPI
-import os 
+from kasa_carbon.modules.carbon_cache import CarbonCache
 from datetime import datetime, timezone, timedelta
-import json
+
+_LOGGER = logging.getLogger(__name__)
 
 class ElectricityMapAPI(CarbonAPI):
     BASE_URL = "https://api-access.electricitymaps.com/free-tier/carbon-intensity/latest"
+    HISTORY_URL = "https://api-access.electricitymaps.com/free-tier/carbon-intensity/past-range"
+    #maximum range of a single past-range request for hourly data
+    HISTORY_MAX_RANGE = timedelta(days=10)
     CACHE_FILE = "em_cache.json"
 
-    def __init__(self, em_api_key, co2_time_threshold_mins=120, clear_cache=False, em_cache_expiry_mins=30):
+    def __init__(self, em_api_key, co2_time_threshold_mins=120, clear_cache=False, em_cache_expiry_mins=30, cache_max_size=1024,
+                 background_refresh=True, refresh_margin_mins=5, refresh_backoff_max_mins=30):
+        '''
+        Args:
+            em_api_key (str): Electricity Maps api key.
+            co2_time_threshold_mins (int): Intensity data older than this is treated as unavailable.
+            clear_cache (bool): Start with an empty cache rather than loading em_cache.json.
+            em_cache_expiry_mins (int): Minutes a fetched intensity is served from the cache.
+            cache_max_size (int): Maximum number of cached locations.
+            background_refresh (bool): Refresh each looked up location in a background task shortly before it
+                expires and serve the expired value while a refresh is running, so callers only wait on the
+                api the first time a location is looked up.
+            refresh_margin_mins (float): How long before expiry the background refresh runs.
+            refresh_backoff_max_mins (float): Upper bound of the exponential backoff between failed refreshes.
+        '''
         self.api_key = em_api_key 
         self.co2_time_threshold_mins = co2_time_threshold_mins
-        self.CACHE_EXPIRY = timedelta(int(em_cache_expiry_mins))
+        if em_cache_expiry_mins is None:
+            em_cache_expiry_mins = 30
+        self.CACHE_EXPIRY = timedelta(minutes=int(em_cache_expiry_mins))
+        self.cache = CarbonCache(self.CACHE_FILE, self.CACHE_EXPIRY, max_size=cache_max_size)
+        #one keep-alive session per api object, created on first use
+        self._session = None
+        #fetches in progress keyed by cache key so concurrent callers for the same zone share one request
+        self._in_flight = {}
+        self.background_refresh = background_refresh
+        self.refresh_margin = timedelta(minutes=refresh_margin_mins)
+        self.refresh_backoff_max = timedelta(minutes=refresh_backoff_max_mins)
+        #locations the refresher keeps warm (cache key -> params) and their backoff state (cache key -> (delay, retry_at))
+        self._watched = {}
+        self._backoff = {}
+        self._refresh_task = None
         if clear_cache:
             self._clear_cache()
         else:
             self._load_cache()
     
     def _load_cache(self):
-        if os.path.exists(self.CACHE_FILE):
-            with open(self.CACHE_FILE, 'r') as f:
-                cache = json.load(f)
-                # Convert the keys from strings to dictionaries and the timestamps from strings to datetime objects
-                self.cache = {key: [value[0], datetime.fromisoformat(value[1])] for key, value in cache.items()}
-        else:
-            self.cache = {}
-
-    def _save_cache(self):
-        # Convert the timestamps from datetime objects to strings
-        cache = {key: [value[0], value[1].isoformat()] for key, value in self.cache.items()}
-        with open(self.CACHE_FILE, 'w') as f:
-            json.dump(cache, f)
+        self.cache.load()
 
     def _clear_cache(self):
-        self.cache = {}
-        self._save_cache()
+        self.cache.clear()
 
     async def get_co2_by_gridid(self, grid_id: str) -> float:
         '''
         Get the current CO2 emission rate per kWh for a specific location, identified by grid ID.
-        Will use a local cache to store the data for 30 minutes to ease the load on the API.
+        Will use a local cache to store the data for em_cache_expiry_mins minutes to ease the load on the API.
 
         Args:
             grid_id (str): The grid ID of the specific location.
@@ -54,7 +75,7 @@ class ElectricityMapAPI(CarbonAPI):
     async def get_co2_by_latlon(self, lat: float, lon: float) -> float:
         '''
         Get the current CO2 emission rate per kWh for a specific location, identified by latitude and longitude.
-        Will use a local cache to store the data for 30 minutes to ease the load on the API.
+        Will use a local cache to store the data for em_cache_expiry_mins minutes to ease the load on the API.
 
         Args:
             lat (float): The latitude of the location.
@@ -66,26 +87,138 @@ class ElectricityMapAPI(CarbonAPI):
         params = {"lat": lat, "lon": lon}
         return await self._get_co2_data(params)
 
+    async def get_co2_history_by_gridid(self, grid_id: str, start: datetime, end: datetime) -> list:
+        '''
+        Get the hourly CO2 emission rate per kWh for a grid between start and end. Long ranges are split into
+        HISTORY_MAX_RANGE requests, history isn't cached.
+
+        Args:
+            grid_id (str): The grid ID of the specific location.
+            start (datetime): The start of the range.
+            end (datetime): The end of the range.
+
+        Returns:
+            list: (datetime, gCO2/kWh) tuples in time order, hours without data are left out.
+        '''
+        #keyed by time, adjacent windows share their boundary hour
+        history = {}
+        window_start = start
+        while window_start < end:
+            window_end = min(window_start + self.HISTORY_MAX_RANGE, end)
+            params = {"zone": grid_id, "start": window_start.isoformat(), "end": window_end.isoformat()}
+            async with self._get_session().get(self.HISTORY_URL, params=params) as response:
+                response.raise_for_status()
+                data = await response.json()
+            for point in data["data"]:
+                if point.get("carbonIntensity") is not None:
+                    history[datetime.fromisoformat(point["datetime"])] = float(point["carbonIntensity"])
+            window_start = window_end
+        return sorted(history.items())
+
     async def _get_co2_data(self, params) -> float:
-        # Check if the data is in the cache and is less than 30 minutes old
+        # Check if the data is in the cache and is younger than the cache expiry
         # Convert the params dictionary to a string to use as a key
         cache_key = '_'.join(str(v) for v in params.values())
-        if cache_key in self.cache and datetime.now(timezone.utc) - self.cache[cache_key][1] < self.CACHE_EXPIRY:
-            return self.cache[cache_key][0]
-
-        headers = {"auth-token": self.api_key}
+        entry = self.cache.get(cache_key, stale=self.background_refresh)
+        if self.background_refresh:
+            self._watch(cache_key, params)
+        if entry is not None:
+            if self.cache.is_expired(entry) and not self._backing_off(cache_key):
+                #serve the last good value and let the refresh happen off the caller's path
+                self._start_fetch(params, cache_key)
+            return entry[0]
+
+        #shield so a caller being cancelled doesn't cancel the fetch the other callers are waiting on
+        return await asyncio.shield(self._start_fetch(params, cache_key))
+
+    def _start_fetch(self, params, cache_key):
+        fetch = self._in_flight.get(cache_key)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self._fetch_co2_data(params, cache_key))
+            self._in_flight[cache_key] = fetch
+            fetch.add_done_callback(lambda done: self._fetch_done(cache_key, done))
+        return fetch
+
+    def _fetch_done(self, cache_key, fetch):
+        if self._in_flight.get(cache_key) is fetch:
+            self._in_flight.pop(cache_key)
+        if fetch.cancelled():
+            return
+        if fetch.exception() is not None:
+            #retrieving the exception here also keeps background fetches nobody awaited from warning
+            delay = self._backoff.get(cache_key, (timedelta(0), None))[0]
+            delay = min(max(delay * 2, timedelta(seconds=10)), self.refresh_backoff_max)
+            self._backoff[cache_key] = (delay, datetime.now(timezone.utc) + delay)
+            _LOGGER.warning("Failed to fetch carbon intensity for %s, retrying in %s: %r", cache_key, delay, fetch.exception())
+        else:
+            self._backoff.pop(cache_key, None)
+
+    def _backing_off(self, cache_key):
+        backoff = self._backoff.get(cache_key)
+        return backoff is not None and backoff[1] > datetime.now(timezone.utc)
+
+    def _watch(self, cache_key, params):
+        self._watched[cache_key] = params
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        #renew each watched location refresh_margin before it expires, backing off after failures
+        while True:
+            now = datetime.now(timezone.utc)
+            next_due = now + timedelta(minutes=1)
+            margin = min(self.refresh_margin, self.cache.expiry / 2)
+            fetches = []
+            for cache_key, params in list(self._watched.items()):
+                entry = self.cache.peek(cache_key)
+                due = now if entry is None else entry[1] + self.cache.expiry - margin
+                backoff = self._backoff.get(cache_key)
+                if backoff is not None:
+                    due = max(due, backoff[1])
+                if due <= now:
+                    fetches.append(self._start_fetch(params, cache_key))
+                else:
+                    next_due = min(next_due, due)
+            if fetches:
+                #failures are handled (and backed off) in _fetch_done
+                await asyncio.gather(*fetches, return_exceptions=True)
+                continue
+            await asyncio.sleep(max((next_due - datetime.now(timezone.utc)).total_seconds(), 0.01))
+
+    async def _fetch_co2_data(self, params, cache_key) -> float:
         co2_data = None
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.BASE_URL, headers=headers, params=params) as response:
-                data = await response.json()
-                co2_data = self._process_co2_data(data)
+        async with self._get_session().get(self.BASE_URL, params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+            co2_data = self._process_co2_data(data)
         
-        # Store the data and the current time in the cache
-        self.cache[cache_key] = (co2_data, datetime.now(timezone.utc))
-        self._save_cache()  # Save the cache to the file
+        # Store the data and the current time in the cache, the cache file is written in the background
+        self.cache.put(cache_key, co2_data)
 
         return co2_data
 
+    def cache_stats(self) -> dict:
+        return self.cache.stats()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            #keep connections alive between requests and cache dns lookups rather than resolving on every miss
+            connector = aiohttp.TCPConnector(ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, headers={"auth-token": self.api_key})
+        return self._session
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        for fetch in list(self._in_flight.values()):
+            fetch.cancel()
+        self._in_flight = {}
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await self.cache.flush()
+
     def _process_co2_data(self, data):
         data_updated_at = datetime.strptime(data["updatedAt"], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
         #verify its within the last minutes defined by co2_time_threshold
@@ -0,0 +1,91 @@
+import numpy as np
+
+def emitted_mgco2e(power_watts, interval_sec, intensity_gco2perkwhr):
+    '''
+    Emissions for a device drawing power_watts for interval_sec on a grid with the given carbon intensity,
+    assuming constant power over the interval. Works element-wise on numpy arrays; a NaN intensity gives a NaN result.
+
+    Args:
+        power_watts: Power draw in watts.
+        interval_sec: Length of the interval in seconds.
+        intensity_gco2perkwhr: Grid carbon intensity in gCO2e/kWh.
+
+    Returns:
+        The emissions in mgCO2e.
+    '''
+    power_kwatts = np.asarray(power_watts, dtype=np.float64) / 1000.0 #convert to kW from watts
+    hours = np.asarray(interval_sec, dtype=np.float64) / 3600.0 #time in use in hours
+    return hours * power_kwatts * np.asarray(intensity_gco2perkwhr, dtype=np.float64) / 1000.0 #convert to mgCO2e
+
+def trapezoidal_mgco2e(power_watts, previous_power_watts, interval_sec, intensity_gco2perkwhr):
+    '''
+    Emissions over the interval between two samples of each device, integrating power with the trapezoidal rule
+    (power assumed to change linearly between the samples). Works element-wise on numpy arrays, where there is
+    no previous sample pass the current power as previous_power_watts to fall back to constant power.
+
+    Args:
+        power_watts: Power draw at the end of the interval in watts.
+        previous_power_watts: Power draw at the start of the interval in watts.
+        interval_sec: Time between the samples in seconds.
+        intensity_gco2perkwhr: Grid carbon intensity in gCO2e/kWh, NaN where it isn't known.
+
+    Returns:
+        The emissions in mgCO2e, NaN where the intensity is NaN.
+    '''
+    average_power = (np.asarray(power_watts, dtype=np.float64) + np.asarray(previous_power_watts, dtype=np.float64)) / 2.0
+    return emitted_mgco2e(average_power, interval_sec, intensity_gco2perkwhr)
+
+def seconds_since_previous(devices, times, previous_times: dict, default=np.nan):
+    '''
+    Seconds between each reading and the previous reading of the same device, for readings in any order.
+
+    Args:
+        devices: Device of each reading.
+        times: Unix time in seconds of each reading.
+        previous_times (dict): Time of the latest earlier reading per device, e.g. from a previous chunk. Updated
+            in place with the latest time of each device so it can be passed along with the next chunk.
+        default: Interval of readings without any previous reading.
+
+    Returns:
+        numpy.ndarray: The interval of each reading in seconds.
+    '''
+    times = np.asarray(times, dtype=np.float64)
+    previous = previous_values(devices, times, times, previous_times)
+    return np.where(np.isnan(previous), default, times - previous)
+
+def previous_values(devices, times, values, previous: dict):
+    '''
+    The value of the previous reading of the same device for each reading, for readings in any order.
+
+    Args:
+        devices: Device of each reading.
+        times: Unix time in seconds of each reading, which orders each device's readings.
+        values: Value of each reading.
+        previous (dict): Value of the latest earlier reading per device, e.g. from a previous chunk. Updated in
+            place with the value of the latest reading of each device so it can be passed along with the next chunk.
+
+    Returns:
+        numpy.ndarray: The previous value of each reading, NaN for readings without any previous reading.
+    '''
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(times) == 0:
+        return np.empty(0)
+    codes, inverse = np.unique(np.asarray(devices), return_inverse=True)
+    order = np.lexsort((times, inverse))
+    sorted_values = values[order]
+    sorted_codes = inverse[order]
+    sorted_previous = np.empty(len(times))
+    sorted_previous[1:] = sorted_values[:-1]
+    first = np.ones(len(times), dtype=bool)
+    first[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    #the first reading of a device continues from previous if there is an entry for it
+    sorted_previous[first] = [previous.get(codes[code], np.nan) for code in sorted_codes[first]]
+    result = np.empty(len(times))
+    result[order] = sorted_previous
+
+    last = np.ones(len(times), dtype=bool)
+    last[:-1] = sorted_codes[:-1] != sorted_codes[1:]
+    for code, value in zip(sorted_codes[last], sorted_values[last]):
+        previous[codes[code]] = value
+    return result
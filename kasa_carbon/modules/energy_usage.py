@@ -1,7 +1,12 @@
 from datetime import datetime, timezone
 
 class EnergyUsage:
-    def __init__(self, device=None, power=None, co2emitted=None, co2=None, energy_usage_dict=None):
+    #column order of the energy_usage table, the csv files and the tuples from as_tuple()
+    KEYS = ("device", "timestamp", "power_draw_watts", "avg_emitted_mgco2e", "grid_carbon_intensity_gco2perkwhr")
+    #slots keep each reading a small fixed size record rather than an object with its own __dict__
+    __slots__ = KEYS
+
+    def __init__(self, device=None, power=None, co2emitted=None, co2=None, energy_usage_dict=None, timestamp=None):
         if energy_usage_dict is not None:
             self.device = energy_usage_dict["device"]
             self.timestamp = energy_usage_dict["timestamp"]
@@ -10,17 +15,49 @@ class EnergyUsage:
             self.grid_carbon_intensity_gco2perkwhr = energy_usage_dict["grid_carbon_intensity_gco2perkwhr"]
         else:
             self.device = device
-            self.timestamp = datetime.now(timezone.utc)
+            self.timestamp = timestamp if timestamp is not None else datetime.now(timezone.utc)
             self.power_draw_watts = power
             self.avg_emitted_mgco2e = co2emitted
             self.grid_carbon_intensity_gco2perkwhr = co2
     
     #get dict representation of energy usage
     def get_dict(self) -> dict:
-        return {"device": self.device, "timestamp": self.timestamp, "power_draw_watts": self.power_draw_watts, 
-                "avg_emitted_mgco2e": self.avg_emitted_mgco2e, "grid_carbon_intensity_gco2perkwhr": self.grid_carbon_intensity_gco2perkwhr}
+        return dict(zip(EnergyUsage.KEYS, self.as_tuple()))
+
+    #get the values in column order without building a dict
+    def as_tuple(self) -> tuple:
+        return (self.device, self.timestamp, self.power_draw_watts, self.avg_emitted_mgco2e, self.grid_carbon_intensity_gco2perkwhr)
     
     #get csv headers
     @staticmethod
     def keys() -> list:
-        return ["device", "timestamp", "power_draw_watts", "avg_emitted_mgco2e", "grid_carbon_intensity_gco2perkwhr"]
\ No newline at end of file
+        return list(EnergyUsage.KEYS)
+
+    #build from a subset of the columns, columns which aren't in values are left as None
+    @staticmethod
+    def from_dict(values: dict) -> "EnergyUsage":
+        energy_usage = EnergyUsage()
+        energy_usage.timestamp = None
+        for key, value in values.items():
+            setattr(energy_usage, key, value)
+        return energy_usage
+
+    #parse a row written by FileStorage, columns which aren't in keys are left as None
+    @staticmethod
+    def from_csv_row(row: list, keys: list = None) -> "EnergyUsage":
+        energy_usage = EnergyUsage()
+        energy_usage.timestamp = None
+        for key, value in zip(EnergyUsage.KEYS, row):
+            if keys is not None and key not in keys:
+                continue
+            if value == "":
+                value = None
+            elif key == "timestamp":
+                value = datetime.fromisoformat(value)
+            elif key != "device":
+                value = float(value)
+            setattr(energy_usage, key, value)
+        return energy_usage
+
+    def __repr__(self):
+        return f"EnergyUsage({self.get_dict()})"
@@ -0,0 +1,94 @@
+import gzip
+import io
+import json
+import os
+import shutil
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+def check_compression(compression):
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"compression must be one of {list(COMPRESSION_SUFFIXES)}")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+
+def compress_file(path, compression) -> str:
+    '''
+    Compress path next to itself and remove the original.
+
+    Returns:
+        str: The path of the compressed file (path itself if compression is None).
+    '''
+    if compression is None:
+        return path
+    compressed_path = path + COMPRESSION_SUFFIXES[compression]
+    with open(path, 'rb') as src:
+        if compression == "gzip":
+            with gzip.open(compressed_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            with open(compressed_path, 'wb') as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+    os.remove(path)
+    return compressed_path
+
+def open_segment(path):
+    '''Open a (possibly compressed) csv segment for reading as text.'''
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', newline='')
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError("reading zstd segments requires the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True), newline='')
+    return open(path, 'r', newline='')
+
+class SegmentManifest:
+    '''
+    Json manifest of the closed segments of a rotated csv file, oldest first. Each segment records its path,
+    the timestamps of its first and last rows and its row count so range readers can skip segments which
+    can't contain rows of interest.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.segments = json.load(f)
+
+    def add(self, segment_path, start: datetime, end: datetime, rows: int):
+        self.segments.append({"path": segment_path, "start": start.isoformat() if start else None,
+                              "end": end.isoformat() if end else None, "rows": rows})
+        self.save()
+
+    def remove_oldest(self, keep: int) -> list:
+        '''Drop all but the newest keep segments from the manifest and return the dropped entries.'''
+        if keep is None or len(self.segments) <= keep:
+            return []
+        dropped = self.segments[:len(self.segments) - keep]
+        self.segments = self.segments[len(self.segments) - keep:]
+        self.save()
+        return dropped
+
+    def segments_for_range(self, start: datetime = None, end: datetime = None) -> list:
+        '''Return the paths of the segments which overlap [start, end], oldest first.'''
+        paths = []
+        for segment in self.segments:
+            if start is not None and segment["end"] is not None and datetime.fromisoformat(segment["end"]) < start:
+                continue
+            if end is not None and segment["start"] is not None and datetime.fromisoformat(segment["start"]) > end:
+                continue
+            paths.append(segment["path"])
+        return paths
+
+    def save(self):
+        #write to a temp file and rename so a crash never leaves a half written manifest
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.segments, f)
+        os.replace(temp_path, self.path)
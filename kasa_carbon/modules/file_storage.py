@@ -1,31 +1,355 @@
 import asyncio
 from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import as_rows
 from kasa_carbon.interfaces.datastore_api import DatastoreAPI
-import csv, os
+from kasa_carbon.modules.file_segments import SegmentManifest, COMPRESSION_SUFFIXES, check_compression, compress_file, open_segment
+from datetime import datetime
+import csv, os, time
 
-class FileStorage(DatastoreAPI): 
-    def __init__(self, file_path, storage_mode="append"):
+class FileStorage(DatastoreAPI):
+    DURABILITY_POLICIES = ("cycle", "rows", "interval", "fsync")
+    ROTATION_PERIODS = {"hourly": "%Y%m%d%H", "daily": "%Y%m%d"}
+
+    def __init__(self, file_path, storage_mode="append", buffer_size=64 * 1024, durability="cycle", flush_rows=1000, flush_interval_sec=5.0,
+                 rotate_bytes=None, rotate_period=None, compression=None, max_segments=None):
+        '''
+        Args:
+            file_path (str): The csv file to write to.
+            storage_mode (str): 'append' keeps every reading, 'overwrite' only keeps the most recent cycle.
+            buffer_size (int): Size in bytes of the write buffer of the open file.
+            durability (str): When buffered rows are flushed to the OS.
+                'cycle' flushes after every write_usage/write_usage_batch call,
+                'rows' flushes once flush_rows rows have been written,
+                'interval' flushes once flush_interval_sec seconds have passed since the last flush, on the next
+                write or from a background task if no write comes,
+                'fsync' flushes and fsyncs after every write call so each cycle is on disk.
+            flush_rows (int): Row count for the 'rows' policy.
+            flush_interval_sec (float): Interval for the 'interval' policy.
+            rotate_bytes (int, optional): Start a new segment once the file reaches this size.
+            rotate_period (str, optional): Start a new segment every 'hourly' or 'daily' (UTC) period.
+            compression (str, optional): Compress closed segments with 'gzip' or 'zstd' (requires zstandard).
+            max_segments (int, optional): Number of closed segments to keep, older segments are deleted.
+
+        Closed segments are named <file>.<start timestamp>[-<n>].csv[.gz|.zst] and recorded with their time range
+        in <file>.manifest.json.
+        '''
+        if durability not in self.DURABILITY_POLICIES:
+            raise ValueError(f"durability must be one of {self.DURABILITY_POLICIES}")
+        if rotate_period is not None and rotate_period not in self.ROTATION_PERIODS:
+            raise ValueError(f"rotate_period must be one of {list(self.ROTATION_PERIODS)}")
+        check_compression(compression)
+        self.rotation_enabled = rotate_bytes is not None or rotate_period is not None
+        if self.rotation_enabled and storage_mode != "append":
+            raise ValueError("rotation is only supported in append mode")
         self.file_path = file_path
         self.storage_mode = storage_mode
+        self.buffer_size = buffer_size
+        self.durability = durability
+        self.flush_rows = flush_rows
+        self.flush_interval_sec = flush_interval_sec
+        self.rotate_bytes = rotate_bytes
+        self.rotate_period = rotate_period
+        self.compression = compression
+        self.max_segments = max_segments
+        self.manifest = SegmentManifest(self.file_path + ".manifest.json") if self.rotation_enabled else None
+
+        #the file is kept open between writes and all file io runs in a worker thread, serialized by the lock
+        self._file = None
+        self._writer = None
+        self._rows_since_flush = 0
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+        #flushes rows left waiting by the 'interval' policy, started by the first write
+        self._flush_task = None
 
         #create file if it doesn't exist & write headers
         file_exists = os.path.isfile(self.file_path)
         if not file_exists:
-            with open(self.file_path, 'w') as f:
-                writer = csv.writer(f)
-                writer.writerow(EnergyUsage.keys())
+            self._write_header()
+
+        #time range and row count of the active segment, only tracked when rotating
+        self._active_start = None
+        self._active_end = None
+        self._active_rows = 0
+        if self.rotation_enabled and file_exists:
+            self._load_active_range()
 
     async def write_usage(self, energy_usage: EnergyUsage) -> None:
-        mode = 'a' if self.storage_mode == 'append' else 'w'
-        with open(self.file_path, mode, newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(energy_usage.get_dict().values())
+        await self.write_usage_batch([energy_usage])
+
+    async def write_usage_batch(self, energy_usages: list) -> None:
+        rows = as_rows(energy_usages)
+        async with self._lock:
+            await asyncio.to_thread(self._write_rows, rows)
+        if self.durability == "interval" and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
 
     async def read_usage(self, last_n=10, columns="*"):
-        with open(self.file_path, 'r') as f:
-            #read last_n lines
-            lines = f.readlines()[-last_n:]
-            return lines 
+        '''
+        Read the last_n rows of the file, oldest first. Only the tail of the file is read so the cost doesn't
+        grow with the file size.
+
+        Returns:
+            list: EnergyUsage objects, columns not included in columns are left as None.
+        '''
+        #make sure rows still sitting in the write buffer are visible to the reader
+        async with self._lock:
+            if self._file is not None:
+                await asyncio.to_thread(self._file.flush)
+        keys = None if columns == "*" else list(columns)
+        lines = await asyncio.to_thread(self._read_last_lines, last_n)
+        header = EnergyUsage.keys()
+        return [EnergyUsage.from_csv_row(row, keys) for row in csv.reader(lines) if row and row != header]
+
+    async def iter_usage(self, start=None, end=None, devices=None, columns="*", chunk_rows=1000):
+        '''
+        Stream readings segment by segment, parsing chunk_rows rows at a time in a worker thread. Closed
+        segments outside the range are skipped using the manifest. Rows written after the iteration started
+        aren't returned.
+
+        Every file is opened before the first row is returned, so a rotation or retention while the caller is
+        still iterating can't delete or replace a file under it.
+        '''
+        async with self._lock:
+            if self._file is not None:
+                await asyncio.to_thread(self._file.flush)
+            files = await asyncio.to_thread(self._open_files, self.segments_for_range(start, end))
+            active_size = os.path.getsize(self.file_path)
+        chunks = self._read_chunks(files, active_size, start, end, devices, None if columns == "*" else list(columns), chunk_rows)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    return
+                for energy_usage in chunk:
+                    yield energy_usage
+        finally:
+            for _, f in files:
+                f.close()
+
+    async def update_carbon_batch(self, energy_usages: list) -> None:
+        '''
+        Rewrite the segments holding the readings in one pass per segment. Compressed segments are
+        recompressed and every segment is replaced atomically.
+        '''
+        if not energy_usages:
+            return
+        updates = {(energy_usage.device, energy_usage.timestamp): energy_usage for energy_usage in energy_usages}
+        start = min(energy_usage.timestamp for energy_usage in energy_usages)
+        end = max(energy_usage.timestamp for energy_usage in energy_usages)
+        async with self._lock:
+            #the writer is reopened on the next write
+            if self._file is not None:
+                await asyncio.to_thread(self._close_file)
+            for path in self.segments_for_range(start, end):
+                await asyncio.to_thread(self._rewrite_rows, path, updates)
 
     async def close(self):
-        pass
\ No newline at end of file
+        async with self._lock:
+            if self._flush_task is not None:
+                #cancelled under the lock so it can't be interrupted half way through a flush
+                self._flush_task.cancel()
+            if self._file is not None:
+                await asyncio.to_thread(self._close_file)
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+
+    async def _flush_periodically(self):
+        #without it rows written just before the writes stop would only be flushed on close
+        while True:
+            if self._rows_since_flush:
+                await asyncio.sleep(max(self._last_flush + self.flush_interval_sec - time.monotonic(), 0.0))
+            else:
+                await asyncio.sleep(self.flush_interval_sec)
+            async with self._lock:
+                if self._file is not None and self._rows_since_flush and time.monotonic() - self._last_flush >= self.flush_interval_sec:
+                    await asyncio.to_thread(self._flush)
+
+    def segments_for_range(self, start: datetime = None, end: datetime = None) -> list:
+        '''
+        Return the files which can hold rows between start and end, oldest first. Closed segments outside the
+        range are skipped using the manifest, the active file is always included.
+        '''
+        segments = self.manifest.segments_for_range(start, end) if self.manifest is not None else []
+        return segments + [self.file_path]
+
+    def _open_files(self, paths):
+        #(path, open file) of every path, the active file is opened in binary so it can be read up to a byte offset
+        files = []
+        try:
+            for path in paths:
+                files.append((path, open(path, 'rb') if path == self.file_path else open_segment(path)))
+        except BaseException:
+            for _, f in files:
+                f.close()
+            raise
+        return files
+
+    def _read_chunks(self, files, active_size, start, end, devices, keys, chunk_rows):
+        #generator of lists of up to chunk_rows parsed readings, the active file is only read up to active_size
+        header = EnergyUsage.keys()
+        devices = set(devices) if devices is not None else None
+        chunk = []
+        for path, f in files:
+            lines = _lines_up_to(f, active_size) if path == self.file_path else f
+            for row in csv.reader(lines):
+                if not row or row == header or (devices is not None and row[0] not in devices):
+                    continue
+                if start is not None or end is not None:
+                    timestamp = datetime.fromisoformat(row[1])
+                    if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                        continue
+                chunk.append(EnergyUsage.from_csv_row(row, keys))
+                if len(chunk) >= chunk_rows:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def _rewrite_rows(self, path, updates):
+        header = EnergyUsage.keys()
+        temp_path = path + ".tmp"
+        changed = False
+        with open_segment(path) as src, open(temp_path, 'w', newline='') as dst:
+            writer = csv.writer(dst)
+            for row in csv.reader(src):
+                if row and row != header:
+                    energy_usage = updates.get((row[0], datetime.fromisoformat(row[1])))
+                    if energy_usage is not None:
+                        row[3] = energy_usage.avg_emitted_mgco2e
+                        row[4] = energy_usage.grid_carbon_intensity_gco2perkwhr
+                        changed = True
+                writer.writerow(row)
+        if not changed:
+            os.remove(temp_path)
+            return
+        compression = next((name for name, suffix in COMPRESSION_SUFFIXES.items() if suffix and path.endswith(suffix)), None)
+        os.replace(compress_file(temp_path, compression), path)
+
+    def _write_header(self):
+        with open(self.file_path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(EnergyUsage.keys())
+
+    def _load_active_range(self):
+        #recover the time range and row count of an existing active file so it rotates correctly after a restart
+        header = EnergyUsage.keys()
+        with open(self.file_path, 'r', newline='') as f:
+            rows = (row for row in csv.reader(f) if row and row != header)
+            first = next(rows, None)
+            self._active_rows = (1 + sum(1 for _ in rows)) if first is not None else 0
+        last = [row for row in csv.reader(self._read_last_lines(1)) if row and row != header]
+        if first is not None and last:
+            self._active_start = datetime.fromisoformat(first[1])
+            self._active_end = datetime.fromisoformat(last[0][1])
+
+    def _needs_rotation(self, first_timestamp):
+        if self._active_start is None:
+            return False
+        if self.rotate_bytes is not None and os.path.getsize(self.file_path) >= self.rotate_bytes:
+            return True
+        if self.rotate_period is not None:
+            period_format = self.ROTATION_PERIODS[self.rotate_period]
+            return first_timestamp.strftime(period_format) != self._active_start.strftime(period_format)
+        return False
+
+    def _rotate(self):
+        if self._file is not None:
+            self._close_file()
+        segment_path = self._segment_path(self._active_start)
+        os.replace(self.file_path, segment_path)
+        segment_path = compress_file(segment_path, self.compression)
+        self.manifest.add(segment_path, self._active_start, self._active_end, self._active_rows)
+        for segment in self.manifest.remove_oldest(self.max_segments):
+            if os.path.exists(segment["path"]):
+                os.remove(segment["path"])
+
+        self._write_header()
+        self._active_start = None
+        self._active_end = None
+        self._active_rows = 0
+
+    def _segment_path(self, start):
+        #segments starting in the same second get a sequence suffix so an earlier segment is never replaced
+        base = f"{os.path.splitext(self.file_path)[0]}.{start.strftime('%Y%m%dT%H%M%S')}"
+        suffix = COMPRESSION_SUFFIXES[self.compression]
+        segment_path = f"{base}.csv"
+        sequence = 1
+        while os.path.exists(segment_path) or os.path.exists(segment_path + suffix):
+            segment_path = f"{base}-{sequence}.csv"
+            sequence += 1
+        return segment_path
+
+    def _read_last_lines(self, last_n, block_size=8192):
+        #seek backwards from the end of the file a block at a time until we have seen last_n complete lines
+        with open(self.file_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= last_n:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                data = f.read(read_size) + data
+        #a block boundary can split a multi-byte character, but only inside the first line which is dropped anyway
+        lines = data.decode(errors="replace").splitlines()
+        if position > 0:
+            #the first line is (most likely) partial
+            lines = lines[1:]
+        return lines[-last_n:] if last_n > 0 else []
+
+    def _open_file(self):
+        mode = 'a' if self.storage_mode == 'append' else 'w'
+        self._file = open(self.file_path, mode, newline='', buffering=self.buffer_size)
+        self._writer = csv.writer(self._file)
+
+    def _write_rows(self, rows):
+        if self.rotation_enabled and rows:
+            if self._file is not None:
+                self._file.flush()
+            if self._needs_rotation(rows[0][1]):
+                self._rotate()
+            if self._active_start is None:
+                self._active_start = rows[0][1]
+            self._active_end = rows[-1][1]
+            self._active_rows += len(rows)
+
+        if self._file is None:
+            self._open_file()
+        elif self.storage_mode == 'overwrite':
+            #overwrite mode keeps the most recent cycle so truncate once per batch rather than once per row
+            self._file.seek(0)
+            self._file.truncate()
+
+        self._writer.writerows(rows)
+        self._rows_since_flush += len(rows)
+
+        if self.durability == "fsync":
+            self._flush(fsync=True)
+        elif (self.durability == "cycle"
+              or (self.durability == "rows" and self._rows_since_flush >= self.flush_rows)
+              or (self.durability == "interval" and time.monotonic() - self._last_flush >= self.flush_interval_sec)):
+            self._flush()
+
+    def _flush(self, fsync=False):
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self._rows_since_flush = 0
+        self._last_flush = time.monotonic()
+
+    def _close_file(self):
+        self._flush(fsync=self.durability == "fsync")
+        self._file.close()
+        self._file = None
+        self._writer = None
+
+def _lines_up_to(f, size):
+    #decoded lines of a binary file up to byte offset size, so a row being appended concurrently isn't read half written
+    position = 0
+    for line in f:
+        position += len(line)
+        if position > size:
+            return
+        yield line.decode()
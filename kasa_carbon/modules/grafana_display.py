@@ -0,0 +1,100 @@
+import json
+import time
+from aiohttp import web
+from kasa_carbon.modules.recent_readings import RecentReadings
+from kasa_carbon.modules.metrics import InMemoryMetrics, escape_label
+
+class GrafanaDisplay:
+    '''
+    Small HTTP server inside the monitor process serving the latest reading of every device from memory, so
+    live dashboards don't query the datastore:
+
+        GET /readings    JSON list of the latest reading per device. Responses carry an ETag which changes with
+                         every published cycle, a request with a matching If-None-Match gets 304 Not Modified.
+        GET /metrics     Prometheus text exposition of the same values as gauges, followed by the pipeline
+                         metrics if an InMemoryMetrics is given.
+
+    The readings are rendered once per published cycle and reused for every request until the next cycle.
+    '''
+    CONTENT_TYPE_PROMETHEUS = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, recent_readings: RecentReadings, host="127.0.0.1", port=8080, metrics: InMemoryMetrics = None):
+        '''
+        Args:
+            recent_readings (RecentReadings): The buffer the monitor publishes to.
+            host (str): Address to listen on.
+            port (int): Port to listen on, 0 picks a free port (see port after start()).
+            metrics (InMemoryMetrics, optional): The monitor's pipeline metrics, also served on /metrics.
+        '''
+        self.recent_readings = recent_readings
+        self.host = host
+        self.port = port
+        self.metrics = metrics
+        self._runner = None
+        #(kind, version) -> rendered body, for the current version only
+        self._rendered = {}
+        #versions restart with the process, the start time keeps ETags from before a restart from matching
+        self._etag_prefix = str(int(time.time()))
+
+        self.app = web.Application()
+        self.app.router.add_get("/readings", self._readings)
+        self.app.router.add_get("/metrics", self._metrics)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _readings(self, request):
+        version = self.recent_readings.version
+        etag = f'"{self._etag_prefix}-{version}"'
+        if_none_match = [tag.strip().removeprefix("W/") for tag in request.headers.get("If-None-Match", "").split(",")]
+        if etag in if_none_match or "*" in if_none_match:
+            return web.Response(status=304, headers={"ETag": etag})
+        body = self._render("json", version, self._readings_json)
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    async def _metrics(self, request):
+        body = self._render("prometheus", self.recent_readings.version, self._metrics_text)
+        if self.metrics is not None:
+            #the pipeline metrics change after the cycle is published (e.g. the write latency), so aren't cached
+            body += self.metrics.prometheus_text().encode()
+        return web.Response(body=body, headers={"Content-Type": self.CONTENT_TYPE_PROMETHEUS})
+
+    def _render(self, kind, version, render):
+        key = (kind, version)
+        body = self._rendered.get(key)
+        if body is None:
+            self._rendered = {cached: value for cached, value in self._rendered.items() if cached[1] == version}
+            body = self._rendered[key] = render().encode()
+        return body
+
+    def _readings_json(self):
+        readings = []
+        for energy_usage in self.recent_readings.latest().values():
+            reading = energy_usage.get_dict()
+            reading["timestamp"] = energy_usage.timestamp.isoformat()
+            readings.append(reading)
+        return json.dumps(readings)
+
+    def _metrics_text(self):
+        gauges = (("kasa_carbon_power_draw_watts", "Latest power draw of the device in watts", "power_draw_watts"),
+                  ("kasa_carbon_emitted_mgco2e", "Emissions of the device over its latest sample interval in mgCO2e", "avg_emitted_mgco2e"),
+                  ("kasa_carbon_grid_carbon_intensity_gco2perkwhr", "Grid carbon intensity of the device's latest reading in gCO2e/kWh", "grid_carbon_intensity_gco2perkwhr"))
+        latest = self.recent_readings.latest()
+        lines = []
+        for name, help_text, key in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for device, energy_usage in latest.items():
+                value = getattr(energy_usage, key)
+                if value is not None:
+                    lines.append(f'{name}{{device="{escape_label(device)}"}} {value}')
+        return "\n".join(lines) + "\n"
@@ -1,15 +1,55 @@
 from kasa import Discover, SmartPlug, SmartStrip
 from kasa_carbon.modules.database import Database
 from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.interfaces.carbon_api import CarbonAPI
+from kasa_carbon.interfaces.metrics_sink import MetricsSink
 from kasa_carbon.modules.electricitymaps_api import ElectricityMapAPI
-from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import ReadingBatch
+from kasa_carbon.modules.emissions import trapezoidal_mgco2e
+from kasa_carbon.modules.tick_scheduler import TickScheduler
+from kasa_carbon.modules.device_registry import DeviceRegistry
+from kasa_carbon.modules.recent_readings import RecentReadings
+from kasa_carbon.modules.metrics import NullMetrics
+from kasa_carbon.modules.sampling_profiler import SamplingProfiler
 import asyncio
+import logging
 import time, os
 from datetime import datetime, timezone
+import numpy as np
+
+_LOGGER = logging.getLogger(__name__)
 
 class KasaMonitor:
-    def __init__(self, api_key, local_lat=None, local_lon=None, local_grid_id=None, co2_api_provider="ElectricityMaps", em_cache_expiry_mins=30):
-        self.devices = []
+    #what to do when the grid carbon intensity isn't available: store readings without emissions ('null', they can be
+    #backfilled later) or use the last intensity which was available ('last')
+    MISSING_INTENSITY_POLICIES = ("null", "last")
+
+    def __init__(self, api_key, local_lat=None, local_lon=None, local_grid_id=None, co2_api_provider="ElectricityMaps", em_cache_expiry_mins=30,
+                 max_concurrent_polls=32, device_timeout_sec=5.0, missing_intensity="null", registry_path=None, rediscovery_interval_sec=300,
+                 co2_api: CarbonAPI = None, discovery_target="255.255.255.255", device_prefix="", recent_readings: RecentReadings = None,
+                 metrics: MetricsSink = None, profile_cycles=None, profile_path="kasa_carbon_profile.folded"):
+        if missing_intensity not in self.MISSING_INTENSITY_POLICIES:
+            raise ValueError(f"missing_intensity must be one of {self.MISSING_INTENSITY_POLICIES}")
+        self.devices = {}
+        #known devices persisted between runs so startup can skip broadcast discovery
+        self.registry = DeviceRegistry(registry_path) if registry_path is not None else None
+        if self.registry is not None:
+            self.registry.load()
+        self.rediscovery_interval_sec = rediscovery_interval_sec
+        self._devices_started = False
+        self._rediscovery_task = None
+        self.max_concurrent_polls = max_concurrent_polls
+        self.device_timeout_sec = device_timeout_sec
+        #most recent poll latency in seconds keyed by device address, and the addresses which failed the last poll
+        self.poll_latencies = {}
+        self.failed_devices = set()
+        #number of scheduler ticks skipped because a cycle took longer than the update interval
+        self.overrun_ticks = 0
+        self.missing_intensity = missing_intensity
+        self._last_co2 = None
+        #monotonic time each device (or strip plug) was last sampled, and its (time, power) at the previous emissions computation
+        self.sample_times = {}
+        self._previous_samples = {}
         self.lat = local_lat 
         self.lon = local_lon 
         self.grid_id = None
@@ -19,47 +59,206 @@ class KasaMonitor:
             self.grid_id = local_grid_id
         #else should be just use local_lat/local_lon
 
-        if co2_api_provider == "ElectricityMaps":
+        #every cycle is published here for local consumers (status output, the display server) before it's written
+        self.recent_readings = recent_readings if recent_readings is not None else RecentReadings()
+        self.discovery_target = discovery_target
+        #prepended to every device name, e.g. to tell sites apart when several monitors share a datastore
+        self.device_prefix = device_prefix
+        #stage and per device timings of the pipeline, see monitor_energy_use_continuously for the metric names
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        #opt-in: sample the event loop's stacks for the first profile_cycles cycles and write them to profile_path
+        self.profile_cycles = profile_cycles
+        self.profile_path = profile_path
+
+        #a carbon client passed in is shared with other monitors and closed by its owner, not by this monitor
+        self._owns_co2_api = co2_api is None
+        if co2_api is not None:
+            self.co2_api = co2_api
+        elif co2_api_provider == "ElectricityMaps":
             self.co2_api = ElectricityMapAPI(em_api_key=api_key, em_cache_expiry_mins=em_cache_expiry_mins)
         else:
             raise ValueError("co2_api_provider must be 'EM' until others are supported")        
 
     async def discover_devices(self):
         # Discover Kasa devices on the network
-        self.devices = await Discover.discover()
+        self.devices = await Discover.discover(target=self.discovery_target)
+        self._devices_started = True
+        if self.registry is not None:
+            for host, device in self.devices.items():
+                self.registry.update(host, device)
+            await asyncio.to_thread(self.registry.save)
+
+    async def connect_known_devices(self, records: list = None):
+        '''
+        Connect to every host in the registry in parallel, without a broadcast discovery. Connected devices are
+        added to the polled devices, hosts which don't answer within device_timeout_sec are recorded in
+        failed_devices and left to the background rediscovery (or a later call).
+
+        Args:
+            records (list, optional): Registry records to connect to instead of the whole registry.
+
+        Returns:
+            int: The number of devices connected.
+        '''
+        async def connect(record):
+            host = record["host"]
+            try:
+                return host, await asyncio.wait_for(Discover.connect_single(host, port=record.get("port"), timeout=self.device_timeout_sec),
+                                                    timeout=self.device_timeout_sec)
+            except Exception as e:
+                _LOGGER.warning("Failed to connect to known device at %s: %r", host, e)
+                self.failed_devices.add(host)
+                return host, None
+
+        if records is None:
+            records = list(self.registry.devices.values())
+        results = await asyncio.gather(*[connect(record) for record in records])
+        for host, device in results:
+            if device is not None:
+                self.devices[host] = device
+                self.failed_devices.discard(host)
+        self._devices_started = True
+        return len(self.devices)
+
+    async def start_devices(self):
+        '''
+        Find the devices to poll: connect straight to the registry's hosts if there are any, otherwise (first run
+        or no registry) fall back to a broadcast discovery.
+        '''
+        if self.registry is not None and self.registry.devices:
+            await self.connect_known_devices()
+        else:
+            await self.discover_devices()
+
+    async def rediscover_devices(self):
+        '''
+        Reconcile the polled devices with a broadcast discovery: newly found hosts are added, known hosts have their
+        registry record refreshed and hosts which neither answer polls nor the discovery are dropped. Devices
+        which keep answering polls are kept even if the broadcast missed them.
+        '''
+        discovered = await Discover.discover(target=self.discovery_target)
+        for host, device in discovered.items():
+            if host not in self.devices:
+                _LOGGER.info("Discovered new device %s at %s", device.alias, host)
+                self.devices[host] = device
+                self.failed_devices.discard(host)
+            if self.registry is not None:
+                self.registry.update(host, device)
+
+        known = set(self.devices) | (set(self.registry.devices) if self.registry is not None else set())
+        for host in known - set(discovered):
+            if host in self.failed_devices or host not in self.devices:
+                _LOGGER.info("Dropping device at %s which no longer responds", host)
+                self.devices.pop(host, None)
+                self.failed_devices.discard(host)
+                self.poll_latencies.pop(host, None)
+                if self.registry is not None:
+                    self.registry.remove(host)
+        if self.registry is not None:
+            await asyncio.to_thread(self.registry.save)
+
+    def start_rediscovery(self):
+        '''Start the background rediscovery task (every rediscovery_interval_sec) if it isn't running.'''
+        if self.rediscovery_interval_sec is not None and (self._rediscovery_task is None or self._rediscovery_task.done()):
+            self._rediscovery_task = asyncio.create_task(self._rediscover_periodically())
+
+    async def _rediscover_periodically(self):
+        while True:
+            #with nothing to poll look straight away rather than after a full interval
+            if self.devices:
+                await asyncio.sleep(self.rediscovery_interval_sec)
+            try:
+                await self.rediscover_devices()
+            except Exception as e:
+                _LOGGER.warning("Device rediscovery failed: %r", e)
+            if not self.devices:
+                await asyncio.sleep(self.rediscovery_interval_sec)
 
     async def monitor_energy_use_once(self):
+        '''
+        Poll every discovered device concurrently and return the current power draw per device.
+
+        At most max_concurrent_polls devices are polled at once and each poll is bounded by device_timeout_sec.
+        Devices which time out or fail are left out of the result (and recorded in failed_devices) so a single
+        unreachable strip can't stall the rest of the cycle.
+
+        Returns:
+            dict: The power draw in watts keyed by device (or device-plug for strips) alias.
+        '''
         energy_values = {}
 
-        #assert discover_devices has been called
-        if len(self.devices) == 0:
-            await self.discover_devices()
+        #find devices once, an empty network is left to the background rediscovery rather than rediscovered every tick
+        if len(self.devices) == 0 and not self._devices_started:
+            await self.start_devices()
 
-        for addr, device in self.devices.items():
-            await device.update()
-            if isinstance(device, SmartStrip):
-                for i, plug in enumerate(device.children):
-                    if plug.has_emeter:
-                        emeter_realtime = plug.emeter_realtime
-                        energy_values[f"{device.alias + '-' + plug.alias}"] = emeter_realtime["power"]
-            elif device.has_emeter:
-                emeter_realtime = device.emeter_realtime
-                energy_values[device.alias] = emeter_realtime["power"]
+        semaphore = asyncio.Semaphore(self.max_concurrent_polls)
+        results = await asyncio.gather(*[self._poll_device(addr, device, semaphore) for addr, device in self.devices.items()])
+        for device_values in results:
+            energy_values.update(device_values)
 
         return energy_values
 
+    async def _poll_device(self, addr, device, semaphore):
+        energy_values = {}
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(device.update(), timeout=self.device_timeout_sec)
+            except Exception as e:
+                #TimeoutError or any connection/protocol error, skip this device for this cycle
+                _LOGGER.warning("Failed to poll device at %s: %r", addr, e)
+                self.failed_devices.add(addr)
+                self.metrics.increment("device_poll_failures_total", labels={"device": addr})
+                return energy_values
+            finally:
+                self.poll_latencies[addr] = time.perf_counter() - start
+                self.metrics.observe("device_poll_seconds", self.poll_latencies[addr], {"device": addr})
+
+        sampled_at = time.monotonic()
+        self.failed_devices.discard(addr)
+        if isinstance(device, SmartStrip):
+            for i, plug in enumerate(device.children):
+                if plug.has_emeter:
+                    emeter_realtime = plug.emeter_realtime
+                    energy_values[f"{self.device_prefix}{device.alias + '-' + plug.alias}"] = emeter_realtime["power"]
+        elif device.has_emeter:
+            emeter_realtime = device.emeter_realtime
+            energy_values[self.device_prefix + device.alias] = emeter_realtime["power"]
+        for name in energy_values:
+            self.sample_times[name] = sampled_at
+        return energy_values
+
+    async def close(self):
+        if self._rediscovery_task is not None:
+            self._rediscovery_task.cancel()
+            self._rediscovery_task = None
+        if self._owns_co2_api:
+            await self.co2_api.close()
+
     #get carbon data by either grid or lat/lon
     async def _get_co2_data(self):
-        if self.grid_id is not None:
-            return await self.co2_api.get_co2_by_gridid(self.grid_id)
-        else:
-            return await self.co2_api.get_co2_by_latlon(self.lat, self.lon) 
+        #an api outage (with no cached value to fall back on) leaves the intensity to the missing_intensity policy
+        try:
+            if self.grid_id is not None:
+                return await self.co2_api.get_co2_by_gridid(self.grid_id)
+            else:
+                return await self.co2_api.get_co2_by_latlon(self.lat, self.lon)
+        except Exception as e:
+            _LOGGER.warning("Carbon intensity is unavailable, applying the '%s' missing_intensity policy: %r", self.missing_intensity, e)
+            return None
 
 
-    async def monitor_energy_use_continuously(self, db: DatastoreAPI, delay: int, timeout: int=None):
+    async def monitor_energy_use_continuously(self, db: DatastoreAPI, delay: int, timeout: int=None, close_db=True):
         '''
         Monitor energy use continuously and store the data in the database.
 
+        Samples are taken on a fixed tick grid of delay seconds and the emissions for each sample are computed
+        from the measured time since the previous sample rather than the nominal delay.
+
+        Every stage is timed into self.metrics: the histograms cycle_seconds, poll_seconds, device_poll_seconds
+        (labelled by device address), carbon_lookup_seconds, emissions_seconds, write_seconds and batch_size, the
+        counters overrun_ticks_total and device_poll_failures_total and the gauge carbon_cache_hit_ratio.
+
         DB Schema:
         device VARCHAR(255) NOT NULL,
         timestamp TIMESTAMPTZ NOT NULL,
@@ -70,35 +269,114 @@ class KasaMonitor:
 
         Args:
             db (Database): The database to store the energy use data in.
-            delay (int): The number of seconds to wait between each update.
+            delay (int): The number of seconds between each update.
             timeout (int, optional): The number of seconds to run the monitor for. Defaults to None, which will run forever.
+            close_db (bool): Close db when the monitor stops, turn off when db is shared with other monitors.
         
         Returns:
             None
         '''
         start_time = time.time()
+        profiler = None
+        cycles = 0
 
         try:
+            #warm the carbon intensity cache so the first tick doesn't wait on the api (later lookups are refreshed in the background)
+            await self._get_co2_data()
+            scheduler = TickScheduler(delay)
+            scheduler.start()
+            if self.profile_cycles:
+                profiler = SamplingProfiler()
+                profiler.start()
+
             while True:
+                cycle_start = time.perf_counter()
                 energy_values = await self.monitor_energy_use_once()
+                poll_end = time.perf_counter()
+                self.metrics.observe("poll_seconds", poll_end - cycle_start)
+                #after the first cycle so startup discovery and the background rediscovery don't overlap
+                self.start_rediscovery()
 
                 #Get average CO2 from API
                 co2 = await self._get_co2_data()
-                for device, power in energy_values.items():
-                    #convert gird co2 to device actual co2 by taking the timespan (assuming constant power draw over that period) and 
-                    #multiplying by the grid co2 while also converting to mgCO2e
-                    power_kwatts = power / 1000.0 #convert to kW from watts
-                    hours = delay / 3600.0 #time in use in hours
-                    co2emitted = hours * power_kwatts * co2 / 1000.0 #convert to mgCO2e 
-                    energy_usage = {"device": device, "timestamp": datetime.now(timezone.utc), 
-                                    "power_draw_watts": power, "avg_emitted_mgco2e": co2emitted,
-                                    "grid_carbon_intensity_gco2perkwhr": co2}
-
-                    await db.write_usage(EnergyUsage(energy_usage_dict=energy_usage))
+                self.metrics.observe("carbon_lookup_seconds", time.perf_counter() - poll_end)
+                cache_stats = self.co2_api.cache_stats()
+                if cache_stats is not None and cache_stats["hit_ratio"] is not None:
+                    self.metrics.set_gauge("carbon_cache_hit_ratio", cache_stats["hit_ratio"])
+                await self.write_cycle(db, energy_values, co2, delay)
+                self.metrics.observe("cycle_seconds", time.perf_counter() - cycle_start)
+
+                cycles += 1
+                if profiler is not None and cycles >= self.profile_cycles:
+                    self._dump_profile(profiler)
+                    profiler = None
 
                 if timeout is not None and time.time() - start_time >= timeout:
                     break
 
-                time.sleep(delay)
+                await scheduler.wait_next()
+                if scheduler.overrun_ticks > self.overrun_ticks:
+                    self.metrics.increment("overrun_ticks_total", scheduler.overrun_ticks - self.overrun_ticks)
+                self.overrun_ticks = scheduler.overrun_ticks
         finally:
-            await db.close()
\ No newline at end of file
+            if profiler is not None:
+                #stopped before profile_cycles, keep what was sampled
+                self._dump_profile(profiler)
+            if close_db:
+                await db.close()
+            await self.close()
+
+    async def write_cycle(self, db: DatastoreAPI, energy_values: dict, co2, delay):
+        '''
+        Compute the cycle's emissions, publish the readings to recent_readings and write them to db as one batch
+        so stores can write the whole cycle in a single round trip.
+        '''
+        start = time.perf_counter()
+        batch = self.emissions_batch(energy_values, co2, delay)
+        self.recent_readings.publish(batch)
+        emissions_end = time.perf_counter()
+        self.metrics.observe("emissions_seconds", emissions_end - start)
+        self.metrics.observe("batch_size", len(batch))
+        await db.write_usage_batch(batch)
+        self.metrics.observe("write_seconds", time.perf_counter() - emissions_end)
+
+    def _dump_profile(self, profiler):
+        profiler.stop()
+        profiler.dump(self.profile_path)
+        _LOGGER.info("Wrote a profile of %d samples to %s", profiler.samples, self.profile_path)
+
+    def emissions_batch(self, energy_values: dict, co2, delay) -> ReadingBatch:
+        '''
+        Compute the emissions of one cycle for all devices at once. Each device's power is integrated with the
+        trapezoidal rule over the time actually elapsed since that device's previous sample, so devices which
+        missed a cycle or were polled late are accounted for correctly. A device's first sample has nothing to
+        integrate from and is counted as constant power over the nominal delay.
+
+        Args:
+            energy_values (dict): Power draw in watts keyed by device, from monitor_energy_use_once.
+            co2 (float): Grid carbon intensity, None if it isn't available (see MISSING_INTENSITY_POLICIES).
+            delay (float): The nominal sample interval in seconds.
+
+        Returns:
+            ReadingBatch: The cycle's readings.
+        '''
+        if co2 is not None:
+            self._last_co2 = co2
+        elif self.missing_intensity == "last":
+            co2 = self._last_co2
+
+        devices = list(energy_values)
+        power = np.fromiter(energy_values.values(), dtype=np.float64, count=len(devices))
+        now = time.monotonic()
+        sample_times = np.array([self.sample_times.get(device, now) for device in devices], dtype=np.float64)
+        previous = np.array([self._previous_samples.get(device, (np.nan, np.nan)) for device in devices], dtype=np.float64).reshape(-1, 2)
+        first = np.isnan(previous[:, 0])
+        intervals = np.where(first, delay, sample_times - previous[:, 0])
+        previous_power = np.where(first, power, previous[:, 1])
+        intensity = np.nan if co2 is None else co2
+        #null propagation, a NaN intensity gives NaN emissions which are stored as NULL
+        emitted = trapezoidal_mgco2e(power, previous_power, intervals, intensity)
+
+        for device, sample_time, device_power in zip(devices, sample_times.tolist(), power.tolist()):
+            self._previous_samples[device] = (sample_time, device_power)
+        return ReadingBatch(devices, datetime.now(timezone.utc), power, emitted, np.full(len(devices), intensity))
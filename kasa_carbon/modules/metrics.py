@@ -0,0 +1,135 @@
+from bisect import bisect_left
+from kasa_carbon.interfaces.metrics_sink import MetricsSink
+
+#upper bounds of the histogram buckets, in seconds for latencies and in rows for sizes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class NullMetrics(MetricsSink):
+    '''Discards everything, the default sink so uninstrumented runs pay next to nothing.'''
+    def observe(self, name, value, labels=None):
+        pass
+
+    def increment(self, name, amount=1, labels=None):
+        pass
+
+    def set_gauge(self, name, value, labels=None):
+        pass
+
+class Histogram:
+    '''
+    Fixed bucket histogram: counts of observations <= each bound (plus one overflow bucket), their sum and count.
+    Memory is constant however many values are observed.
+    '''
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q) -> float:
+        '''
+        Estimate the q quantile (0 <= q <= 1) by linear interpolation within its bucket, the way Prometheus'
+        histogram_quantile does. Values in the overflow bucket are reported as the largest bound.
+
+        Returns:
+            float: The estimate, None if nothing was observed.
+        '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.bounds):
+                    return float(self.bounds[-1])
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return float(self.bounds[-1])
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else None
+
+class InMemoryMetrics(MetricsSink):
+    '''
+    Keeps every metric in process: histograms, counters and gauges keyed by (name, labels). Histograms use
+    LATENCY_BUCKETS unless their name is listed in buckets. prometheus_text() renders the lot in the Prometheus
+    text exposition format, e.g. for the display server's /metrics.
+    '''
+    def __init__(self, buckets: dict = None):
+        '''
+        Args:
+            buckets (dict, optional): Bucket bounds by metric name for histograms which aren't latencies.
+        '''
+        self.buckets = {"batch_size": SIZE_BUCKETS}
+        self.buckets.update(buckets or {})
+        #(name, labels tuple) -> Histogram / float
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, value, labels=None):
+        key = (name, _label_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+        histogram.observe(value)
+
+    def increment(self, name, amount=1, labels=None):
+        key = (name, _label_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, labels=None):
+        self.gauges[(name, _label_key(labels))] = value
+
+    def histogram(self, name, labels=None) -> Histogram:
+        '''The histogram of name and labels, None if nothing was observed.'''
+        return self.histograms.get((name, _label_key(labels)))
+
+    def counter(self, name, labels=None) -> float:
+        return self.counters.get((name, _label_key(labels)), 0)
+
+    def gauge(self, name, labels=None) -> float:
+        return self.gauges.get((name, _label_key(labels)))
+
+    def prometheus_text(self, prefix="kasa_carbon_") -> str:
+        lines = []
+        for name, kind, values in _by_name(self.counters, "counter") + _by_name(self.gauges, "gauge"):
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+            for labels, value in values:
+                lines.append(f"{prefix}{name}{_format_labels(labels)} {value}")
+        for name, _, values in _by_name(self.histograms, "histogram"):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for labels, histogram in values:
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{prefix}{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+def escape_label(value) -> str:
+    '''Escape a Prometheus label value.'''
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+def _by_name(metrics, kind):
+    #[(name, kind, [(labels, value)])] so each metric gets a single TYPE line
+    grouped = {}
+    for (name, labels), value in metrics.items():
+        grouped.setdefault(name, []).append((labels, value))
+    return [(name, kind, values) for name, values in grouped.items()]
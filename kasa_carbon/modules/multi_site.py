@@ -0,0 +1,97 @@
+import asyncio
+import json
+from kasa_carbon.interfaces.carbon_api import CarbonAPI
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.modules.electricitymaps_api import ElectricityMapAPI
+from kasa_carbon.modules.kasa_monitor import KasaMonitor
+from kasa_carbon.modules.recent_readings import RecentReadings
+
+#KasaMonitor arguments which can be set per site
+SITE_OPTIONS = ("local_lat", "local_lon", "local_grid_id", "registry_path", "discovery_target", "device_prefix",
+                "max_concurrent_polls", "device_timeout_sec", "missing_intensity", "rediscovery_interval_sec")
+
+def load_sites_config(path) -> list:
+    '''
+    Read a multi-site config file:
+
+        {"sites": [{"name": "hq", "local_grid_id": "US-NW-SCL", "discovery_target": "10.1.255.255",
+                    "registry_path": "hq_devices.json", "device_prefix": "hq/"}, ...]}
+
+    Every site needs a name and either local_grid_id or local_lat/local_lon, the other SITE_OPTIONS are optional.
+    With more than one site every site needs its own discovery_target, see check_discovery_targets.
+
+    Returns:
+        list: One dict per site.
+    '''
+    with open(path, 'r') as f:
+        sites = json.load(f)["sites"]
+    names = set()
+    for site in sites:
+        if "name" not in site:
+            raise ValueError("Every site needs a name")
+        if site["name"] in names:
+            raise ValueError(f"Duplicate site name {site['name']}")
+        names.add(site["name"])
+        unknown = set(site) - set(SITE_OPTIONS) - {"name"}
+        if unknown:
+            raise ValueError(f"Unknown options {sorted(unknown)} for site {site['name']}")
+    check_discovery_targets(sites)
+    return sites
+
+def check_discovery_targets(sites: list):
+    '''
+    Sites which discover on the same target (e.g. all on the default 255.255.255.255) find each other's devices and
+    count them twice, so with more than one site every site has to set its own discovery_target. A registry alone
+    isn't enough, the site still discovers on its target when the registry is empty and when rediscovering.
+    '''
+    if len(sites) < 2:
+        return
+    targets = {}
+    for site in sites:
+        target = site.get("discovery_target")
+        if target is None:
+            raise ValueError(f"Site {site['name']} needs a discovery_target when monitoring more than one site")
+        if target in targets:
+            raise ValueError(f"Sites {targets[target]} and {site['name']} have the same discovery_target {target}")
+        targets[target] = site["name"]
+
+class MultiSiteMonitor:
+    '''
+    Run one KasaMonitor per site (a group of devices in one grid zone) in a single process. All sites share one
+    carbon intensity client, so its cache, session and in-flight request coalescing are shared and sites in the
+    same zone cause a single lookup, and they all write to one datastore.
+    '''
+    def __init__(self, sites: list, api_key=None, em_cache_expiry_mins=30, co2_api: CarbonAPI = None, **monitor_kwargs):
+        '''
+        Args:
+            sites (list): Site dicts, see load_sites_config.
+            api_key (str): Electricity Maps API key, used when co2_api isn't given.
+            em_cache_expiry_mins (int): Carbon intensity cache expiry, used when co2_api isn't given.
+            co2_api (CarbonAPI, optional): The shared carbon client, owned (and closed) by this monitor either way.
+            monitor_kwargs: KasaMonitor defaults for options which a site doesn't set.
+        '''
+        check_discovery_targets(sites)
+        self.co2_api = co2_api if co2_api is not None else ElectricityMapAPI(em_api_key=api_key, em_cache_expiry_mins=em_cache_expiry_mins)
+        #every site publishes into the same buffer of recent readings
+        self.recent_readings = RecentReadings()
+        self.monitors = {}
+        for site in sites:
+            options = {**monitor_kwargs, **{key: value for key, value in site.items() if key != "name"}}
+            self.monitors[site["name"]] = KasaMonitor(api_key=api_key, co2_api=self.co2_api, recent_readings=self.recent_readings, **options)
+
+    async def run(self, db: DatastoreAPI, delay, timeout=None):
+        '''
+        Monitor every site concurrently, writing to db, until timeout seconds have passed (forever if None).
+        db and the carbon client are closed once every site has stopped.
+        '''
+        tasks = [asyncio.create_task(monitor.monitor_energy_use_continuously(db, delay, timeout=timeout, close_db=False))
+                 for monitor in self.monitors.values()]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            #if one site fails stop the others before the shared clients are closed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await db.close()
+            await self.co2_api.close()
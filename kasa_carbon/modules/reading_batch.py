@@ -0,0 +1,81 @@
+import numpy as np
+from kasa_carbon.modules.energy_usage import EnergyUsage
+
+class ReadingBatch:
+    '''
+    One cycle of readings held as parallel columns rather than one EnergyUsage object per reading. The numeric
+    columns are float64 numpy arrays with NaN for missing values, device and timestamp are lists (readings of
+    the same cycle usually share one timestamp object).
+
+    Every DatastoreAPI.write_usage_batch accepts a ReadingBatch as well as a list of EnergyUsage. Indexing or
+    iterating a batch yields EnergyUsage objects so code written for lists keeps working.
+    '''
+    __slots__ = ("devices", "timestamps", "power_draw_watts", "avg_emitted_mgco2e", "grid_carbon_intensity_gco2perkwhr")
+
+    def __init__(self, devices, timestamps, power_draw_watts, avg_emitted_mgco2e=None, grid_carbon_intensity_gco2perkwhr=None):
+        '''
+        Args:
+            devices (list): Device name of each reading.
+            timestamps: A list with the timestamp of each reading, or a single timestamp shared by all of them.
+            power_draw_watts: Power draw of each reading.
+            avg_emitted_mgco2e (optional): Emissions of each reading, missing if None.
+            grid_carbon_intensity_gco2perkwhr (optional): Grid intensity of each reading, missing if None.
+        '''
+        self.devices = list(devices)
+        rows = len(self.devices)
+        self.timestamps = list(timestamps) if isinstance(timestamps, (list, tuple)) else [timestamps] * rows
+        self.power_draw_watts = _column(power_draw_watts, rows)
+        self.avg_emitted_mgco2e = _column(avg_emitted_mgco2e, rows)
+        self.grid_carbon_intensity_gco2perkwhr = _column(grid_carbon_intensity_gco2perkwhr, rows)
+
+    @staticmethod
+    def from_energy_usages(energy_usages) -> "ReadingBatch":
+        if isinstance(energy_usages, ReadingBatch):
+            return energy_usages
+        columns = list(zip(*(energy_usage.as_tuple() for energy_usage in energy_usages))) or [()] * len(EnergyUsage.KEYS)
+        return ReadingBatch(*columns)
+
+    def rows(self) -> list:
+        '''
+        Returns:
+            list: One tuple per reading in EnergyUsage.KEYS order with None for missing values, as taken by
+            asyncpg's copy_records_to_table and csv.writer.
+        '''
+        return list(zip(self.devices, self.timestamps, _values(self.power_draw_watts), _values(self.avg_emitted_mgco2e),
+                        _values(self.grid_carbon_intensity_gco2perkwhr)))
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, row) -> EnergyUsage:
+        return EnergyUsage(energy_usage_dict=dict(zip(EnergyUsage.KEYS, (
+            self.devices[row], self.timestamps[row], _value(self.power_draw_watts[row]),
+            _value(self.avg_emitted_mgco2e[row]), _value(self.grid_carbon_intensity_gco2perkwhr[row])))))
+
+    def __iter__(self):
+        for row in self.rows():
+            yield EnergyUsage(energy_usage_dict=dict(zip(EnergyUsage.KEYS, row)))
+
+    def __repr__(self):
+        return f"ReadingBatch({len(self)} readings)"
+
+def as_rows(energy_usages) -> list:
+    '''Rows (tuples in EnergyUsage.KEYS order) of a ReadingBatch or a list of EnergyUsage.'''
+    if isinstance(energy_usages, ReadingBatch):
+        return energy_usages.rows()
+    return [energy_usage.as_tuple() for energy_usage in energy_usages]
+
+def _column(values, rows):
+    if values is None:
+        return np.full(rows, np.nan)
+    if isinstance(values, np.ndarray):
+        return values.astype(np.float64, copy=False)
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+def _values(column):
+    #tolist converts to python floats in one call, NaN becomes None
+    return [None if value != value else value for value in column.tolist()]
+
+def _value(value):
+    value = float(value)
+    return None if value != value else value
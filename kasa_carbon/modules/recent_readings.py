@@ -0,0 +1,74 @@
+import numpy as np
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import as_rows
+
+class RecentReadings:
+    '''
+    Bounded in-memory buffer of the most recent readings, published by the monitor every cycle so status output
+    and other local consumers don't have to query the datastore.
+
+    Each device keeps a ring of its last window readings (power, emissions and intensity in a fixed numpy array)
+    and its latest reading, so latest() is O(1) per device and stats() only looks at the requested samples.
+    '''
+    def __init__(self, window=60):
+        self.window = window
+        #device -> latest row (tuple in EnergyUsage.KEYS order)
+        self._latest = {}
+        #device -> [values array (window, 3), next position, count]
+        self._rings = {}
+        #incremented on every publish so consumers can tell whether anything changed
+        self.version = 0
+
+    def publish(self, energy_usages):
+        '''Add a cycle of readings, a ReadingBatch or a list of EnergyUsage.'''
+        for row in as_rows(energy_usages):
+            device = row[0]
+            ring = self._rings.get(device)
+            if ring is None:
+                ring = self._rings[device] = [np.full((self.window, 3), np.nan), 0, 0]
+            values, position, count = ring
+            values[position] = [np.nan if value is None else value for value in row[2:]]
+            ring[1] = (position + 1) % self.window
+            ring[2] = min(count + 1, self.window)
+            self._latest[device] = row
+        self.version += 1
+
+    def devices(self) -> list:
+        return list(self._latest)
+
+    def latest(self, device=None):
+        '''
+        Returns:
+            The latest EnergyUsage of device (None if it hasn't reported), or a dict of the latest EnergyUsage of every device.
+        '''
+        if device is not None:
+            row = self._latest.get(device)
+            return None if row is None else EnergyUsage(energy_usage_dict=dict(zip(EnergyUsage.KEYS, row)))
+        return {device: EnergyUsage(energy_usage_dict=dict(zip(EnergyUsage.KEYS, row))) for device, row in self._latest.items()}
+
+    def stats(self, device, last_n=None) -> dict:
+        '''
+        Statistics of the device's last last_n readings (the whole window if None).
+
+        Returns:
+            dict: samples, min/avg/max_power_draw_watts, sum_emitted_mgco2e and avg_grid_carbon_intensity_gco2perkwhr,
+            None for values without any data.
+        '''
+        ring = self._rings.get(device)
+        samples = 0 if ring is None else min(ring[2], last_n or self.window)
+        stats = {"samples": samples}
+        if samples == 0:
+            return {**stats, "min_power_draw_watts": None, "avg_power_draw_watts": None, "max_power_draw_watts": None,
+                    "sum_emitted_mgco2e": None, "avg_grid_carbon_intensity_gco2perkwhr": None}
+        values = ring[0][(ring[1] - 1 - np.arange(samples)) % self.window]
+        power, emitted, intensity = values[:, 0], values[:, 1], values[:, 2]
+        return {**stats,
+                "min_power_draw_watts": _stat(np.min, power),
+                "avg_power_draw_watts": _stat(np.mean, power),
+                "max_power_draw_watts": _stat(np.max, power),
+                "sum_emitted_mgco2e": _stat(np.sum, emitted),
+                "avg_grid_carbon_intensity_gco2perkwhr": _stat(np.mean, intensity)}
+
+def _stat(function, values):
+    values = values[~np.isnan(values)]
+    return float(function(values)) if len(values) else None
@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+from collections import Counter
+
+class SamplingProfiler:
+    '''
+    Statistical profiler for one thread (by default the one calling start(), i.e. the event loop). A daemon thread
+    looks at the profiled thread's current stack every interval_sec and counts each distinct stack, so the
+    overhead depends on the sampling rate rather than on how much code runs.
+
+    The result is written in the folded stack format (one "outer;...;inner count" line per stack) which
+    flamegraph.pl, speedscope and inferno read directly. Time the loop spends waiting shows up under the
+    selector's select/poll frames.
+    '''
+    def __init__(self, interval_sec=0.005):
+        self.interval_sec = interval_sec
+        #folded stack -> number of samples
+        self.stacks = Counter()
+        self.samples = 0
+        self._thread_id = None
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def start(self, thread_id=None):
+        '''Start sampling thread_id, the calling thread if None.'''
+        if self._sampler is not None:
+            return
+        self._thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._run, name="kasa-carbon-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        if self._sampler is None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+
+    @property
+    def running(self) -> bool:
+        return self._sampler is not None
+
+    def folded(self) -> str:
+        '''The samples in the folded stack format, most frequent stacks first.'''
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def dump(self, path):
+        '''Write folded() to path, atomically so a viewer never reads a partial profile.'''
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.folded())
+        os.replace(temp_path, path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_sec):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                #the profiled thread has exited
+                return
+            self.stacks[_fold(frame)] += 1
+            self.samples += 1
+
+def _fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+import numpy as np
+from kasa_carbon.interfaces.carbon_api import CarbonAPI
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.interfaces.metrics_sink import MetricsSink
+from kasa_carbon.modules.kasa_monitor import KasaMonitor
+from kasa_carbon.modules.tick_scheduler import TickScheduler
+
+_LOGGER = logging.getLogger(__name__)
+
+class ShardedMonitor:
+    '''
+    Poll a large fleet from several processes. The device registry is split into one shard per worker process,
+    each worker polls its shard concurrently on its own event loop and sends every cycle to the writer (the
+    process calling run()) as a compact message over a multiprocessing queue:
+
+        (devices, sample times, power)    a list of names plus two float64 numpy arrays
+
+    The writer owns the carbon intensity client and the DatastoreAPI. It computes the emissions of all the
+    messages waiting in the queue in one vectorized pass (KasaMonitor.emissions_batch) and writes them as one batch.
+    '''
+    def __init__(self, workers: int, monitor_kwargs: dict, queue_size=64, mp_context="spawn", metrics: MetricsSink = None):
+        '''
+        Args:
+            workers (int): Number of polling processes.
+            monitor_kwargs (dict): KasaMonitor arguments, must include registry_path. The writer uses them
+                as they are, the workers without the registry and rediscovery. Instead of rediscovering, each
+                worker retries the hosts of its shard which aren't connected or failed their last poll every
+                rediscovery_interval_sec.
+            queue_size (int): Cycles which can be waiting for the writer before workers block.
+            mp_context (str): multiprocessing start method.
+            metrics (MetricsSink, optional): Sink for the writer's emissions and write timings.
+        '''
+        if monitor_kwargs.get("registry_path") is None:
+            raise ValueError("sharded polling requires a device registry (registry_path)")
+        self.workers = workers
+        self.monitor_kwargs = monitor_kwargs
+        self.monitor = KasaMonitor(**monitor_kwargs, metrics=metrics)
+        self._context = multiprocessing.get_context(mp_context)
+        self._queue = self._context.Queue(maxsize=queue_size)
+        self._stop = self._context.Event()
+        self._processes = []
+
+    def shards(self) -> list:
+        '''Split the registry records round robin into one list per worker.'''
+        records = list(self.monitor.registry.devices.values())
+        return [records[i::self.workers] for i in range(self.workers)]
+
+    async def run(self, db: DatastoreAPI, delay, timeout=None):
+        '''
+        Start the workers and write their readings until timeout seconds have passed (forever if None).
+        The registry is filled with a broadcast discovery first if it's empty.
+        '''
+        start_time = time.time()
+        try:
+            if not self.monitor.registry.devices:
+                await self.monitor.discover_devices()
+            #warm the carbon intensity cache so the first cycle doesn't wait on the api
+            await self.monitor._get_co2_data()
+
+            worker_kwargs = self._worker_kwargs()
+            for shard in self.shards():
+                if not shard:
+                    continue
+                process = self._context.Process(target=_run_worker, daemon=True,
+                                                args=(worker_kwargs, shard, delay, self._queue, self._stop, self.monitor.rediscovery_interval_sec))
+                process.start()
+                self._processes.append(process)
+
+            while timeout is None or time.time() - start_time < timeout:
+                messages = await asyncio.to_thread(self._get_messages, min(delay, 0.5))
+                if messages:
+                    await self._write(db, messages, delay)
+                elif not any(process.is_alive() for process in self._processes):
+                    _LOGGER.warning("All polling workers have exited")
+                    break
+        finally:
+            #readings sent before the workers stopped are still written
+            messages = await asyncio.to_thread(self._stop_workers, max(10.0, 2 * delay))
+            if messages:
+                await self._write(db, messages, delay)
+            await db.close()
+            await self.monitor.close()
+
+    def _worker_kwargs(self) -> dict:
+        #workers only poll, the stub carbon client keeps them from each opening the intensity cache and api session
+        return {**self.monitor_kwargs, "registry_path": None, "rediscovery_interval_sec": None, "co2_api": _WorkerCarbonAPI()}
+
+    async def _write(self, db, messages, delay):
+        co2 = await self.monitor._get_co2_data()
+        #messages from different workers are merged into one batch, a device's next cycle starts a new batch
+        energy_values = {}
+        for devices, sample_times, power in messages:
+            if not energy_values.keys().isdisjoint(devices):
+                await self._write_cycle(db, energy_values, co2, delay)
+                energy_values = {}
+            self.monitor.sample_times.update(zip(devices, sample_times.tolist()))
+            energy_values.update(zip(devices, power.tolist()))
+        await self._write_cycle(db, energy_values, co2, delay)
+
+    async def _write_cycle(self, db, energy_values, co2, delay):
+        await self.monitor.write_cycle(db, energy_values, co2, delay)
+
+    def _get_messages(self, wait_sec) -> list:
+        #wait up to wait_sec for one message then take everything else already queued
+        messages = []
+        try:
+            messages.append(self._queue.get(timeout=wait_sec) if wait_sec > 0 else self._queue.get_nowait())
+            while True:
+                messages.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+
+    def _stop_workers(self, wait_sec) -> list:
+        #keep draining the queue while the workers exit, a worker can't exit until its queued messages are read
+        self._stop.set()
+        messages = []
+        deadline = time.monotonic() + wait_sec
+        while any(process.is_alive() for process in self._processes) and time.monotonic() < deadline:
+            messages.extend(self._get_messages(0.1))
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self._processes = []
+        return messages + self._get_messages(0)
+
+class _WorkerCarbonAPI(CarbonAPI):
+    '''Carbon client of the polling workers, which never look up the intensity (the writer does).'''
+    async def get_co2_by_latlon(self, lat: float, lon: float) -> float:
+        raise RuntimeError("polling workers don't look up the carbon intensity")
+
+    async def get_co2_by_gridid(self, grid_id: str) -> float:
+        raise RuntimeError("polling workers don't look up the carbon intensity")
+
+def _run_worker(monitor_kwargs, shard, delay, readings_queue, stop, reconnect_interval_sec=None):
+    asyncio.run(_poll_shard(monitor_kwargs, shard, delay, readings_queue, stop, reconnect_interval_sec))
+
+async def _poll_shard(monitor_kwargs, shard, delay, readings_queue, stop, reconnect_interval_sec=None):
+    monitor = KasaMonitor(**monitor_kwargs)
+    reconnect = None
+    try:
+        await monitor.connect_known_devices(shard)
+        if reconnect_interval_sec is not None:
+            reconnect = asyncio.create_task(_reconnect_periodically(monitor, shard, reconnect_interval_sec))
+        scheduler = TickScheduler(delay)
+        scheduler.start()
+        while not stop.is_set():
+            energy_values = await monitor.monitor_energy_use_once()
+            devices = list(energy_values)
+            message = (devices, np.array([monitor.sample_times[device] for device in devices], dtype=np.float64),
+                       np.fromiter(energy_values.values(), dtype=np.float64, count=len(devices)))
+            #blocks while the queue is full so a slow writer slows the workers down rather than growing memory
+            await asyncio.to_thread(_put, readings_queue, message, stop)
+            await scheduler.wait_next()
+    finally:
+        if reconnect is not None:
+            reconnect.cancel()
+        await monitor.close()
+
+async def _reconnect_periodically(monitor, shard, interval_sec):
+    #workers don't rediscover, so hosts which were down at startup or stopped answering are reconnected here
+    while True:
+        await asyncio.sleep(interval_sec)
+        records = [record for record in shard if record["host"] not in monitor.devices or record["host"] in monitor.failed_devices]
+        if records:
+            try:
+                await monitor.connect_known_devices(records)
+            except Exception as e:
+                _LOGGER.warning("Reconnecting devices failed: %r", e)
+
+def _put(readings_queue, message, stop):
+    while not stop.is_set():
+        try:
+            readings_queue.put(message, timeout=0.5)
+            return
+        except queue.Full:
+            pass
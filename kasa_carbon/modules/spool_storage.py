@@ -0,0 +1,284 @@
+import asyncio
+import csv
+import io
+import logging
+import os
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import ReadingBatch, as_rows
+
+_LOGGER = logging.getLogger(__name__)
+
+class SpoolStorage(DatastoreAPI):
+    '''
+    Local write-ahead spool in front of another store (typically the Database). A batch which fails to write, or
+    doesn't finish within write_timeout_sec, is appended to the spool instead of failing the monitor, and a
+    background replayer drains the spool into the store in ordered batches of replay_batch_rows once it
+    accepts writes again. While the spool holds readings new batches are appended behind them, so the store
+    receives the readings in order and isn't hit with live writes while it's recovering.
+
+    The spool is a directory of csv segments (<sequence>.csv, rows in EnergyUsage.KEYS order), appended to and
+    fsynced per batch. Each run appends to new segments so a row torn by a crash is never extended, it's skipped
+    on replay. A segment is deleted once all of its rows are replayed. Replay uses the store's
+    write_usage_batch_idempotent, so rows which are written twice (a replay interrupted by a crash, or a batch
+    which timed out but reached the store) are stored once.
+
+    Disk use is bounded by max_bytes. When a batch doesn't fit the overflow policy decides which readings are
+    lost: 'drop_oldest' deletes the oldest segments until it fits, 'drop_newest' discards the incoming batch. A batch
+    larger than max_bytes can never fit and is discarded whatever the policy.
+    Dropped readings are counted in dropped_rows and logged.
+
+    Readings the store has accepted but not stored yet (the Database's write-behind buffer) are moved to the spool
+    when a write or closing the store fails, so buffered readings aren't lost either. A failed background flush
+    of the store keeps its readings buffered, they're spooled by the next write which fails.
+
+    Spooled readings aren't visible to reads until they've been replayed.
+    '''
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest")
+
+    def __init__(self, store: DatastoreAPI, spool_dir, max_bytes=256 * 1024 * 1024, segment_bytes=4 * 1024 * 1024,
+                 overflow="drop_oldest", write_timeout_sec=None, replay_batch_rows=5000, retry_interval_sec=5.0, fsync=True):
+        '''
+        Args:
+            store (DatastoreAPI): The store written to.
+            spool_dir (str): Directory of the spool segments. Readings left by a previous run are replayed once
+                start_replay() is called, or by the first write.
+            max_bytes (int): Maximum disk use of the spool.
+            segment_bytes (int): Start a new segment once the active one reaches this size.
+            overflow (str): What to drop when the spool is full, see OVERFLOW_POLICIES.
+            write_timeout_sec (float, optional): Latency budget of a write, slower writes are spooled.
+            replay_batch_rows (int): Rows per replayed batch.
+            retry_interval_sec (float): Wait between replay attempts while the store is failing.
+            fsync (bool): fsync every spooled batch so it survives a power loss.
+        '''
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {self.OVERFLOW_POLICIES}")
+        self.store = store
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.overflow = overflow
+        self.write_timeout_sec = write_timeout_sec
+        self.replay_batch_rows = replay_batch_rows
+        self.retry_interval_sec = retry_interval_sec
+        self.fsync = fsync
+        self.spooled_rows = 0
+        self.replayed_rows = 0
+        self.dropped_rows = 0
+        os.makedirs(self.spool_dir, exist_ok=True)
+        #segment sequence numbers, oldest first, the last one is appended to while _file is open
+        self._segments = sorted(int(name[:-4]) for name in os.listdir(self.spool_dir) if name.endswith(".csv") and name[:-4].isdigit())
+        #running total of the segments' sizes, so appending doesn't stat every segment
+        self._spooled_bytes = sum(os.path.getsize(self._segment_path(segment)) for segment in self._segments)
+        self._file = None
+        #byte offset in the oldest segment up to which its rows have been replayed
+        self._replay_offset = 0
+        #serializes the spool's file operations between writers and the replayer
+        self._lock = asyncio.Lock()
+        self._replay_task = None
+
+    @property
+    def spooled_bytes(self) -> int:
+        return self._spooled_bytes
+
+    async def write_usage(self, energy_usage: EnergyUsage) -> None:
+        await self.write_usage_batch([energy_usage])
+
+    async def write_usage_batch(self, energy_usages) -> None:
+        if not self._segments:
+            try:
+                await asyncio.wait_for(self.store.write_usage_batch(energy_usages), self.write_timeout_sec)
+                return
+            except Exception as e:
+                _LOGGER.warning("Failed to write %d readings, spooling them: %r", len(energy_usages), e)
+                await self._spool_unflushed(as_rows(energy_usages))
+                self.start_replay()
+                return
+        await self._spool(as_rows(energy_usages))
+        self.start_replay()
+
+    def start_replay(self):
+        '''Start the background replay if the spool holds readings and it isn't running.'''
+        if self._segments and (self._replay_task is None or self._replay_task.done()):
+            self._replay_task = asyncio.create_task(self._replay_until_empty())
+
+    async def drain(self) -> int:
+        '''
+        Replay every spooled reading in the foreground, e.g. before reading from the store.
+
+        Returns:
+            int: The number of readings replayed.
+        '''
+        replayed = 0
+        while True:
+            rows = await self.replay()
+            if rows == 0:
+                return replayed
+            replayed += rows
+
+    async def replay(self) -> int:
+        '''
+        Write the next batch of spooled readings to the store.
+
+        Returns:
+            int: The number of readings replayed, 0 once the spool is empty.
+        '''
+        async with self._lock:
+            if not self._segments:
+                return 0
+            if len(self._segments) == 1:
+                #the active segment is only read once it's closed, new batches go to a new segment
+                await asyncio.to_thread(self._close_file)
+            segment, offset = self._segments[0], self._replay_offset
+        rows, offset, done = await asyncio.to_thread(self._read_rows, self._segment_path(segment), offset, self.replay_batch_rows)
+        if rows:
+            await asyncio.wait_for(self.store.write_usage_batch_idempotent(ReadingBatch(*zip(*rows))), self.write_timeout_sec)
+        async with self._lock:
+            #the segment may have been dropped by the overflow policy while its rows were written
+            if self._segments and self._segments[0] == segment:
+                self._replay_offset = offset
+                if done:
+                    self._segments.pop(0)
+                    self._replay_offset = 0
+                    self._spooled_bytes -= await asyncio.to_thread(_remove, self._segment_path(segment))
+        self.replayed_rows += len(rows)
+        return len(rows)
+
+    async def read_usage(self, last_n=10, columns="*"):
+        return await self.store.read_usage(last_n, columns)
+
+    async def read_usage_range(self, start, end) -> list:
+        return await self.store.read_usage_range(start, end)
+
+    def iter_usage(self, start=None, end=None, devices=None, columns="*"):
+        return self.store.iter_usage(start, end, devices, columns)
+
+    async def aggregate_usage(self, start, end, bucket, agg="avg", devices=None) -> list:
+        return await self.store.aggregate_usage(start, end, bucket, agg, devices)
+
+    async def usage_totals(self, start, end, devices=None) -> dict:
+        return await self.store.usage_totals(start, end, devices)
+
+    async def update_carbon_batch(self, energy_usages: list) -> None:
+        await self.store.update_carbon_batch(energy_usages)
+
+    async def close(self):
+        #readings still spooled stay on disk and are replayed by the next run
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            await asyncio.gather(self._replay_task, return_exceptions=True)
+            self._replay_task = None
+        error = None
+        try:
+            await self.store.close()
+        except Exception as e:
+            error = e
+            await self._spool_unflushed([])
+        async with self._lock:
+            await asyncio.to_thread(self._close_file)
+        if error is not None:
+            if not self._segments:
+                raise error
+            _LOGGER.warning("Failed to close the store, %d bytes of readings remain spooled: %r", self.spooled_bytes, error)
+
+    async def _replay_until_empty(self):
+        while True:
+            try:
+                if await self.replay() == 0:
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _LOGGER.warning("Failed to replay spooled readings, retrying in %s seconds: %r", self.retry_interval_sec, e)
+                await asyncio.sleep(self.retry_interval_sec)
+
+    async def _spool_unflushed(self, rows):
+        #spool the readings the store still holds ahead of rows, a failed write can have left rows in the store's buffer too
+        unflushed = self.store.take_unflushed()
+        held = {row[:2] for row in unflushed}
+        rows = unflushed + [row for row in rows if row[:2] not in held]
+        if rows:
+            await self._spool(rows)
+
+    async def _spool(self, rows):
+        async with self._lock:
+            await asyncio.to_thread(self._append, rows)
+        self.spooled_rows += len(rows)
+
+    def _append(self, rows):
+        lines = _format_rows(rows)
+        size = len(lines)
+        if size > self.max_bytes:
+            #dropping older readings wouldn't make room for it
+            self._drop(len(rows), "an oversized batch of")
+            return
+        if self._spooled_bytes + size > self.max_bytes:
+            if self.overflow == "drop_newest":
+                self._drop(len(rows), "the newest")
+                return
+            while self._segments and self._spooled_bytes + size > self.max_bytes:
+                if len(self._segments) == 1:
+                    self._close_file()
+                segment = self._segments.pop(0)
+                path = self._segment_path(segment)
+                self._drop(_count_rows(path, self._replay_offset), "the oldest")
+                self._spooled_bytes -= _remove(path)
+                self._replay_offset = 0
+
+        if self._file is not None and self._file.tell() >= self.segment_bytes:
+            self._close_file()
+        if self._file is None:
+            self._segments.append(self._segments[-1] + 1 if self._segments else 1)
+            self._file = open(self._segment_path(self._segments[-1]), 'ab')
+        self._file.write(lines)
+        self._spooled_bytes += size
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _drop(self, rows, which):
+        self.dropped_rows += rows
+        _LOGGER.warning("Spool is full (%d bytes), dropped %s %d readings", self.max_bytes, which, rows)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _segment_path(self, segment):
+        return os.path.join(self.spool_dir, f"{segment:020d}.csv")
+
+    @staticmethod
+    def _read_rows(path, offset, max_rows):
+        #returns (rows, offset after them, whether the segment is exhausted), a torn last line is skipped
+        rows = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while len(rows) < max_rows:
+                line = f.readline()
+                if not line:
+                    return rows, f.tell(), True
+                offset = f.tell()
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete row")
+                    rows.append(EnergyUsage.from_csv_row(next(csv.reader([line.decode()]))).as_tuple())
+                except (ValueError, StopIteration) as e:
+                    _LOGGER.warning("Skipping a corrupt row of spool segment %s: %r", path, e)
+            return rows, offset, f.read(1) == b""
+
+def _format_rows(rows) -> bytes:
+    lines = io.StringIO()
+    csv.writer(lines, lineterminator="\n").writerows(rows)
+    return lines.getvalue().encode()
+
+def _remove(path) -> int:
+    #delete a segment, returns its size
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
+
+def _count_rows(path, offset=0):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
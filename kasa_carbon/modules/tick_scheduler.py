@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+class TickScheduler:
+    '''
+    Fires on a fixed grid of ticks spaced interval seconds apart, anchored at the time start() is called.
+
+    Unlike sleeping for interval after each unit of work, the tick grid doesn't drift by however long the work took.
+    If the work overruns one or more ticks those ticks are skipped (and counted in overrun_ticks) rather than
+    fired back to back to catch up.
+    '''
+    def __init__(self, interval: float, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.overrun_ticks = 0
+        self._next_tick = None
+        self._last_tick = None
+
+    def start(self):
+        now = self.clock()
+        self._last_tick = now
+        self._next_tick = now + self.interval
+
+    async def wait_next(self) -> float:
+        '''
+        Wait until the next tick.
+
+        Returns:
+            float: The measured number of seconds since the previous tick (or since start()).
+        '''
+        if self._next_tick is None:
+            self.start()
+
+        now = self.clock()
+        if now > self._next_tick:
+            missed = int((now - self._next_tick) // self.interval) + 1
+            self.overrun_ticks += missed
+            self._next_tick += missed * self.interval
+
+        await asyncio.sleep(self._next_tick - now)
+
+        now = self.clock()
+        elapsed = now - self._last_tick
+        self._last_tick = now
+        self._next_tick += self.interval
+        return elapsed
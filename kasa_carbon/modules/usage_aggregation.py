@@ -0,0 +1,142 @@
+from datetime import datetime, timezone, timedelta
+import numpy as np
+from kasa_carbon.modules.emissions import seconds_since_previous
+
+AGGREGATES = ("avg", "min", "max", "sum")
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def check_aggregate(agg):
+    if agg not in AGGREGATES:
+        raise ValueError(f"agg must be one of {AGGREGATES}")
+
+class _Stats:
+    #count/sum/min/max of the non-null values of one column in one group
+    __slots__ = ("count", "sum", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def merge(self, count, total, minimum, maximum):
+        if count == 0:
+            return
+        self.count += count
+        self.sum += total
+        self.min = minimum if self.min is None else min(self.min, minimum)
+        self.max = maximum if self.max is None else max(self.max, maximum)
+
+    def value(self, agg):
+        if self.count == 0:
+            return None
+        if agg == "avg":
+            return self.sum / self.count
+        return getattr(self, agg)
+
+class BucketAggregator:
+    '''
+    Streaming per device, per time bucket aggregation of readings. Only one set of running statistics per
+    (device, bucket) is kept so the input can be any number of readings.
+
+    Each output row holds the number of samples, agg of power_draw_watts and grid_carbon_intensity_gco2perkwhr
+    and the total avg_emitted_mgco2e of the bucket. Buckets are aligned to the unix epoch.
+    '''
+    def __init__(self, bucket: timedelta, agg="avg"):
+        check_aggregate(agg)
+        self.bucket_us = bucket // timedelta(microseconds=1)
+        self.agg = agg
+        self.groups = {}
+
+    def add(self, device, timestamp: datetime, power, emitted, intensity):
+        bucket = ((timestamp - EPOCH) // timedelta(microseconds=1)) // self.bucket_us
+        group = self._group(device, bucket)
+        group[0] += 1
+        for stats, value in zip(group[1:], (power, emitted, intensity)):
+            if value is not None:
+                stats.merge(1, value, value, value)
+
+    def add_arrays(self, devices, timestamps_us, power, emitted, intensity):
+        '''Vectorized add for numpy arrays, NaN marks a missing value.'''
+        if len(timestamps_us) == 0:
+            return
+        keys = np.stack([np.asarray(devices, dtype=np.int64), np.asarray(timestamps_us, dtype=np.int64) // self.bucket_us], axis=1)
+        groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse, minlength=len(groups))
+        partials = [_group_stats(np.asarray(values, dtype=np.float64), inverse, len(groups)) for values in (power, emitted, intensity)]
+        for i, (device, bucket) in enumerate(groups):
+            group = self._group(int(device), int(bucket))
+            group[0] += int(counts[i])
+            for stats, (n, total, minimum, maximum) in zip(group[1:], partials):
+                stats.merge(int(n[i]), float(total[i]), float(minimum[i]), float(maximum[i]))
+
+    def rows(self, device_names=None):
+        '''
+        Returns:
+            list: dicts with device, bucket (start datetime), samples, power_draw_watts, avg_emitted_mgco2e and
+            grid_carbon_intensity_gco2perkwhr, ordered by bucket then device.
+        '''
+        rows = []
+        for (device, bucket), (samples, power, emitted, intensity) in self.groups.items():
+            rows.append({"device": device_names[device] if device_names is not None else device,
+                         "bucket": EPOCH + timedelta(microseconds=bucket * self.bucket_us),
+                         "samples": samples,
+                         "power_draw_watts": power.value(self.agg),
+                         "avg_emitted_mgco2e": emitted.value("sum"),
+                         "grid_carbon_intensity_gco2perkwhr": intensity.value(self.agg)})
+        rows.sort(key=lambda row: (row["bucket"], row["device"]))
+        return rows
+
+    def _group(self, device, bucket):
+        group = self.groups.get((device, bucket))
+        if group is None:
+            group = self.groups[(device, bucket)] = [0, _Stats(), _Stats(), _Stats()]
+        return group
+
+class TotalsAggregator:
+    '''
+    Streaming per device totals: number of samples, energy in Wh and emissions in mgCO2e. Each reading's power
+    is counted for the time since the device's previous reading (the first reading of a device adds no energy),
+    which is the same period its avg_emitted_mgco2e covers.
+    '''
+    def __init__(self):
+        self.totals = {}
+        self._previous_times = {}
+
+    def add_arrays(self, devices, times, power, emitted):
+        '''Add readings as numpy arrays, times in unix seconds, NaN marks a missing value.'''
+        if len(times) == 0:
+            return
+        intervals = seconds_since_previous(devices, times, self._previous_times)
+        energy_wh = np.asarray(power, dtype=np.float64) * intervals / 3600.0
+        emitted = np.asarray(emitted, dtype=np.float64)
+        codes, inverse = np.unique(np.asarray(devices), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse, minlength=len(codes))
+        energy = np.bincount(inverse, weights=np.nan_to_num(energy_wh), minlength=len(codes))
+        emitted_count = np.bincount(inverse, weights=~np.isnan(emitted), minlength=len(codes))
+        emitted_sum = np.bincount(inverse, weights=np.nan_to_num(emitted), minlength=len(codes))
+        for i, device in enumerate(codes):
+            total = self.totals.setdefault(device.item(), {"samples": 0, "energy_wh": 0.0, "emitted_mgco2e": None})
+            total["samples"] += int(counts[i])
+            total["energy_wh"] += float(energy[i])
+            if emitted_count[i] > 0:
+                total["emitted_mgco2e"] = (total["emitted_mgco2e"] or 0.0) + float(emitted_sum[i])
+
+    def add_usages(self, energy_usages):
+        self.add_arrays([energy_usage.device for energy_usage in energy_usages],
+                        [energy_usage.timestamp.timestamp() for energy_usage in energy_usages],
+                        [np.nan if energy_usage.power_draw_watts is None else energy_usage.power_draw_watts for energy_usage in energy_usages],
+                        [np.nan if energy_usage.avg_emitted_mgco2e is None else energy_usage.avg_emitted_mgco2e for energy_usage in energy_usages])
+
+def _group_stats(values, inverse, group_count):
+    #count, sum, min and max of the non-NaN values per group
+    present = ~np.isnan(values)
+    counts = np.bincount(inverse, weights=present, minlength=group_count)
+    sums = np.bincount(inverse, weights=np.where(present, values, 0.0), minlength=group_count)
+    minimums = np.full(group_count, np.inf)
+    maximums = np.full(group_count, -np.inf)
+    np.minimum.at(minimums, inverse[present], values[present])
+    np.maximum.at(maximums, inverse[present], values[present])
+    return counts, sums, minimums, maximums
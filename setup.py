@@ -16,7 +16,8 @@ setup(
         'asyncpg==0.29.0',
         'pytz==2023.3.post1',
         'aiohttp==3.9.1',
-        'python-dotenv==1.0.0'
+        'python-dotenv==1.0.0',
+        'numpy==1.26.4'
     ],
     classifiers=[
         'Programming Language :: Python :: 3',
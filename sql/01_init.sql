@@ -1,3 +1,4 @@
+-- requires PostgreSQL 14 or later (CREATE OR REPLACE TRIGGER, date_bin in the application queries)
 CREATE TABLE IF NOT EXISTS energy_usage (
     device VARCHAR(255) NOT NULL,
     timestamp TIMESTAMPTZ NOT NULL,
@@ -5,10 +6,117 @@ CREATE TABLE IF NOT EXISTS energy_usage (
     avg_emitted_mgco2e real,
     grid_carbon_intensity_gco2perkwhr real,
     PRIMARY KEY (device, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+-- readings arrive in time order so a BRIN index keeps time range scans cheap at a tiny fraction of a btree's size
+CREATE INDEX IF NOT EXISTS energy_usage_timestamp_brin ON energy_usage USING BRIN (timestamp);
+
+-- catches readings of months without a partition (raw inserts, imports), so an insert never fails for lack of one
+CREATE TABLE IF NOT EXISTS energy_usage_default PARTITION OF energy_usage DEFAULT;
+
+-- monthly (UTC) partitions named energy_usage_YYYY_MM, created on demand by the application before it writes to a new month.
+-- Readings of the month already in the default partition are moved into the new partition before it's attached
+CREATE OR REPLACE FUNCTION ensure_energy_usage_partition(ts TIMESTAMPTZ) RETURNS void AS $$
+DECLARE
+    month_start TIMESTAMPTZ := date_trunc('month', ts, 'UTC');
+    partition_name TEXT := 'energy_usage_' || to_char(date_trunc('month', ts, 'UTC') AT TIME ZONE 'UTC', 'YYYY_MM');
+BEGIN
+    -- serializes concurrent writers creating the same partition
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_energy_usage_partition'));
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE energy_usage INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+    EXECUTE format('WITH moved AS (DELETE FROM energy_usage_default WHERE timestamp >= $1 AND timestamp < $2 RETURNING *)
+                    INSERT INTO %I SELECT * FROM moved', partition_name)
+        USING month_start, month_start + interval '1 month';
+    EXECUTE format('ALTER TABLE energy_usage ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, month_start, month_start + interval '1 month');
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_energy_usage_partition(now());
+SELECT ensure_energy_usage_partition(now() + interval '1 month');
+
+-- per device rollups, kept up to date incrementally as readings are inserted
+CREATE TABLE IF NOT EXISTS energy_usage_1m (
+    device VARCHAR(255) NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    sample_count integer NOT NULL,
+    sum_power_draw_watts double precision NOT NULL,
+    max_power_draw_watts real NOT NULL,
+    sum_emitted_mgco2e double precision,
+    PRIMARY KEY (device, bucket)
 );
+CREATE TABLE IF NOT EXISTS energy_usage_1h (LIKE energy_usage_1m INCLUDING ALL);
+CREATE TABLE IF NOT EXISTS energy_usage_1d (LIKE energy_usage_1m INCLUDING ALL);
 
+CREATE OR REPLACE FUNCTION energy_usage_rollup_insert() RETURNS trigger AS $$
+DECLARE
+    rollup TEXT[];
+BEGIN
+    FOREACH rollup SLICE 1 IN ARRAY ARRAY[['energy_usage_1m', 'minute'], ['energy_usage_1h', 'hour'], ['energy_usage_1d', 'day']] LOOP
+        EXECUTE format(
+            'INSERT INTO %1$I AS r (device, bucket, sample_count, sum_power_draw_watts, max_power_draw_watts, sum_emitted_mgco2e)
+             SELECT device, date_trunc(%2$L, timestamp, ''UTC''), count(*), sum(power_draw_watts), max(power_draw_watts), sum(avg_emitted_mgco2e)
+             FROM new_rows
+             GROUP BY 1, 2
+             ON CONFLICT (device, bucket) DO UPDATE SET
+                 sample_count = r.sample_count + EXCLUDED.sample_count,
+                 sum_power_draw_watts = r.sum_power_draw_watts + EXCLUDED.sum_power_draw_watts,
+                 max_power_draw_watts = GREATEST(r.max_power_draw_watts, EXCLUDED.max_power_draw_watts),
+                 sum_emitted_mgco2e = CASE WHEN r.sum_emitted_mgco2e IS NULL THEN EXCLUDED.sum_emitted_mgco2e
+                                           WHEN EXCLUDED.sum_emitted_mgco2e IS NULL THEN r.sum_emitted_mgco2e
+                                           ELSE r.sum_emitted_mgco2e + EXCLUDED.sum_emitted_mgco2e END',
+            rollup[1], rollup[2]);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- statement level so a COPY or multi-row insert updates each rollup with one grouped upsert
+CREATE OR REPLACE TRIGGER energy_usage_rollup AFTER INSERT ON energy_usage
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION energy_usage_rollup_insert();
+
+-- recompute the rollup buckets overlapping [range_start, range_end] from the readings, used after readings are updated
+CREATE OR REPLACE FUNCTION refresh_energy_usage_rollups(range_start TIMESTAMPTZ, range_end TIMESTAMPTZ) RETURNS void AS $$
+DECLARE
+    rollup TEXT[];
+    bucket_start TIMESTAMPTZ;
+    bucket_end TIMESTAMPTZ;
+BEGIN
+    FOREACH rollup SLICE 1 IN ARRAY ARRAY[['energy_usage_1m', 'minute'], ['energy_usage_1h', 'hour'], ['energy_usage_1d', 'day']] LOOP
+        bucket_start := date_trunc(rollup[2], range_start, 'UTC');
+        bucket_end := date_trunc(rollup[2], range_end, 'UTC') + ('1 ' || rollup[2])::interval;
+        EXECUTE format('DELETE FROM %I WHERE bucket >= $1 AND bucket < $2', rollup[1]) USING bucket_start, bucket_end;
+        EXECUTE format(
+            'INSERT INTO %1$I (device, bucket, sample_count, sum_power_draw_watts, max_power_draw_watts, sum_emitted_mgco2e)
+             SELECT device, date_trunc(%2$L, timestamp, ''UTC''), count(*), sum(power_draw_watts), max(power_draw_watts), sum(avg_emitted_mgco2e)
+             FROM energy_usage
+             WHERE timestamp >= $1 AND timestamp < $2
+             GROUP BY 1, 2',
+            rollup[1], rollup[2]) USING bucket_start, bucket_end;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the time window lets the planner prune old partitions and use the BRIN index instead of sorting every reading
 CREATE OR REPLACE VIEW energy_usage_view AS
 SELECT *
 FROM energy_usage
+WHERE timestamp >= now() - interval '30 days'
 ORDER BY timestamp DESC
 LIMIT 100000;
+
+CREATE OR REPLACE VIEW energy_usage_1m_view AS
+SELECT device, bucket, sample_count, sum_power_draw_watts / sample_count AS avg_power_draw_watts, max_power_draw_watts, sum_emitted_mgco2e
+FROM energy_usage_1m;
+
+CREATE OR REPLACE VIEW energy_usage_1h_view AS
+SELECT device, bucket, sample_count, sum_power_draw_watts / sample_count AS avg_power_draw_watts, max_power_draw_watts, sum_emitted_mgco2e
+FROM energy_usage_1h;
+
+CREATE OR REPLACE VIEW energy_usage_1d_view AS
+SELECT device, bucket, sample_count, sum_power_draw_watts / sample_count AS avg_power_draw_watts, max_power_draw_watts, sum_emitted_mgco2e
+FROM energy_usage_1d;
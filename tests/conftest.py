@@ -11,7 +11,7 @@ def energy_usage_test_data() -> EnergyUsage:
         sql = file.read()
 
     # Parse the CREATE TABLE statement to get the column names and types
-    match = re.search(r'CREATE TABLE IF NOT EXISTS energy_usage \((.*)\)\s*;', sql, re.DOTALL)
+    match = re.search(r'CREATE TABLE IF NOT EXISTS energy_usage \((.*?)\)\s*(?:PARTITION BY[^;]*)?;', sql, re.DOTALL)
     column_definitions = re.split(r',(?![^(]*\))', match.group(1))
     columns = [re.search(r'^\s*(\w+)\s+(.+)', column_definition).groups() for column_definition in column_definitions]
 
@@ -0,0 +1,65 @@
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, patch
+from kasa import SmartStrip
+from kasa_carbon.modules.kasa_monitor import KasaMonitor
+from benchmarks.kasa_simulator import KasaSimulator
+from benchmarks.run_benchmark import run_fleet, delete_simulated_readings
+
+PORT = 19999
+
+@pytest.mark.asyncio
+async def test_monitor_polls_simulated_fleet():
+    # Arrange
+    simulator = KasaSimulator(4, port=PORT, strip_every=2)
+    await simulator.start()
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE", rediscovery_interval_sec=None)
+
+    # Act
+    try:
+        connected = await kasa.connect_known_devices(simulator.records())
+        first = await kasa.monitor_energy_use_once()
+        second = await kasa.monitor_energy_use_once()
+    finally:
+        await simulator.close()
+        await kasa.close()
+
+    # Assert
+    assert connected == 4
+    assert sum(isinstance(device, SmartStrip) for device in kasa.devices.values()) == 2
+    assert len(first) == simulator.plugs == 14
+    assert "sim-127.0.0.3-plug5" in first
+    assert first.keys() == second.keys()
+    assert first != second
+    assert all(power > 0 for power in first.values())
+
+@pytest.mark.asyncio
+async def test_run_fleet_reports_throughput(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+
+    # Act
+    result = await run_fleet(5, "file", str(tmp_path), duration_sec=0.5, delay=0.01, strip_every=5, carbon_latency_sec=0.0, port=PORT)
+
+    # Assert
+    assert result["connected"] == 5
+    assert result["cycles"] > 1
+    assert result["rows"] == result["cycles"] * 10
+    assert result["cycle_sec"]["p50"] <= result["cycle_sec"]["p99"]
+    assert (tmp_path / "energy_usage_5.csv").exists()
+
+@pytest.mark.asyncio
+async def test_delete_simulated_readings_refreshes_rollups():
+    # Arrange
+    conn = AsyncMock()
+    start, end = datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 1, 0, 1, tzinfo=timezone.utc)
+    conn.fetchrow.return_value = (start, end)
+
+    # Act
+    with patch('asyncpg.connect', new_callable=AsyncMock, return_value=conn):
+        await delete_simulated_readings({"host": "localhost", "database": "scratch"})
+
+    # Assert
+    assert "device LIKE 'sim-%'" in conn.fetchrow.await_args.args[0]
+    conn.execute.assert_awaited_once_with("SELECT refresh_energy_usage_rollups($1, $2)", start, end)
+    conn.close.assert_awaited_once()
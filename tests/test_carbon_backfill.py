@@ -0,0 +1,189 @@
+import pytest
+import pytest_asyncio
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, patch
+from aiohttp import web
+from kasa_carbon.modules.carbon_backfill import backfill_emissions
+from kasa_carbon.modules.electricitymaps_api import ElectricityMapAPI
+from kasa_carbon.modules.file_storage import FileStorage
+from kasa_carbon.modules.columnar_storage import ColumnarStorage
+from kasa_carbon.modules.database import Database
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.interfaces.carbon_api import CarbonAPI
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from tests.test_database import mock_pool
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+@pytest_asyncio.fixture
+async def fake_history_server():
+    # Serves 100 gCO2/kWh for every even hour and 200 for every odd hour
+    requests = []
+
+    async def past_range(request):
+        requests.append(dict(request.query))
+        start = datetime.fromisoformat(request.query["start"])
+        end = datetime.fromisoformat(request.query["end"])
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        data = []
+        while hour <= end:
+            data.append({"carbonIntensity": 100 if hour.hour % 2 == 0 else 200,
+                         "datetime": hour.strftime('%Y-%m-%dT%H:%M:%S.000Z')})
+            hour += timedelta(hours=1)
+        return web.json_response({"zone": request.query["zone"], "data": data})
+
+    app = web.Application()
+    app.router.add_get("/past-range", past_range)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    yield f"http://127.0.0.1:{port}/past-range", requests
+    await runner.cleanup()
+
+def readings():
+    # two devices sampled every 30 minutes for 4 hours without carbon data
+    usages = []
+    for i in range(8):
+        for device, power in (("device1", 1000.0), ("device2", 500.0)):
+            usages.append(EnergyUsage(energy_usage_dict={"device": device, "timestamp": START + timedelta(minutes=30 * i),
+                                                         "power_draw_watts": power, "avg_emitted_mgco2e": None,
+                                                         "grid_carbon_intensity_gco2perkwhr": None}))
+    return usages
+
+def carbon_api(history_url, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    api = ElectricityMapAPI(em_api_key="test", clear_cache=True)
+    api.HISTORY_URL = history_url
+    api.HISTORY_MAX_RANGE = timedelta(hours=2)
+    return api
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("make_store", [
+    lambda tmp_path: FileStorage(str(tmp_path / "energy_usage.csv"), "append", rotate_period="hourly", compression="gzip"),
+    lambda tmp_path: ColumnarStorage(str(tmp_path / "columns")),
+])
+async def test_backfill_emissions(fake_history_server, tmp_path, monkeypatch, make_store):
+    # Arrange
+    history_url, requests = fake_history_server
+    api = carbon_api(history_url, tmp_path, monkeypatch)
+    store = make_store(tmp_path)
+    usages = readings()
+    for i in range(0, len(usages), 2):
+        await store.write_usage_batch(usages[i:i + 2])
+
+    # Act
+    updated = await backfill_emissions(store, api, "DE", START, START + timedelta(hours=4), interval_sec=1800, chunk=timedelta(hours=1))
+    result = await store.read_usage_range(START, START + timedelta(hours=4))
+    await store.close()
+    await api.close()
+
+    # Assert
+    assert updated == 16
+    assert len(requests) == 3 # 5 hours of history fetched in 2 hour windows
+    assert [usage.grid_carbon_intensity_gco2perkwhr for usage in result if usage.device == "device1"] == [100, 100, 200, 200, 100, 100, 200, 200]
+    # 1kW for half an hour at 200 gCO2/kWh
+    device1_at_1am = [usage for usage in result if usage.device == "device1" and usage.timestamp == START + timedelta(hours=1)][0]
+    assert device1_at_1am.avg_emitted_mgco2e == pytest.approx(0.5 * 1.0 * 200 / 1000.0)
+
+@pytest.mark.asyncio
+async def test_backfill_only_missing(fake_history_server, tmp_path, monkeypatch):
+    # Arrange
+    history_url, _ = fake_history_server
+    api = carbon_api(history_url, tmp_path, monkeypatch)
+    store = FileStorage(str(tmp_path / "energy_usage.csv"), "append")
+    usages = readings()
+    usages[0].grid_carbon_intensity_gco2perkwhr = 999.0
+    usages[0].avg_emitted_mgco2e = 1.0
+    await store.write_usage_batch(usages)
+
+    # Act
+    updated = await backfill_emissions(store, api, "DE", START, START + timedelta(hours=4), interval_sec=1800)
+    result = await store.read_usage_range(START, START + timedelta(hours=4))
+    await store.close()
+    await api.close()
+
+    # Assert
+    assert updated == 15
+    assert result[0].grid_carbon_intensity_gco2perkwhr == 999.0
+
+@pytest.mark.asyncio
+async def test_backfill_integrates_power_changes_across_chunks(fake_history_server, tmp_path, monkeypatch):
+    # Arrange
+    history_url, _ = fake_history_server
+    api = carbon_api(history_url, tmp_path, monkeypatch)
+    store = FileStorage(str(tmp_path / "energy_usage.csv"), "append")
+    await store.write_usage_batch([EnergyUsage(energy_usage_dict={"device": "device1", "timestamp": START + timedelta(minutes=30 * i),
+                                                                  "power_draw_watts": 1000.0 * i, "avg_emitted_mgco2e": None,
+                                                                  "grid_carbon_intensity_gco2perkwhr": None}) for i in range(3)])
+
+    # Act
+    await backfill_emissions(store, api, "DE", START, START + timedelta(hours=2), interval_sec=1800, chunk=timedelta(minutes=30))
+    result = await store.read_usage_range(START, START + timedelta(hours=2))
+    await store.close()
+    await api.close()
+
+    # Assert
+    # the power ramps linearly between readings in different chunks, 0.5kW then 1.5kW average for half an hour
+    assert [usage.avg_emitted_mgco2e for usage in result] == pytest.approx([0.0, 0.5 * 0.5 * 100 / 1000.0, 0.5 * 1.5 * 200 / 1000.0])
+
+@pytest.mark.asyncio
+async def test_update_carbon_batch_database():
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"})
+    pool, conn = mock_pool()
+    usages = readings()[:2]
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.update_carbon_batch(usages)
+
+    # Assert
+    assert conn.execute.await_args_list[0].args == (Database.UPDATE_CARBON_SQL_QUERY, ("device1", "device2"), (START, START), (None, None), (None, None))
+    assert conn.execute.await_args_list[1].args == ("SELECT refresh_energy_usage_rollups($1, $2)", START, START)
+
+class MinimalStore(DatastoreAPI):
+    '''A store which implements only the abstract methods.'''
+    async def write_usage(self, energy_usage):
+        pass
+
+    async def read_usage(self, last_n=10, columns="*"):
+        return []
+
+    async def close(self):
+        pass
+
+class CurrentOnlyCarbonAPI(CarbonAPI):
+    async def get_co2_by_latlon(self, lat, lon):
+        return 100.0
+
+    async def get_co2_by_gridid(self, grid_id):
+        return 100.0
+
+@pytest.mark.asyncio
+async def test_implementations_without_backfill_support_still_work():
+    # Arrange
+    store = MinimalStore()
+    carbon_api = CurrentOnlyCarbonAPI()
+    now = datetime.now(timezone.utc)
+
+    # Act
+    intensity = await carbon_api.get_co2_by_gridid("US-NW-SCL")
+
+    # Assert
+    assert intensity == 100.0
+    with pytest.raises(NotImplementedError, match="MinimalStore"):
+        await store.update_carbon_batch([])
+    with pytest.raises(NotImplementedError, match="CurrentOnlyCarbonAPI"):
+        await carbon_api.get_co2_history_by_gridid("US-NW-SCL", now - timedelta(hours=1), now)
+
+@pytest.mark.asyncio
+async def test_range_reads_of_a_store_without_iter_usage_fail_clearly():
+    # Arrange
+    store = MinimalStore()
+    now = datetime.now(timezone.utc)
+
+    # Act / Assert
+    with pytest.raises(NotImplementedError, match="MinimalStore"):
+        await store.read_usage_range(now - timedelta(hours=1), now)
@@ -0,0 +1,75 @@
+import asyncio
+import json
+import pytest
+from datetime import datetime, timedelta, timezone
+from kasa_carbon.modules.carbon_cache import CarbonCache
+
+def test_get_respects_expiry_in_minutes(tmp_path):
+    # Arrange
+    cache = CarbonCache(str(tmp_path / "cache.json"), timedelta(minutes=30))
+    cache.put("DE", 300.0, fetched_at=datetime.now(timezone.utc) - timedelta(minutes=29))
+    cache.put("FR", 50.0, fetched_at=datetime.now(timezone.utc) - timedelta(minutes=31))
+
+    # Act
+    fresh = cache.get("DE")
+    expired = cache.get("FR")
+
+    # Assert
+    assert fresh[0] == 300.0
+    assert expired is None
+    assert cache.peek("FR")[0] == 50.0
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_stale_entries_are_counted_as_stale_hits(tmp_path):
+    # Arrange
+    cache = CarbonCache(str(tmp_path / "cache.json"), timedelta(minutes=30))
+    cache.put("DE", 300.0)
+    cache.put("FR", 50.0, fetched_at=datetime.now(timezone.utc) - timedelta(minutes=31))
+
+    # Act
+    cache.get("DE")
+    stale = cache.get("FR", stale=True)
+    cache.get("GB", stale=True)
+
+    # Assert
+    assert stale[0] == 50.0
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["stale_hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hit_ratio"] == 2 / 3
+
+def test_lru_eviction(tmp_path):
+    # Arrange
+    cache = CarbonCache(str(tmp_path / "cache.json"), timedelta(minutes=30), max_size=2)
+    cache.put("DE", 1.0)
+    cache.put("FR", 2.0)
+
+    # Act
+    cache.get("DE") # DE is now the most recently used
+    cache.put("GB", 3.0)
+
+    # Assert
+    assert list(cache.entries) == ["DE", "GB"]
+    assert cache.evictions == 1
+
+@pytest.mark.asyncio
+async def test_save_later_writes_atomically_in_background(tmp_path):
+    # Arrange
+    path = tmp_path / "cache.json"
+    cache = CarbonCache(str(path), timedelta(minutes=30))
+
+    # Act
+    for i in range(5):
+        cache.put(f"zone{i}", float(i))
+    written_before_flush = path.exists()
+    await cache.flush()
+
+    # Assert
+    assert not written_before_flush
+    assert set(json.loads(path.read_text())) == {f"zone{i}" for i in range(5)}
+    assert not (tmp_path / "cache.json.tmp").exists()
+
+    reloaded = CarbonCache(str(path), timedelta(minutes=30))
+    reloaded.load()
+    assert reloaded.get("zone3")[0] == 3.0
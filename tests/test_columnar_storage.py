@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+from datetime import datetime, timezone, timedelta
+from kasa_carbon.modules.columnar_storage import ColumnarStorage
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+
+def usage_at(device, second, power=1.0, co2emitted=2.0, co2=3.0):
+    return EnergyUsage(energy_usage_dict={"device": device, "timestamp": datetime(2024, 1, 1, 0, 0, second, tzinfo=timezone.utc),
+                                          "power_draw_watts": power, "avg_emitted_mgco2e": co2emitted,
+                                          "grid_carbon_intensity_gco2perkwhr": co2})
+
+@pytest.mark.asyncio
+async def test_write_and_read_usage(tmp_path):
+    # Arrange
+    storage = ColumnarStorage(str(tmp_path))
+
+    # Act
+    await storage.write_usage_batch([usage_at("device1", 0, 10.0), usage_at("device2", 0, 20.0, None, None)])
+    await storage.write_usage(usage_at("device1", 15, 11.0))
+    result = await storage.read_usage(last_n=2)
+    await storage.close()
+
+    # Assert
+    assert [usage.device for usage in result] == ["device2", "device1"]
+    assert result[0].avg_emitted_mgco2e is None
+    assert result[0].grid_carbon_intensity_gco2perkwhr is None
+    assert result[1].timestamp == datetime(2024, 1, 1, 0, 0, 15, tzinfo=timezone.utc)
+    assert result[1].power_draw_watts == 11.0
+
+@pytest.mark.asyncio
+async def test_read_columns_is_memory_mapped(tmp_path):
+    # Arrange
+    storage = ColumnarStorage(str(tmp_path))
+    await storage.write_usage_batch([usage_at(f"device{i % 3}", i, float(i)) for i in range(30)])
+    await storage.close()
+
+    # Act
+    reopened = ColumnarStorage(str(tmp_path))
+    data = reopened.read_columns()
+
+    # Assert
+    assert isinstance(data["power_draw_watts"], np.memmap)
+    assert data["devices"] == ["device0", "device1", "device2"]
+    assert data["power_draw_watts"].sum() == sum(range(30))
+    assert list(data["device_id"][:4]) == [0, 1, 2, 0]
+    assert (tmp_path / "power_draw_watts.bin").stat().st_size == 30 * 4
+
+@pytest.mark.asyncio
+async def test_reopen_trims_partial_append(tmp_path):
+    # Arrange
+    storage = ColumnarStorage(str(tmp_path))
+    await storage.write_usage_batch([usage_at("device1", 0), usage_at("device1", 1)])
+    await storage.close()
+    with open(tmp_path / "timestamp.bin", "ab") as f:
+        f.write(b"\x00" * 8)
+
+    # Act
+    reopened = ColumnarStorage(str(tmp_path))
+
+    # Assert
+    assert reopened.rows == 2
+    assert (tmp_path / "timestamp.bin").stat().st_size == 2 * 8
+
+@pytest.mark.asyncio
+async def test_aggregates_match_generic_implementation(tmp_path):
+    # Arrange
+    storage = ColumnarStorage(str(tmp_path))
+    await storage.write_usage_batch([usage_at(f"device{i % 3}", i, float(i), None if i % 4 == 0 else float(i)) for i in range(60)])
+    start = datetime(2024, 1, 1, 0, 0, 5, tzinfo=timezone.utc)
+    end = datetime(2024, 1, 1, 0, 0, 50, tzinfo=timezone.utc)
+
+    # Act
+    buckets = await storage.aggregate_usage(start, end, timedelta(seconds=10), agg="avg", devices=["device0", "device2"])
+    expected_buckets = await DatastoreAPI.aggregate_usage(storage, start, end, timedelta(seconds=10), agg="avg", devices=["device0", "device2"])
+    totals = await storage.usage_totals(start, end)
+    expected_totals = await DatastoreAPI.usage_totals(storage, start, end)
+    streamed = [usage async for usage in storage.iter_usage(start, end, chunk_rows=7)]
+    await storage.close()
+
+    # Assert
+    assert len(streamed) == 45
+    assert [(row["device"], row["bucket"], row["samples"]) for row in buckets] == [(row["device"], row["bucket"], row["samples"]) for row in expected_buckets]
+    for row, expected in zip(buckets, expected_buckets):
+        assert row["power_draw_watts"] == pytest.approx(expected["power_draw_watts"])
+        assert row["avg_emitted_mgco2e"] == pytest.approx(expected["avg_emitted_mgco2e"])
+    assert totals.keys() == expected_totals.keys()
+    for device, total in totals.items():
+        assert total["samples"] == expected_totals[device]["samples"]
+        assert total["energy_wh"] == pytest.approx(expected_totals[device]["energy_wh"])
+        assert total["emitted_mgco2e"] == pytest.approx(expected_totals[device]["emitted_mgco2e"])
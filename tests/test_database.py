@@ -1,9 +1,11 @@
 # FILEPATH: /C:/Users/scott/source/repos/kasa_carbon/tests/test_database.py
 
+import asyncio
 import pytest
 import asyncpg
 import os
-from unittest.mock import patch, AsyncMock, Mock
+from datetime import datetime, timezone, timedelta
+from unittest.mock import patch, AsyncMock, Mock, MagicMock
 from kasa_carbon.modules.database import Database
 from kasa_carbon.modules.energy_usage import EnergyUsage
 
@@ -24,46 +26,155 @@ async def setup_method():
     await conn.close()
     print("Tearing down")
 
+def mock_pool():
+    conn = AsyncMock()
+    pool = MagicMock()
+    pool.acquire.return_value.__aenter__ = AsyncMock(return_value=conn)
+    pool.acquire.return_value.__aexit__ = AsyncMock(return_value=None)
+    pool.close = AsyncMock()
+    pool.expire_connections = AsyncMock()
+    return pool, conn
+
 @pytest.mark.asyncio
 async def test_write_usage(energy_usage_test_data):
     # Arrange
     db_config = {"user": "test", "password": "test", "database": "test", "host": "localhost"}
-    db = Database(db_config)
-    with patch('asyncpg.connect', new_callable=AsyncMock) as mock_connect:
-        mock_connect.return_value.execute = AsyncMock()
-        mock_connect.return_value.is_closed = Mock(return_value=False)
-        mock_connect.return_value.close = AsyncMock()
+    db = Database(db_config, min_pool_size=2, max_pool_size=5, manage_partitions=False)
+    pool, conn = mock_pool()
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool) as mock_create_pool:
 
         # Act
         await db.write_usage(energy_usage_test_data)
-        
+        await db.write_usage(energy_usage_test_data)
+        await db.close()
+
         # Assert
-        mock_connect.assert_called_once_with(**db_config)
+        mock_create_pool.assert_called_once_with(**db_config, min_size=2, max_size=5)
         expected_query = db._generate_insert_sql_query(energy_usage_test_data)
-        mock_connect.return_value.execute.assert_called_once_with(
+        assert conn.execute.await_count == 2
+        conn.execute.assert_called_with(
             expected_query,
             *energy_usage_test_data.get_dict().values()
         )
-        mock_connect.return_value.close.assert_called_once()
+        pool.close.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_concurrent_connects_create_one_pool():
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"})
+    pool, conn = mock_pool()
+    async def slow_create_pool(**kwargs):
+        await asyncio.sleep(0.05)
+        return pool
+
+    # Act
+    with patch('asyncpg.create_pool', side_effect=slow_create_pool) as create_pool:
+        pools = await asyncio.gather(*[db.connect() for _ in range(5)])
+
+    # Assert
+    create_pool.assert_called_once()
+    assert all(connected is pool for connected in pools)
 
 @pytest.mark.asyncio
 async def test_read_usage():
     # Arrange
     db_config = {"user": "test", "password": "test", "database": "test", "host": "localhost"}
     db = Database(db_config)
+    pool, conn = mock_pool()
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool) as mock_create_pool:
+        await db.read_usage(10)
+
+    # Assert
+    mock_create_pool.assert_called_once_with(**db_config, min_size=1, max_size=10)
+    expected_query = db._generate_select_sql_query()
+    conn.fetch.assert_called_once_with(expected_query, 10)
+    assert "LIMIT $1" in expected_query
+
+@pytest.mark.asyncio
+async def test_read_usage_sees_buffered_readings(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=100, manage_partitions=False)
+    pool, conn = mock_pool()
 
     # Act
-    with patch('asyncpg.connect', new_callable=AsyncMock) as mock_connect:
-        mock_connect.return_value.fetch = AsyncMock()
-        mock_connect.return_value.is_closed = Mock(return_value=False)
-        mock_connect.return_value.close = AsyncMock()
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
         await db.read_usage(10)
 
     # Assert
-    mock_connect.assert_called_once_with(**db_config)
-    expected_query = db._generate_select_sql_query(10)
-    mock_connect.return_value.fetch.assert_called_once_with(expected_query)
-    mock_connect.return_value.close.assert_called_once()
+    assert db.buffer == []
+    assert [call[0] for call in conn.method_calls] == ["copy_records_to_table", "fetch"]
+
+@pytest.mark.asyncio
+async def test_iter_usage_uses_parameterized_server_side_cursor():
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, manage_partitions=False)
+    pool, conn = mock_pool()
+    conn.transaction = MagicMock()
+    conn.transaction.return_value.__aenter__ = AsyncMock(return_value=None)
+    conn.transaction.return_value.__aexit__ = AsyncMock(return_value=None)
+    timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    async def cursor(query, *args, prefetch):
+        for power in (1.0, 2.0):
+            yield {"device": "device1", "power_draw_watts": power}
+    conn.cursor = MagicMock(side_effect=cursor)
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        result = [usage async for usage in db.iter_usage(start=timestamp, devices=["device1"], columns=["device", "power_draw_watts"], prefetch=50)]
+
+    # Assert
+    conn.cursor.assert_called_once_with(
+        "SELECT device, power_draw_watts FROM energy_usage WHERE timestamp >= $1 AND device = ANY($2::varchar[]) ORDER BY timestamp",
+        timestamp, ["device1"], prefetch=50)
+    assert [usage.power_draw_watts for usage in result] == [1.0, 2.0]
+    assert result[0].timestamp is None
+
+@pytest.mark.asyncio
+async def test_aggregate_usage_is_pushed_down():
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, manage_partitions=False)
+    pool, conn = mock_pool()
+    conn.fetch.return_value = [{"device": "device1", "samples": 2, "energy_wh": 1.5, "emitted_mgco2e": 3.0}]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.aggregate_usage(start, end, timedelta(hours=1), agg="max")
+        aggregate_args = conn.fetch.call_args.args
+        totals = await db.usage_totals(start, end, devices=["device1"])
+        totals_args = conn.fetch.call_args.args
+
+    # Assert
+    assert "date_bin($1::interval" in aggregate_args[0]
+    assert "max(power_draw_watts)" in aggregate_args[0]
+    assert aggregate_args[1:] == (timedelta(hours=1), start, end)
+    assert "lag(timestamp)" in totals_args[0]
+    assert totals_args[1:] == (start, end, ["device1"])
+    assert totals == {"device1": {"samples": 2, "energy_wh": 1.5, "emitted_mgco2e": 3.0}}
+    with pytest.raises(ValueError):
+        await db.aggregate_usage(start, end, timedelta(hours=1), agg="median; DROP TABLE energy_usage")
+    with pytest.raises(ValueError):
+        db._generate_select_sql_query(columns=["device", "1; DROP TABLE energy_usage"])
+
+@pytest.mark.asyncio
+async def test_write_usage_reconnects_after_server_restart(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, manage_partitions=False)
+    pool, conn = mock_pool()
+    conn.execute.side_effect = [asyncpg.exceptions.ConnectionDoesNotExistError("connection was closed"), None]
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage(energy_usage_test_data)
+
+    # Assert
+    pool.expire_connections.assert_awaited_once()
+    assert conn.execute.await_count == 2
 
 @pytest.mark.asyncio
 @pytest.mark.real_database
@@ -125,4 +236,264 @@ async def test_read_usage_realdb(energy_usage_test_data):
     try:
         await conn.execute("DELETE FROM energy_usage")
     finally:
-        await conn.close()
\ No newline at end of file
+        await conn.close()
+
+def real_db_config():
+    return {
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "database": os.getenv("DB_NAME"),
+        "host": os.getenv("DB_HOST"),
+        "port": os.getenv("DB_PORT"),
+    }
+
+@pytest.mark.asyncio
+@pytest.mark.real_database
+async def test_reading_without_partition_moves_into_partition_once_created_realdb():
+    # Arrange
+    timestamp = datetime(2031, 5, 10, tzinfo=timezone.utc)
+    conn = await asyncpg.connect(**real_db_config())
+    try:
+        await conn.execute("DROP TABLE IF EXISTS energy_usage_2031_05")
+        await conn.execute("INSERT INTO energy_usage VALUES ('partition_test', $1, 10.0, 1.0, 100.0)", timestamp)
+        in_default = await conn.fetchval("SELECT tableoid::regclass::text FROM energy_usage WHERE device = 'partition_test'")
+
+        # Act
+        await conn.execute("SELECT ensure_energy_usage_partition($1)", timestamp)
+        await conn.execute("SELECT ensure_energy_usage_partition($1)", timestamp)
+        in_partition = await conn.fetchval("SELECT tableoid::regclass::text FROM energy_usage WHERE device = 'partition_test'")
+        rows = await conn.fetchval("SELECT count(*) FROM energy_usage WHERE device = 'partition_test'")
+
+        # Assert
+        assert in_default == "energy_usage_default"
+        assert in_partition == "energy_usage_2031_05"
+        assert rows == 1
+    finally:
+        await conn.execute("DELETE FROM energy_usage WHERE device = 'partition_test'")
+        await conn.execute("DROP TABLE IF EXISTS energy_usage_2031_05")
+        for rollup in ("energy_usage_1m", "energy_usage_1h", "energy_usage_1d"):
+            await conn.execute(f"DELETE FROM {rollup} WHERE device = 'partition_test'")
+        await conn.close()
+
+@pytest.mark.asyncio
+@pytest.mark.real_database
+async def test_rollups_follow_inserts_and_carbon_updates_realdb():
+    # Arrange
+    db = Database(real_db_config(), batch_size=3)
+    start = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+    usages = [EnergyUsage(energy_usage_dict={"device": "rollup_test", "timestamp": start + timedelta(seconds=20 * i),
+                                             "power_draw_watts": 10.0 * (i + 1), "avg_emitted_mgco2e": None,
+                                             "grid_carbon_intensity_gco2perkwhr": None}) for i in range(3)]
+    try:
+        # Act
+        await db.write_usage_batch(usages)
+        inserted = await db._run(lambda conn: conn.fetchrow("SELECT * FROM energy_usage_1m WHERE device = 'rollup_test'"))
+        for usage in usages:
+            usage.avg_emitted_mgco2e = 2.0
+            usage.grid_carbon_intensity_gco2perkwhr = 300.0
+        await db.update_carbon_batch(usages)
+        hourly = await db._run(lambda conn: conn.fetchrow("SELECT * FROM energy_usage_1h WHERE device = 'rollup_test'"))
+
+        # Assert
+        assert inserted["bucket"] == start
+        assert inserted["sample_count"] == 3
+        assert inserted["sum_power_draw_watts"] == pytest.approx(60.0)
+        assert inserted["max_power_draw_watts"] == pytest.approx(30.0)
+        assert inserted["sum_emitted_mgco2e"] is None
+        assert hourly["sample_count"] == 3
+        assert hourly["sum_emitted_mgco2e"] == pytest.approx(6.0)
+    finally:
+        await db._run(lambda conn: conn.execute("DELETE FROM energy_usage WHERE device = 'rollup_test'"))
+        for rollup in ("energy_usage_1m", "energy_usage_1h", "energy_usage_1d"):
+            await db._run(lambda conn: conn.execute(f"DELETE FROM {rollup} WHERE device = 'rollup_test'"))
+        await db.close()
+
+@pytest.mark.asyncio
+async def test_write_usage_batch_uses_copy(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=3, manage_partitions=False)
+    pool, conn = mock_pool()
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+        buffered = len(db.buffer)
+        await db.write_usage(energy_usage_test_data)
+
+    # Assert
+    assert buffered == 2
+    assert db.buffer == []
+    conn.execute.assert_not_called()
+    conn.copy_records_to_table.assert_awaited_once_with(
+        "energy_usage",
+        records=[tuple(energy_usage_test_data.get_dict().values())] * 3,
+        columns=EnergyUsage.KEYS
+    )
+
+@pytest.mark.asyncio
+async def test_close_flushes_buffer(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=100, flush_interval_sec=60)
+    pool, conn = mock_pool()
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+        await db.close()
+
+    # Assert
+    conn.copy_records_to_table.assert_awaited_once()
+    pool.close.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_close_during_periodic_flush_keeps_readings(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=100,
+                  flush_interval_sec=0.05, manage_partitions=False)
+    pool, conn = mock_pool()
+    copied = []
+    async def slow_copy(table, records, columns):
+        await asyncio.sleep(0.2)
+        copied.extend(records)
+    conn.copy_records_to_table.side_effect = slow_copy
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+        await asyncio.sleep(0.1)
+        await db.close()
+
+    # Assert
+    assert len(copied) == 2
+    assert db.buffer == []
+    pool.close.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_cancelled_flush_keeps_buffer(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=2, manage_partitions=False)
+    pool, conn = mock_pool()
+    async def stalled_copy(table, records, columns):
+        await asyncio.sleep(1)
+    conn.copy_records_to_table.side_effect = stalled_copy
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(db.write_usage_batch([energy_usage_test_data, energy_usage_test_data]), 0.05)
+
+    # Assert
+    assert len(db.buffer) == 2
+
+@pytest.mark.asyncio
+async def test_flush_failure_keeps_buffer(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=2)
+    pool, conn = mock_pool()
+    conn.copy_records_to_table.side_effect = asyncpg.exceptions.CannotConnectNowError("the database system is starting up")
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        with pytest.raises(asyncpg.exceptions.CannotConnectNowError):
+            await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+
+    # Assert
+    assert len(db.buffer) == 2
+
+@pytest.mark.asyncio
+async def test_flush_rejected_by_database_drops_batch(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=2, max_buffer_size=2,
+                  manage_partitions=False)
+    pool, conn = mock_pool()
+    conn.copy_records_to_table.side_effect = [asyncpg.exceptions.InsufficientPrivilegeError("permission denied"), None]
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        with pytest.raises(asyncpg.exceptions.InsufficientPrivilegeError):
+            await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+        await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+
+    # Assert
+    assert db.buffer == []
+    assert db.dropped_rows == 2
+    assert conn.copy_records_to_table.await_count == 2
+
+@pytest.mark.asyncio
+async def test_flush_of_already_stored_readings_skips_them(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=2, manage_partitions=False)
+    pool, conn = mock_pool()
+    conn.copy_records_to_table.side_effect = asyncpg.exceptions.UniqueViolationError("duplicate key")
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+
+    # Assert
+    assert db.buffer == []
+    sql_query, *columns = conn.execute.await_args.args
+    assert sql_query == Database.INSERT_IGNORE_SQL_QUERY
+    assert columns == [[value, value] for value in energy_usage_test_data.as_tuple()]
+
+@pytest.mark.asyncio
+async def test_write_usage_batch_idempotent_bypasses_buffer(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=100, manage_partitions=False)
+    pool, conn = mock_pool()
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch_idempotent([energy_usage_test_data])
+
+    # Assert
+    assert db.buffer == []
+    assert "ON CONFLICT (device, timestamp) DO NOTHING" in conn.execute.await_args.args[0]
+    conn.copy_records_to_table.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_write_usage_batch_backpressure(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=100, max_buffer_size=2)
+    pool, conn = mock_pool()
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch([energy_usage_test_data, energy_usage_test_data])
+        await db.write_usage(energy_usage_test_data)
+
+    # Assert
+    conn.copy_records_to_table.assert_awaited_once()
+    assert len(db.buffer) == 1
+
+@pytest.mark.asyncio
+async def test_flush_creates_partitions_once_per_month(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=2)
+    pool, conn = mock_pool()
+    next_month = EnergyUsage(energy_usage_dict={**energy_usage_test_data.get_dict(), "timestamp": datetime(2022, 2, 1, tzinfo=timezone.utc)})
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch([energy_usage_test_data, next_month])
+        await db.write_usage_batch([energy_usage_test_data, next_month])
+
+    # Assert
+    partition_calls = [call.args for call in conn.execute.await_args_list if "ensure_energy_usage_partition" in call.args[0]]
+    assert [args[1] for args in partition_calls] == [datetime(2022, 1, 1, tzinfo=timezone.utc), datetime(2022, 2, 1, tzinfo=timezone.utc)]
+    assert conn.copy_records_to_table.await_count == 2
+
+@pytest.mark.asyncio
+async def test_unpartitioned_schema_disables_partition_management(energy_usage_test_data):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"})
+    pool, conn = mock_pool()
+    conn.execute.side_effect = [asyncpg.exceptions.UndefinedFunctionError("function does not exist"), None]
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage(energy_usage_test_data)
+
+    # Assert
+    assert db.manage_partitions is False
+    conn.execute.assert_called_with(db.insert_sql_query, *energy_usage_test_data.get_dict().values())
@@ -0,0 +1,47 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+from kasa_carbon.modules.deadband_storage import DeadbandStorage
+from kasa_carbon.modules.file_storage import FileStorage
+from kasa_carbon.modules.energy_usage import EnergyUsage
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def usage_at(second, power, co2emitted=1.0, co2=100.0, device="device1"):
+    return EnergyUsage(device, power, co2emitted, co2, timestamp=START + timedelta(seconds=second))
+
+@pytest.mark.asyncio
+async def test_unchanged_readings_are_suppressed_and_emissions_carried(tmp_path):
+    # Arrange
+    inner = FileStorage(str(tmp_path / "energy_usage.csv"))
+    store = DeadbandStorage(inner, power_abs_watts=1.0, heartbeat=timedelta(minutes=10))
+    powers = [0.0, 0.0, 0.5, 0.0, 0.0, 60.0, 60.2, 60.0]
+
+    # Act
+    for i, power in enumerate(powers):
+        await store.write_usage_batch([usage_at(15 * i, power)])
+    await store.close()
+    result = await inner.read_usage_range(START, START + timedelta(hours=1))
+
+    # Assert
+    #the first reading, the last reading before the change (carrying the suppressed emissions), the change and the held tail
+    assert [(usage.timestamp - START).seconds for usage in result] == [0, 60, 75, 105]
+    assert [usage.avg_emitted_mgco2e for usage in result] == [1.0, 4.0, 1.0, 2.0]
+    assert sum(usage.avg_emitted_mgco2e for usage in result) == len(powers)
+    assert store.suppressed_rows == 4
+
+@pytest.mark.asyncio
+async def test_heartbeat_and_intensity_changes_are_written(tmp_path):
+    # Arrange
+    inner = FileStorage(str(tmp_path / "energy_usage.csv"))
+    store = DeadbandStorage(inner, intensity_rel=0.1, heartbeat=timedelta(minutes=1))
+
+    # Act
+    await store.write_usage_batch([usage_at(0, 5.0), usage_at(0, 7.0, device="device2")])
+    await store.write_usage_batch([usage_at(30, 5.0), usage_at(30, 7.0, device="device2", co2=105.0)])
+    await store.write_usage_batch([usage_at(60, 5.0), usage_at(60, 7.0, device="device2", co2=120.0)])
+    result = await inner.read_usage(last_n=10)
+    await store.close()
+
+    # Assert
+    assert [(usage.device, (usage.timestamp - START).seconds, usage.avg_emitted_mgco2e) for usage in result] == [
+        ("device1", 0, 1.0), ("device2", 0, 1.0), ("device1", 60, 2.0), ("device2", 30, 1.0), ("device2", 60, 1.0)]
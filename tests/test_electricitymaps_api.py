@@ -1,4 +1,6 @@
+import asyncio
 import pytest
+import pytest_asyncio
 import os
 from unittest.mock import patch, AsyncMock
 from kasa_carbon.modules.electricitymaps_api import ElectricityMapAPI
@@ -47,4 +49,125 @@ async def test_get_co2_by_gridid_uses_cache():
     result2 = await api.get_co2_by_gridid(grid_id)
 
     # Assert
-    assert result1 == result2  # The results should be the same
\ No newline at end of file
+    assert result1 == result2  # The results should be the same
+
+@pytest_asyncio.fixture
+async def fake_em_server():
+    from aiohttp import web
+    requests = []
+    failures = []
+
+    async def latest(request):
+        requests.append(dict(request.query))
+        await asyncio.sleep(0.05)
+        if failures:
+            failures.pop()
+            raise web.HTTPServiceUnavailable()
+        updated_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return web.json_response({"zone": request.query.get("zone"), "carbonIntensity": 321, "updatedAt": updated_at})
+
+    app = web.Application()
+    app.router.add_get("/latest", latest)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    yield f"http://127.0.0.1:{port}", requests, failures
+    await runner.cleanup()
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_are_coalesced(fake_em_server, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    base_url, requests, _ = fake_em_server
+    api = ElectricityMapAPI(em_api_key="test", clear_cache=True, background_refresh=False)
+    api.BASE_URL = base_url + "/latest"
+
+    # Act
+    results = await asyncio.gather(*[api.get_co2_by_gridid("DE") for _ in range(10)])
+    session = api._session
+    await api.get_co2_by_gridid("FR")
+    await api.close()
+
+    # Assert
+    assert results == [321.0] * 10
+    assert requests == [{"zone": "DE"}, {"zone": "FR"}]
+    assert session.closed
+    assert api._in_flight == {}
+
+def test_cache_expiry_is_in_minutes(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+
+    # Act
+    api = ElectricityMapAPI(em_api_key="test", clear_cache=True, em_cache_expiry_mins=30)
+
+    # Assert
+    assert api.CACHE_EXPIRY == timedelta(minutes=30)
+
+@pytest.mark.asyncio
+async def test_stale_value_served_while_refreshing(fake_em_server, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    base_url, requests, _ = fake_em_server
+    api = ElectricityMapAPI(em_api_key="test", clear_cache=True)
+    api.BASE_URL = base_url + "/latest"
+    api.cache.put("DE", 100.0, fetched_at=datetime.now(timezone.utc) - timedelta(hours=1))
+
+    # Act
+    start = asyncio.get_running_loop().time()
+    stale = await api.get_co2_by_gridid("DE")
+    elapsed = asyncio.get_running_loop().time() - start
+    await asyncio.sleep(0.2)
+    refreshed = await api.get_co2_by_gridid("DE")
+    await api.close()
+
+    # Assert
+    assert stale == 100.0
+    assert elapsed < 0.05
+    assert refreshed == 321.0
+    assert len(requests) == 1
+    assert api.cache_stats()["stale_hits"] == 1
+    assert api.cache_stats()["misses"] == 0
+
+@pytest.mark.asyncio
+async def test_background_refresh_before_expiry(fake_em_server, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    base_url, requests, _ = fake_em_server
+    api = ElectricityMapAPI(em_api_key="test", clear_cache=True)
+    api.BASE_URL = base_url + "/latest"
+    api.cache.expiry = timedelta(seconds=0.4)
+    api.refresh_margin = timedelta(seconds=0.2)
+
+    # Act
+    await api.get_co2_by_gridid("DE")
+    await asyncio.sleep(0.6)
+    await api.close()
+
+    # Assert
+    assert len(requests) >= 3
+    assert api.cache.stats()["misses"] == 1
+
+@pytest.mark.asyncio
+async def test_background_refresh_backs_off_on_errors(fake_em_server, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    base_url, requests, failures = fake_em_server
+    api = ElectricityMapAPI(em_api_key="test", clear_cache=True)
+    api.BASE_URL = base_url + "/latest"
+    api.cache.put("DE", 100.0, fetched_at=datetime.now(timezone.utc) - timedelta(hours=1))
+    failures.append(True)
+
+    # Act
+    value = await api.get_co2_by_gridid("DE")
+    await asyncio.sleep(0.2)
+    second_value = await api.get_co2_by_gridid("DE")
+    await asyncio.sleep(0.1)
+    await api.close()
+
+    # Assert
+    assert value == second_value == 100.0
+    assert len(requests) == 1
+    assert api._backoff["DE"][0] == timedelta(seconds=10)
@@ -2,26 +2,46 @@ import asyncio
 import pytest
 from unittest.mock import patch, mock_open, call
 from kasa_carbon.modules.file_storage import FileStorage
+from kasa_carbon.modules.file_segments import open_segment
 from kasa_carbon.modules.energy_usage import EnergyUsage
 import os
+from datetime import datetime, timezone, timedelta
 
 @pytest.mark.asyncio
-async def test_read_usage():
+async def test_read_usage(tmp_path):
     # Arrange
-    file_path = "/path/to/your/file"
-    mock_file_content = ["device,timestamp,power_draw_watts,avg_emitted_mgco2e,grid_carbon_intensity_gco2perkwhr\n",
-                         "device1,2022-01-01T00:00:00Z,100,200,300\n",
-                         "device2,2022-01-01T00:00:01Z,110,210,310\n"]
+    file_path = tmp_path / "energy_usage.csv"
+    file_path.write_text("device,timestamp,power_draw_watts,avg_emitted_mgco2e,grid_carbon_intensity_gco2perkwhr\n"
+                         "device1,2022-01-01T00:00:00Z,100,200,300\n"
+                         "device2,2022-01-01T00:00:01Z,110,210,\n")
 
     # Act
-    with patch("builtins.open", mock_open(read_data="".join(mock_file_content))) as mock_file, \
-         patch("os.path.isfile", return_value=True):
-        file_storage = FileStorage(file_path, "append")
-        result = await file_storage.read_usage()
+    file_storage = FileStorage(str(file_path), "append")
+    result = await file_storage.read_usage()
+
+    # Assert
+    assert [usage.device for usage in result] == ["device1", "device2"]
+    assert result[0].timestamp == datetime(2022, 1, 1, tzinfo=timezone.utc)
+    assert result[0].power_draw_watts == 100.0
+    assert result[1].grid_carbon_intensity_gco2perkwhr is None
+
+@pytest.mark.asyncio
+async def test_read_usage_tail_of_large_file(tmp_path):
+    # Arrange
+    file_path = tmp_path / "energy_usage.csv"
+    file_storage = FileStorage(str(file_path), "append")
+    await file_storage.write_usage_batch([EnergyUsage(f"device{i}", i, i, i) for i in range(5000)])
+
+    # Act
+    result = await file_storage.read_usage(last_n=3, columns=["device", "power_draw_watts"])
+    lines = file_storage._read_last_lines(3, block_size=64)
+    await file_storage.close()
 
     # Assert
-    mock_file.assert_called_once_with(file_path, 'r')
-    assert result == mock_file_content
+    assert [usage.device for usage in result] == ["device4997", "device4998", "device4999"]
+    assert [usage.power_draw_watts for usage in result] == [4997.0, 4998.0, 4999.0]
+    assert all(usage.timestamp is None and usage.avg_emitted_mgco2e is None for usage in result)
+    assert [line.split(",")[0] for line in lines] == ["device4997", "device4998", "device4999"]
 
 @pytest.mark.asyncio
 async def test_write_usage_append_mode():
@@ -38,7 +58,7 @@ async def test_write_usage_append_mode():
         await file_storage.write_usage(energy_usage)
 
     # Assert
-    mock_file.assert_called_once_with(file_path, 'a', newline='')
+    mock_file.assert_called_once_with(file_path, 'a', newline='', buffering=64 * 1024)
     mock_file().write.assert_called_once_with(','.join(map(str, energy_usage.get_dict().values())) + '\r\n')
 
 @pytest.mark.asyncio
@@ -56,5 +76,234 @@ async def test_write_usage_overwrite_mode():
         await file_storage.write_usage(energy_usage)
 
     # Assert
-    mock_file.assert_called_once_with(file_path, 'w',  newline='')
-    mock_file().write.assert_called_once_with(','.join(map(str, energy_usage.get_dict().values())) + '\r\n')
\ No newline at end of file
+    mock_file.assert_called_once_with(file_path, 'w', newline='', buffering=64 * 1024)
+    mock_file().write.assert_called_once_with(','.join(map(str, energy_usage.get_dict().values())) + '\r\n')
+
+@pytest.mark.asyncio
+async def test_write_usage_keeps_file_open(tmp_path):
+    # Arrange
+    file_path = tmp_path / "energy_usage.csv"
+    file_storage = FileStorage(str(file_path), "append")
+
+    # Act
+    with patch("builtins.open", wraps=open) as mock_file:
+        for i in range(5):
+            await file_storage.write_usage(EnergyUsage(f"device{i}", 100, 200, 300))
+        await file_storage.close()
+
+    # Assert
+    mock_file.assert_called_once()
+    lines = file_path.read_text().splitlines()
+    assert len(lines) == 6
+    assert lines[0] == ",".join(EnergyUsage.keys())
+
+@pytest.mark.asyncio
+async def test_write_usage_batch_overwrite_keeps_whole_cycle(tmp_path):
+    # Arrange
+    file_path = tmp_path / "energy_usage.csv"
+    file_storage = FileStorage(str(file_path), "overwrite")
+
+    # Act
+    await file_storage.write_usage_batch([EnergyUsage("device1", 1, 2, 3), EnergyUsage("device2", 1, 2, 3)])
+    await file_storage.write_usage_batch([EnergyUsage("device1", 4, 5, 6), EnergyUsage("device2", 4, 5, 6)])
+    await file_storage.close()
+
+    # Assert
+    lines = file_path.read_text().splitlines()
+    assert [line.split(",")[0] for line in lines] == ["device1", "device2"]
+    assert all(line.split(",")[2] == "4" for line in lines)
+
+@pytest.mark.asyncio
+async def test_write_usage_rows_durability(tmp_path):
+    # Arrange
+    file_path = tmp_path / "energy_usage.csv"
+    file_storage = FileStorage(str(file_path), "append", durability="rows", flush_rows=3)
+
+    # Act
+    await file_storage.write_usage_batch([EnergyUsage("device1", 1, 2, 3), EnergyUsage("device2", 1, 2, 3)])
+    lines_before_flush = len(file_path.read_text().splitlines())
+    await file_storage.write_usage(EnergyUsage("device3", 1, 2, 3))
+    lines_after_flush = len(file_path.read_text().splitlines())
+    await file_storage.close()
+
+    # Assert
+    assert lines_before_flush == 1
+    assert lines_after_flush == 4
+
+@pytest.mark.asyncio
+async def test_write_usage_interval_durability_flushes_without_another_write(tmp_path):
+    # Arrange
+    file_path = tmp_path / "energy_usage.csv"
+    file_storage = FileStorage(str(file_path), "append", durability="interval", flush_interval_sec=0.05)
+
+    # Act
+    await file_storage.write_usage(EnergyUsage("device1", 1, 2, 3))
+    lines_before_flush = len(file_path.read_text().splitlines())
+    await asyncio.sleep(0.2)
+    lines_after_flush = len(file_path.read_text().splitlines())
+    await file_storage.close()
+
+    # Assert
+    assert lines_before_flush == 1
+    assert lines_after_flush == 2
+    assert file_storage._flush_task is None
+
+@pytest.mark.asyncio
+async def test_write_usage_fsync_durability(tmp_path):
+    # Arrange
+    file_storage = FileStorage(str(tmp_path / "energy_usage.csv"), "append", durability="fsync")
+
+    # Act
+    with patch("os.fsync") as mock_fsync:
+        await file_storage.write_usage_batch([EnergyUsage("device1", 1, 2, 3), EnergyUsage("device2", 1, 2, 3)])
+
+    # Assert
+    mock_fsync.assert_called_once()
+    await file_storage.close()
+
+def test_invalid_durability(tmp_path):
+    with pytest.raises(ValueError):
+        FileStorage(str(tmp_path / "energy_usage.csv"), durability="never")
+
+def usage_at(device, timestamp):
+    return EnergyUsage(energy_usage_dict={"device": device, "timestamp": timestamp, "power_draw_watts": 1.0,
+                                          "avg_emitted_mgco2e": 2.0, "grid_carbon_intensity_gco2perkwhr": 3.0})
+
+@pytest.mark.asyncio
+async def test_rotate_hourly_with_compression_and_retention(tmp_path):
+    # Arrange
+    file_path = str(tmp_path / "energy_usage.csv")
+    file_storage = FileStorage(file_path, "append", rotate_period="hourly", compression="gzip", max_segments=2)
+
+    # Act
+    for hour in range(4):
+        await file_storage.write_usage_batch([usage_at("device1", datetime(2024, 1, 1, hour, 0, tzinfo=timezone.utc)),
+                                              usage_at("device2", datetime(2024, 1, 1, hour, 30, tzinfo=timezone.utc))])
+    await file_storage.close()
+
+    # Assert
+    segments = file_storage.manifest.segments
+    assert [os.path.basename(segment["path"]) for segment in segments] == ["energy_usage.20240101T010000.csv.gz",
+                                                                           "energy_usage.20240101T020000.csv.gz"]
+    assert not os.path.exists(tmp_path / "energy_usage.20240101T000000.csv.gz")
+    assert segments[0]["rows"] == 2
+    with open_segment(segments[0]["path"]) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == ",".join(EnergyUsage.keys())
+    assert len(lines) == 3
+    assert [usage.device for usage in await file_storage.read_usage()] == ["device1", "device2"]
+
+@pytest.mark.asyncio
+async def test_rotate_by_size_and_segments_for_range(tmp_path):
+    # Arrange
+    file_path = str(tmp_path / "energy_usage.csv")
+    file_storage = FileStorage(file_path, "append", rotate_bytes=200)
+
+    # Act
+    for day in range(1, 6):
+        await file_storage.write_usage_batch([usage_at(f"device{i}", datetime(2024, 1, day, tzinfo=timezone.utc)) for i in range(2)])
+    await file_storage.close()
+    reopened = FileStorage(file_path, "append", rotate_bytes=200)
+
+    # Assert
+    assert len(file_storage.manifest.segments) > 1
+    in_range = reopened.segments_for_range(datetime(2024, 1, 5, tzinfo=timezone.utc), None)
+    assert in_range[-1] == file_path
+    assert len(in_range) < len(file_storage.manifest.segments) + 1
+    assert reopened._active_rows > 0
+
+@pytest.mark.asyncio
+async def test_rotate_twice_within_one_second_keeps_every_segment(tmp_path):
+    # Arrange
+    file_path = str(tmp_path / "energy_usage.csv")
+    file_storage = FileStorage(file_path, "append", rotate_bytes=100)
+    timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    # Act
+    for batch in range(3):
+        await file_storage.write_usage_batch([usage_at(f"device{batch}{i}", timestamp) for i in range(3)])
+    await file_storage.close()
+    rows = await file_storage.read_usage_range(timestamp, timestamp + timedelta(seconds=1))
+
+    # Assert
+    paths = [segment["path"] for segment in file_storage.manifest.segments]
+    assert [os.path.basename(path) for path in paths] == ["energy_usage.20240101T000000.csv", "energy_usage.20240101T000000-1.csv"]
+    assert all(os.path.exists(path) for path in paths)
+    assert sorted(usage.device for usage in rows) == [f"device{batch}{i}" for batch in range(3) for i in range(3)]
+
+@pytest.mark.asyncio
+async def test_iter_usage_survives_rotation_and_retention_while_iterating(tmp_path):
+    # Arrange
+    file_storage = FileStorage(str(tmp_path / "energy_usage.csv"), "append", rotate_period="hourly", compression="gzip", max_segments=1)
+    for hour in range(2):
+        await file_storage.write_usage_batch([usage_at(f"device{i}", datetime(2024, 1, 1, hour, tzinfo=timezone.utc)) for i in range(2)])
+
+    # Act
+    usages = file_storage.iter_usage(chunk_rows=1)
+    first = await usages.__anext__()
+    #rotates the active file away and deletes the segment being iterated
+    for hour in range(2, 4):
+        await file_storage.write_usage_batch([usage_at(f"device{i}", datetime(2024, 1, 1, hour, tzinfo=timezone.utc)) for i in range(2)])
+    rest = [usage async for usage in usages]
+    await file_storage.close()
+
+    # Assert
+    assert not os.path.exists(tmp_path / "energy_usage.20240101T000000.csv.gz")
+    assert [(usage.device, usage.timestamp.hour) for usage in [first] + rest] == [("device0", 0), ("device1", 0), ("device0", 1), ("device1", 1)]
+
+def test_rotation_requires_append_mode(tmp_path):
+    with pytest.raises(ValueError):
+        FileStorage(str(tmp_path / "energy_usage.csv"), "overwrite", rotate_period="daily")
+
+@pytest.mark.asyncio
+async def test_iter_usage_streams_filtered_rows_across_segments(tmp_path):
+    # Arrange
+    file_path = tmp_path / "energy_usage.csv"
+    file_storage = FileStorage(str(file_path), "append", rotate_period="hourly", compression="gzip")
+    usages = []
+    for minute in range(0, 180, 10):
+        for device in ("device1", "device2"):
+            usage = EnergyUsage(device, 60.0)
+            usage.timestamp = datetime(2024, 1, 1, minute // 60, minute % 60, tzinfo=timezone.utc)
+            usages.append(usage)
+    for minute in range(0, len(usages), 2):
+        await file_storage.write_usage_batch(usages[minute:minute + 2])
+
+    # Act
+    start = datetime(2024, 1, 1, 0, 30, tzinfo=timezone.utc)
+    end = datetime(2024, 1, 1, 2, 30, tzinfo=timezone.utc)
+    result = [usage async for usage in file_storage.iter_usage(start, end, devices=["device2"], columns=["device", "timestamp"], chunk_rows=4)]
+    await file_storage.close()
+
+    # Assert
+    assert len(result) == 12
+    assert all(usage.device == "device2" for usage in result)
+    assert all(start <= usage.timestamp < end for usage in result)
+    assert [usage.timestamp for usage in result] == sorted(usage.timestamp for usage in result)
+    assert result[0].power_draw_watts is None
+
+@pytest.mark.asyncio
+async def test_aggregate_usage_and_totals(tmp_path):
+    # Arrange
+    file_storage = FileStorage(str(tmp_path / "energy_usage.csv"), "append")
+    usages = []
+    for second, power in ((0, 10.0), (30, 20.0), (60, 40.0), (90, 50.0)):
+        usage = EnergyUsage("device1", power, power / 10, 100.0)
+        usage.timestamp = datetime(2024, 1, 1, 0, 0, tzinfo=timezone.utc) + timedelta(seconds=second)
+        usages.append(usage)
+    await file_storage.write_usage_batch(usages)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    end = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+    # Act
+    buckets = await file_storage.aggregate_usage(start, end, timedelta(minutes=1), agg="max")
+    totals = await file_storage.usage_totals(start, end)
+    await file_storage.close()
+
+    # Assert
+    assert [(row["bucket"].minute, row["samples"], row["power_draw_watts"]) for row in buckets] == [(0, 2, 20.0), (1, 2, 50.0)]
+    assert buckets[0]["avg_emitted_mgco2e"] == pytest.approx(3.0)
+    assert totals["device1"]["samples"] == 4
+    #the first reading has no previous reading so only the last three count, 30s each
+    assert totals["device1"]["energy_wh"] == pytest.approx((20.0 + 40.0 + 50.0) * 30 / 3600)
+    assert totals["device1"]["emitted_mgco2e"] == pytest.approx(12.0)
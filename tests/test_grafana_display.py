@@ -0,0 +1,59 @@
+import aiohttp
+import pytest
+from datetime import datetime, timezone
+from kasa_carbon.modules.grafana_display import GrafanaDisplay
+from kasa_carbon.modules.recent_readings import RecentReadings
+from kasa_carbon.modules.reading_batch import ReadingBatch
+
+TIMESTAMP = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+@pytest.mark.asyncio
+async def test_readings_json_with_etag():
+    # Arrange
+    recent = RecentReadings()
+    recent.publish(ReadingBatch(["Plug 1", "Plug 2"], TIMESTAMP, [60.0, 0.0], [1.5, 0.0], [300.0, 300.0]))
+    display = GrafanaDisplay(recent, port=0)
+    await display.start()
+    url = f"http://127.0.0.1:{display.port}/readings"
+
+    # Act
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            first = await response.json()
+            etag = response.headers["ETag"]
+        async with session.get(url, headers={"If-None-Match": etag}) as response:
+            not_modified = response.status
+        recent.publish(ReadingBatch(["Plug 1"], TIMESTAMP, [70.0]))
+        async with session.get(url, headers={"If-None-Match": etag}) as response:
+            changed = response.status
+            second = await response.json()
+    await display.close()
+
+    # Assert
+    assert first[0] == {"device": "Plug 1", "timestamp": TIMESTAMP.isoformat(), "power_draw_watts": 60.0,
+                        "avg_emitted_mgco2e": 1.5, "grid_carbon_intensity_gco2perkwhr": 300.0}
+    assert not_modified == 304
+    assert changed == 200
+    assert second[0]["power_draw_watts"] == 70.0
+
+@pytest.mark.asyncio
+async def test_prometheus_metrics():
+    # Arrange
+    recent = RecentReadings()
+    recent.publish(ReadingBatch(['Desk "A"', "Plug 2"], TIMESTAMP, [60.0, 0.0], [1.5, None], [300.0, None]))
+    display = GrafanaDisplay(recent, port=0)
+    await display.start()
+
+    # Act
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{display.port}/metrics") as response:
+            content_type = response.headers["Content-Type"]
+            lines = (await response.text()).splitlines()
+    await display.close()
+
+    # Assert
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert "# TYPE kasa_carbon_power_draw_watts gauge" in lines
+    assert 'kasa_carbon_power_draw_watts{device="Desk \\"A\\""} 60.0' in lines
+    assert 'kasa_carbon_power_draw_watts{device="Plug 2"} 0.0' in lines
+    assert not any(line.startswith('kasa_carbon_emitted_mgco2e{device="Plug 2"}') for line in lines)
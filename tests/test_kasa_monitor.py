@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 import os
 from unittest.mock import MagicMock, AsyncMock, Mock, patch
@@ -100,4 +101,226 @@ async def test_monitor_energy_use_continuously_integration(energy_usage_test_dat
     try:
         await conn.execute("DELETE FROM energy_usage")
     finally:
-        await conn.close()
\ No newline at end of file
+        await conn.close()
+
+@pytest.mark.asyncio
+async def test_monitor_energy_use_once_skips_slow_device():
+    # Arrange
+    async def slow_update():
+        await asyncio.sleep(10)
+
+    fast_device = AsyncMock()
+    fast_device.has_emeter = True
+    fast_device.alias = "Fast"
+    fast_device.emeter_realtime = {"power": 100}
+    slow_device = AsyncMock()
+    slow_device.has_emeter = True
+    slow_device.alias = "Slow"
+    slow_device.emeter_realtime = {"power": 50}
+    slow_device.update = slow_update
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE", max_concurrent_polls=2, device_timeout_sec=0.1)
+    kasa.devices = {"192.168.0.1": fast_device, "192.168.0.2": slow_device}
+
+    # Act
+    energy_values = await kasa.monitor_energy_use_once()
+
+    # Assert
+    assert energy_values == {"Fast": 100}
+    assert kasa.failed_devices == {"192.168.0.2"}
+    assert set(kasa.poll_latencies) == {"192.168.0.1", "192.168.0.2"}
+    assert kasa.poll_latencies["192.168.0.2"] >= 0.1
+
+@pytest.mark.asyncio
+async def test_monitor_energy_use_once_bounded_concurrency():
+    # Arrange
+    in_flight = 0
+    max_in_flight = 0
+
+    async def update():
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    devices = {}
+    for i in range(10):
+        device = AsyncMock()
+        device.has_emeter = True
+        device.alias = f"Device{i}"
+        device.emeter_realtime = {"power": i}
+        device.update = update
+        devices[f"192.168.0.{i}"] = device
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE", max_concurrent_polls=3)
+    kasa.devices = devices
+
+    # Act
+    energy_values = await kasa.monitor_energy_use_once()
+
+    # Assert
+    assert len(energy_values) == 10
+    assert max_in_flight == 3
+
+@pytest.mark.asyncio
+async def test_monitor_energy_use_continuously_does_not_block_event_loop():
+    # Arrange
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE")
+    kasa.monitor_energy_use_once = AsyncMock(return_value={"Device": 1000.0})
+    kasa._get_co2_data = AsyncMock(return_value=500.0)
+    db = AsyncMock()
+    ticks = 0
+
+    async def count_ticks():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    counter = asyncio.create_task(count_ticks())
+
+    # Act
+    await kasa.monitor_energy_use_continuously(db, delay=0.1, timeout=0.25)
+    counter.cancel()
+
+    # Assert
+    assert ticks >= 20
+    assert db.write_usage_batch.await_count == 4
+    db.close.assert_awaited_once()
+    # samples after the first are computed from the measured interval
+    last_usage = db.write_usage_batch.await_args_list[-1].args[0][0]
+    assert last_usage.avg_emitted_mgco2e == pytest.approx(0.1 / 3600.0 * 1.0 * 500.0 / 1000.0, rel=0.2)
+
+@pytest.mark.asyncio
+async def test_monitor_energy_use_continuously_survives_carbon_api_outage_at_startup():
+    # Arrange
+    co2_api = MagicMock()
+    co2_api.get_co2_by_gridid = AsyncMock(side_effect=ConnectionError("carbon api is down"))
+    co2_api.cache_stats.return_value = None
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE", co2_api=co2_api)
+    kasa.monitor_energy_use_once = AsyncMock(return_value={"Device": 1000.0})
+    db = AsyncMock()
+
+    # Act
+    await kasa.monitor_energy_use_continuously(db, delay=0.05, timeout=0.12)
+
+    # Assert
+    assert db.write_usage_batch.await_count >= 2
+    assert db.write_usage_batch.await_args_list[-1].args[0][0].grid_carbon_intensity_gco2perkwhr is None
+    db.close.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_monitor_energy_use_continuously_closes_when_startup_fails():
+    # Arrange
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE")
+    kasa._get_co2_data = AsyncMock(side_effect=RuntimeError("startup failed"))
+    kasa.close = AsyncMock()
+    db = AsyncMock()
+
+    # Act
+    with pytest.raises(RuntimeError):
+        await kasa.monitor_energy_use_continuously(db, delay=0.05, timeout=0.1)
+
+    # Assert
+    db.close.assert_awaited_once()
+    kasa.close.assert_awaited_once()
+
+def test_emissions_batch_integrates_each_device_over_its_own_interval():
+    # Arrange
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE")
+    kasa.sample_times = {"A": 100.0, "B": 100.0}
+    kasa.emissions_batch({"A": 100.0, "B": 50.0}, 400.0, delay=15)
+    #B missed a cycle so its next sample is 30s after its previous one
+    kasa.sample_times = {"A": 115.0, "B": 130.0}
+
+    # Act
+    batch = kasa.emissions_batch({"A": 300.0, "B": 50.0}, 400.0, delay=15)
+
+    # Assert
+    assert batch[0].avg_emitted_mgco2e == pytest.approx(15 / 3600.0 * (100.0 + 300.0) / 2 / 1000.0 * 400.0 / 1000.0)
+    assert batch[1].avg_emitted_mgco2e == pytest.approx(30 / 3600.0 * 50.0 / 1000.0 * 400.0 / 1000.0)
+    assert batch[1].grid_carbon_intensity_gco2perkwhr == 400.0
+
+@pytest.mark.parametrize("missing_intensity, expected_co2", [("null", None), ("last", 400.0)])
+def test_emissions_batch_without_intensity(missing_intensity, expected_co2):
+    # Arrange
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE", missing_intensity=missing_intensity)
+    kasa.emissions_batch({"A": 100.0}, 400.0, delay=15)
+
+    # Act
+    batch = kasa.emissions_batch({"A": 100.0}, None, delay=15)
+
+    # Assert
+    assert batch[0].grid_carbon_intensity_gco2perkwhr == expected_co2
+    assert (batch[0].avg_emitted_mgco2e is None) == (expected_co2 is None)
+    assert batch[0].power_draw_watts == 100.0
+
+def emeter_device(alias, power):
+    device = AsyncMock()
+    device.has_emeter = True
+    device.alias = alias
+    device.model = "HS110"
+    device.port = None
+    device.emeter_realtime = {"power": power}
+    return device
+
+@pytest.mark.asyncio
+async def test_startup_connects_to_registered_devices_without_discovery(tmp_path):
+    # Arrange
+    registry_path = str(tmp_path / "devices.json")
+    with patch('kasa.Discover.discover', return_value={"192.168.0.1": emeter_device("A", 10), "192.168.0.2": emeter_device("B", 20)}):
+        first_run = KasaMonitor(api_key=None, local_grid_id="DE", registry_path=registry_path)
+        await first_run.monitor_energy_use_once()
+    in_flight = 0
+    max_in_flight = 0
+
+    async def connect_single(host, port=None, timeout=None):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return emeter_device(host, 5)
+
+    # Act
+    with patch('kasa.Discover.discover') as mock_discover, patch('kasa.Discover.connect_single', side_effect=connect_single):
+        kasa = KasaMonitor(api_key=None, local_grid_id="DE", registry_path=registry_path)
+        energy_values = await kasa.monitor_energy_use_once()
+
+    # Assert
+    mock_discover.assert_not_called()
+    assert max_in_flight == 2
+    assert energy_values == {"192.168.0.1": 5, "192.168.0.2": 5}
+    assert kasa.registry.devices["192.168.0.2"]["alias"] == "B"
+
+@pytest.mark.asyncio
+async def test_empty_network_is_not_rediscovered_every_tick():
+    # Arrange
+    with patch('kasa.Discover.discover', return_value={}) as mock_discover:
+        kasa = KasaMonitor(api_key=None, local_grid_id="DE")
+
+        # Act
+        for _ in range(3):
+            await kasa.monitor_energy_use_once()
+
+    # Assert
+    mock_discover.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_rediscovery_adds_new_and_drops_unresponsive_devices(tmp_path):
+    # Arrange
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE", registry_path=str(tmp_path / "devices.json"))
+    kept = emeter_device("Kept", 1)
+    missed_by_broadcast = emeter_device("Missed", 2)
+    kasa.devices = {"192.168.0.1": kept, "192.168.0.2": missed_by_broadcast, "192.168.0.3": emeter_device("Gone", 3)}
+    kasa.failed_devices = {"192.168.0.3"}
+
+    # Act
+    with patch('kasa.Discover.discover', return_value={"192.168.0.1": emeter_device("Kept", 1), "192.168.0.4": emeter_device("New", 4)}):
+        await kasa.rediscover_devices()
+
+    # Assert
+    assert set(kasa.devices) == {"192.168.0.1", "192.168.0.2", "192.168.0.4"}
+    assert kasa.devices["192.168.0.1"] is kept
+    assert kasa.failed_devices == set()
+    assert set(kasa.registry.devices) == {"192.168.0.1", "192.168.0.4"}
+    assert os.path.exists(tmp_path / "devices.json")
@@ -0,0 +1,93 @@
+import pytest
+import time
+from unittest.mock import AsyncMock
+from kasa_carbon.modules.metrics import Histogram, InMemoryMetrics
+from kasa_carbon.modules.sampling_profiler import SamplingProfiler
+from kasa_carbon.modules.kasa_monitor import KasaMonitor
+
+def test_histogram_buckets_and_quantiles():
+    # Arrange
+    histogram = Histogram(bounds=(1, 2, 4))
+
+    # Act
+    for value in [0.5, 1.0, 1.5, 3.0, 10.0]:
+        histogram.observe(value)
+
+    # Assert
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.count == 5
+    assert histogram.mean() == pytest.approx(3.2)
+    assert histogram.quantile(0.4) == pytest.approx(1.0)
+    assert histogram.quantile(0.5) == pytest.approx(1.5)
+    assert histogram.quantile(1.0) == 4.0
+    assert Histogram().quantile(0.5) is None
+
+def test_prometheus_text():
+    # Arrange
+    metrics = InMemoryMetrics()
+    metrics.observe("write_seconds", 0.003)
+    metrics.observe("batch_size", 12, {"device": 'a "b"'})
+    metrics.increment("overrun_ticks_total", 2)
+    metrics.set_gauge("carbon_cache_hit_ratio", 0.75)
+
+    # Act
+    lines = metrics.prometheus_text().splitlines()
+
+    # Assert
+    assert "# TYPE kasa_carbon_write_seconds histogram" in lines
+    assert 'kasa_carbon_write_seconds_bucket{le="0.0025"} 0' in lines
+    assert 'kasa_carbon_write_seconds_bucket{le="0.005"} 1' in lines
+    assert 'kasa_carbon_write_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'kasa_carbon_batch_size_bucket{device="a \\"b\\"",le="20"} 1' in lines
+    assert "kasa_carbon_write_seconds_count 1" in lines
+    assert "kasa_carbon_overrun_ticks_total 2" in lines
+    assert "kasa_carbon_carbon_cache_hit_ratio 0.75" in lines
+
+@pytest.mark.asyncio
+async def test_monitor_records_stage_metrics(tmp_path):
+    # Arrange
+    metrics = InMemoryMetrics()
+    profile_path = tmp_path / "profile.folded"
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE", metrics=metrics, profile_cycles=2, profile_path=str(profile_path))
+    device = AsyncMock()
+    device.has_emeter = True
+    device.alias = "Plug"
+    device.emeter_realtime = {"power": 100}
+    failing = AsyncMock()
+    failing.update.side_effect = OSError("unreachable")
+    kasa.devices = {"192.168.0.1": device, "192.168.0.2": failing}
+    kasa._devices_started = True
+    kasa.rediscovery_interval_sec = None
+    kasa._get_co2_data = AsyncMock(return_value=500.0)
+    db = AsyncMock()
+
+    # Act
+    await kasa.monitor_energy_use_continuously(db, delay=0.05, timeout=0.12)
+
+    # Assert
+    cycles = db.write_usage_batch.await_count
+    for name in ["cycle_seconds", "poll_seconds", "carbon_lookup_seconds", "emissions_seconds", "write_seconds", "batch_size"]:
+        assert metrics.histogram(name).count == cycles
+    assert metrics.histogram("batch_size").sum == cycles
+    assert metrics.histogram("device_poll_seconds", {"device": "192.168.0.1"}).count == cycles
+    assert metrics.counter("device_poll_failures_total", {"device": "192.168.0.2"}) == cycles
+    assert profile_path.exists()
+
+def test_profiler_folds_stacks_of_the_profiled_thread(tmp_path):
+    # Arrange
+    profiler = SamplingProfiler(interval_sec=0.001)
+    path = tmp_path / "profile.folded"
+
+    # Act
+    profiler.start()
+    deadline = time.monotonic() + 0.1
+    while time.monotonic() < deadline:
+        sum(range(1000))
+    profiler.stop()
+    profiler.dump(str(path))
+
+    # Assert
+    assert profiler.samples > 0
+    lines = path.read_text().splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profiler.samples
+    assert any("test_profiler_folds_stacks_of_the_profiled_thread (test_metrics.py" in line for line in lines)
@@ -0,0 +1,57 @@
+import json
+import pytest
+from unittest.mock import AsyncMock
+from kasa_carbon.modules.multi_site import MultiSiteMonitor, load_sites_config
+from kasa_carbon.modules.electricitymaps_api import ElectricityMapAPI
+from tests.test_electricitymaps_api import fake_em_server
+
+def test_load_sites_config_rejects_unknown_options(tmp_path):
+    # Arrange
+    path = tmp_path / "sites.json"
+    path.write_text(json.dumps({"sites": [{"name": "hq", "local_grid_id": "DE", "local_zone": "FR"}]}))
+
+    # Act / Assert
+    with pytest.raises(ValueError):
+        load_sites_config(str(path))
+
+@pytest.mark.parametrize("sites", [
+    [{"name": "hq", "local_grid_id": "DE", "registry_path": "hq.json"}, {"name": "lab", "local_grid_id": "DE", "discovery_target": "10.2.255.255"}],
+    [{"name": "hq", "local_grid_id": "DE", "discovery_target": "10.1.255.255"}, {"name": "lab", "local_grid_id": "DE", "discovery_target": "10.1.255.255"}]])
+def test_load_sites_config_rejects_sites_which_discover_each_others_devices(tmp_path, sites):
+    # Arrange
+    path = tmp_path / "sites.json"
+    path.write_text(json.dumps({"sites": sites}))
+
+    # Act / Assert
+    with pytest.raises(ValueError, match="discovery_target"):
+        load_sites_config(str(path))
+
+@pytest.mark.asyncio
+async def test_sites_share_carbon_client_and_datastore(fake_em_server, tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    base_url, requests, _ = fake_em_server
+    path = tmp_path / "sites.json"
+    path.write_text(json.dumps({"sites": [{"name": "hq", "local_grid_id": "DE", "discovery_target": "10.1.255.255", "device_prefix": "hq/"},
+                                          {"name": "lab", "local_grid_id": "DE", "discovery_target": "10.2.255.255", "device_prefix": "lab/"},
+                                          {"name": "remote", "local_grid_id": "FR", "discovery_target": "10.3.255.255", "device_prefix": "remote/"}]}))
+    co2_api = ElectricityMapAPI(em_api_key="test", clear_cache=True, background_refresh=False)
+    co2_api.BASE_URL = base_url + "/latest"
+    sites = MultiSiteMonitor(load_sites_config(str(path)), co2_api=co2_api)
+    for name, monitor in sites.monitors.items():
+        device = AsyncMock()
+        device.has_emeter = True
+        device.alias = "Plug"
+        device.emeter_realtime = {"power": 100}
+        monitor.devices = {"192.168.0.1": device}
+    db = AsyncMock()
+
+    # Act
+    await sites.run(db, delay=0.1, timeout=0.15)
+
+    # Assert
+    assert sorted(request["zone"] for request in requests) == ["DE", "FR"]
+    devices = {device for call in db.write_usage_batch.await_args_list for device in call.args[0].devices}
+    assert devices == {"hq/Plug", "lab/Plug", "remote/Plug"}
+    db.close.assert_awaited_once()
+    assert co2_api._session is None or co2_api._session.closed
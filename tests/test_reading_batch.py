@@ -0,0 +1,70 @@
+import pytest
+import numpy as np
+from datetime import datetime, timezone
+from unittest.mock import patch, AsyncMock
+from kasa_carbon.modules.reading_batch import ReadingBatch, as_rows
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.file_storage import FileStorage
+from kasa_carbon.modules.columnar_storage import ColumnarStorage
+from kasa_carbon.modules.database import Database
+from tests.test_database import mock_pool
+
+TIMESTAMP = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def test_energy_usage_is_a_compact_record():
+    # Arrange
+    energy_usage = EnergyUsage("device1", 10.0, 1.0, 100.0, timestamp=TIMESTAMP)
+
+    # Act
+    values = energy_usage.as_tuple()
+
+    # Assert
+    assert not hasattr(energy_usage, "__dict__")
+    assert values == ("device1", TIMESTAMP, 10.0, 1.0, 100.0)
+    assert list(energy_usage.get_dict()) == EnergyUsage.keys()
+
+def test_batch_rows_and_items():
+    # Arrange
+    batch = ReadingBatch(["device1", "device2"], TIMESTAMP, np.array([10.0, 20.0]), [1.0, None])
+
+    # Act
+    rows = batch.rows()
+    energy_usages = list(batch)
+
+    # Assert
+    assert rows == [("device1", TIMESTAMP, 10.0, 1.0, None), ("device2", TIMESTAMP, 20.0, None, None)]
+    assert as_rows(energy_usages) == rows
+    assert batch[1].power_draw_watts == 20.0
+    assert ReadingBatch.from_energy_usages(energy_usages).rows() == rows
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("make_store", [
+    lambda tmp_path: FileStorage(str(tmp_path / "energy_usage.csv")),
+    lambda tmp_path: ColumnarStorage(str(tmp_path / "columnar")),
+], ids=["file", "columnar"])
+async def test_stores_accept_batches(tmp_path, make_store):
+    # Arrange
+    store = make_store(tmp_path)
+    batch = ReadingBatch(["device1", "device2"], TIMESTAMP, [10.0, 20.0], [1.0, 2.0], [100.0, None])
+
+    # Act
+    await store.write_usage_batch(batch)
+    result = await store.read_usage(last_n=2)
+    await store.close()
+
+    # Assert
+    assert [energy_usage.as_tuple() for energy_usage in result] == batch.rows()
+
+@pytest.mark.asyncio
+async def test_database_copies_batch():
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, manage_partitions=False)
+    pool, conn = mock_pool()
+    batch = ReadingBatch(["device1", "device2"], TIMESTAMP, [10.0, 20.0], [1.0, 2.0], [100.0, 100.0])
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=pool):
+        await db.write_usage_batch(batch)
+
+    # Assert
+    conn.copy_records_to_table.assert_awaited_once_with("energy_usage", records=batch.rows(), columns=EnergyUsage.KEYS)
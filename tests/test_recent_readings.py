@@ -0,0 +1,43 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+from unittest.mock import AsyncMock
+from kasa_carbon.modules.recent_readings import RecentReadings
+from kasa_carbon.modules.reading_batch import ReadingBatch
+from kasa_carbon.modules.kasa_monitor import KasaMonitor
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def test_ring_keeps_last_window_readings_per_device():
+    # Arrange
+    recent = RecentReadings(window=3)
+
+    # Act
+    for i in range(5):
+        recent.publish(ReadingBatch(["A", "B"], START + timedelta(seconds=i), [float(i), 10.0], [1.0, None], [100.0, None]))
+
+    # Assert
+    assert recent.latest("A").power_draw_watts == 4.0
+    assert recent.latest("A").timestamp == START + timedelta(seconds=4)
+    assert set(recent.latest()) == {"A", "B"}
+    assert recent.stats("A") == {"samples": 3, "min_power_draw_watts": 2.0, "avg_power_draw_watts": 3.0, "max_power_draw_watts": 4.0,
+                                 "sum_emitted_mgco2e": 3.0, "avg_grid_carbon_intensity_gco2perkwhr": 100.0}
+    assert recent.stats("A", last_n=2)["min_power_draw_watts"] == 3.0
+    assert recent.stats("B")["sum_emitted_mgco2e"] is None
+    assert recent.stats("C")["samples"] == 0
+    assert recent.latest("C") is None
+
+@pytest.mark.asyncio
+async def test_monitor_publishes_each_cycle():
+    # Arrange
+    kasa = KasaMonitor(api_key=None, local_grid_id="DE")
+    kasa.monitor_energy_use_once = AsyncMock(return_value={"Device": 1000.0})
+    kasa._get_co2_data = AsyncMock(return_value=500.0)
+    db = AsyncMock()
+
+    # Act
+    await kasa.monitor_energy_use_continuously(db, delay=0.05, timeout=0.12)
+
+    # Assert
+    assert kasa.recent_readings.stats("Device")["samples"] == db.write_usage_batch.await_count
+    assert kasa.recent_readings.latest("Device").grid_carbon_intensity_gco2perkwhr == 500.0
+    db.read_usage.assert_not_called()
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import threading
+import pytest
+import numpy as np
+from unittest.mock import AsyncMock, patch
+from kasa_carbon.modules.sharded_monitor import ShardedMonitor, _poll_shard, _reconnect_periodically
+from kasa_carbon.modules.kasa_monitor import KasaMonitor
+
+class FakePlug:
+    has_emeter = True
+    model = "HS110"
+    port = None
+
+    def __init__(self, host):
+        self.alias = host
+        self.emeter_realtime = {"power": float(host.rsplit(".", 1)[1])}
+
+    async def update(self):
+        pass
+
+async def connect_fake_plug(host, port=None, timeout=None):
+    return FakePlug(host)
+
+def write_registry(path, hosts):
+    with open(path, 'w') as f:
+        json.dump({host: {"host": host, "port": None, "alias": host, "model": "HS110", "children": []} for host in hosts}, f)
+
+def test_shards_split_registry_round_robin(tmp_path):
+    # Arrange
+    registry_path = str(tmp_path / "devices.json")
+    write_registry(registry_path, [f"10.0.0.{i}" for i in range(5)])
+
+    # Act
+    sharded = ShardedMonitor(2, {"api_key": None, "local_grid_id": "DE", "registry_path": registry_path})
+    shards = sharded.shards()
+
+    # Assert
+    assert [[record["host"] for record in shard] for shard in shards] == [["10.0.0.0", "10.0.0.2", "10.0.0.4"], ["10.0.0.1", "10.0.0.3"]]
+
+@pytest.mark.asyncio
+async def test_write_merges_shards_but_not_cycles_of_one_device(tmp_path):
+    # Arrange
+    registry_path = str(tmp_path / "devices.json")
+    write_registry(registry_path, [])
+    sharded = ShardedMonitor(2, {"api_key": None, "local_grid_id": "DE", "registry_path": registry_path})
+    sharded.monitor._get_co2_data = AsyncMock(return_value=500.0)
+    db = AsyncMock()
+    messages = [(["A"], np.array([1.0]), np.array([10.0])),
+                (["B"], np.array([1.0]), np.array([20.0])),
+                (["A"], np.array([16.0]), np.array([30.0]))]
+
+    # Act
+    await sharded._write(db, messages, delay=15)
+
+    # Assert
+    batches = [call.args[0] for call in db.write_usage_batch.await_args_list]
+    assert [batch.devices for batch in batches] == [["A", "B"], ["A"]]
+    assert batches[1][0].avg_emitted_mgco2e == pytest.approx(15 / 3600.0 * 20.0 / 1000.0 * 500.0 / 1000.0)
+
+@pytest.mark.asyncio
+async def test_workers_poll_their_shards_and_writer_stores_readings(tmp_path):
+    # Arrange
+    registry_path = str(tmp_path / "devices.json")
+    hosts = [f"10.0.0.{i}" for i in range(1, 7)]
+    write_registry(registry_path, hosts)
+    db = AsyncMock()
+
+    # Act
+    #forked workers inherit the patched connect_single
+    with patch('kasa.Discover.connect_single', side_effect=connect_fake_plug):
+        sharded = ShardedMonitor(3, {"api_key": None, "local_grid_id": "DE", "registry_path": registry_path}, mp_context="fork")
+        sharded.monitor._get_co2_data = AsyncMock(return_value=500.0)
+        await sharded.run(db, delay=0.2, timeout=1.0)
+
+    # Assert
+    rows = [row for call in db.write_usage_batch.await_args_list for row in call.args[0].rows()]
+    assert {row[0] for row in rows} == set(hosts)
+    assert all(row[2] == float(row[0].rsplit(".", 1)[1]) for row in rows)
+    db.close.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_workers_dont_create_a_carbon_client(tmp_path, monkeypatch):
+    # Arrange
+    monkeypatch.chdir(tmp_path)
+    registry_path = str(tmp_path / "devices.json")
+    write_registry(registry_path, ["10.0.0.1"])
+    sharded = ShardedMonitor(1, {"api_key": None, "local_grid_id": "DE", "registry_path": registry_path})
+    stop = threading.Event()
+    stop.set()
+
+    # Act
+    with patch('kasa.Discover.connect_single', side_effect=connect_fake_plug), \
+         patch('kasa_carbon.modules.kasa_monitor.ElectricityMapAPI') as electricity_map_api:
+        await _poll_shard(sharded._worker_kwargs(), sharded.shards()[0], 0.1, None, stop)
+
+    # Assert
+    electricity_map_api.assert_not_called()
+    await sharded.monitor.close()
+
+@pytest.mark.asyncio
+async def test_worker_reconnects_hosts_which_were_down():
+    # Arrange
+    shard = [{"host": f"10.0.0.{i}", "port": None} for i in range(1, 4)]
+    down = {"10.0.0.2"}
+    async def connect(host, port=None, timeout=None):
+        if host in down:
+            raise ConnectionRefusedError(host)
+        return FakePlug(host)
+    monitor = KasaMonitor(api_key=None, local_grid_id="DE", rediscovery_interval_sec=None)
+
+    # Act
+    with patch('kasa.Discover.connect_single', side_effect=connect) as connect_single:
+        await monitor.connect_known_devices(shard)
+        connected_at_start = set(monitor.devices)
+        down.clear()
+        reconnect = asyncio.create_task(_reconnect_periodically(monitor, shard, 0.05))
+        await asyncio.sleep(0.2)
+        reconnect.cancel()
+
+    # Assert
+    assert connected_at_start == {"10.0.0.1", "10.0.0.3"}
+    assert set(monitor.devices) == {"10.0.0.1", "10.0.0.2", "10.0.0.3"}
+    assert monitor.failed_devices == set()
+    assert [call.args[0] for call in connect_single.call_args_list[3:]] == ["10.0.0.2"]
+    await monitor.close()
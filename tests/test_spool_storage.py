@@ -0,0 +1,253 @@
+import asyncio
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+from datetime import datetime, timezone, timedelta
+from kasa_carbon.interfaces.datastore_api import DatastoreAPI
+from kasa_carbon.modules.spool_storage import SpoolStorage
+from kasa_carbon.modules.database import Database
+from kasa_carbon.modules.energy_usage import EnergyUsage
+from kasa_carbon.modules.reading_batch import as_rows
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+class KeyedStore(DatastoreAPI):
+    '''In memory store keyed by (device, timestamp) like the energy_usage table, which can be made to fail or stall.'''
+    def __init__(self):
+        self.rows = {}
+        self.batches = []
+        self.failing = False
+        self.stall_sec = 0.0
+
+    async def write_usage(self, energy_usage):
+        await self.write_usage_batch([energy_usage])
+
+    async def write_usage_batch(self, energy_usages):
+        await self._write(as_rows(energy_usages), idempotent=False)
+
+    async def write_usage_batch_idempotent(self, energy_usages):
+        await self._write(as_rows(energy_usages), idempotent=True)
+
+    async def _write(self, rows, idempotent):
+        await asyncio.sleep(self.stall_sec)
+        if self.failing:
+            raise ConnectionRefusedError("database is down")
+        for row in rows:
+            if row[:2] in self.rows and not idempotent:
+                raise ValueError("duplicate key")
+            self.rows.setdefault(row[:2], row)
+        self.batches.append(len(rows))
+
+    async def read_usage(self, last_n=10, columns="*"):
+        return []
+
+    async def iter_usage(self, start=None, end=None, devices=None, columns="*"):
+        for device, timestamp, power, emitted, intensity in list(self.rows.values()):
+            if (start is None or timestamp >= start) and (end is None or timestamp < end) and (devices is None or device in devices):
+                yield EnergyUsage(device, power, emitted, intensity, timestamp=timestamp)
+
+    async def update_carbon_batch(self, energy_usages):
+        for energy_usage in energy_usages:
+            key = (energy_usage.device, energy_usage.timestamp)
+            self.rows[key] = self.rows[key][:3] + (energy_usage.avg_emitted_mgco2e, energy_usage.grid_carbon_intensity_gco2perkwhr)
+
+    async def close(self):
+        pass
+
+def cycle(second, devices=("A", "B")):
+    return [EnergyUsage(device, 10.0 + second, 1.0, 100.0, timestamp=START + timedelta(seconds=second)) for device in devices]
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_spooled_and_replayed_in_order(tmp_path):
+    # Arrange
+    inner = KeyedStore()
+    store = SpoolStorage(inner, str(tmp_path / "spool"), segment_bytes=200, replay_batch_rows=3, retry_interval_sec=0.01)
+
+    # Act
+    await store.write_usage_batch(cycle(0))
+    inner.failing = True
+    for second in range(1, 6):
+        await store.write_usage_batch(cycle(second))
+    spooled_segments = len(store._segments)
+    inner.failing = False
+    await store.write_usage_batch(cycle(6))
+    await store._replay_task
+
+    # Assert
+    assert spooled_segments > 1
+    assert store.spooled_rows == 12
+    assert store.replayed_rows == 12
+    assert len(inner.rows) == 14
+    assert inner.rows[("B", START + timedelta(seconds=6))][2] == 16.0
+    assert max(inner.batches[1:]) == 3
+    assert list(inner.rows)[-1] == ("B", START + timedelta(seconds=6))
+    assert list((tmp_path / "spool").iterdir()) == []
+    await store.close()
+
+@pytest.mark.asyncio
+async def test_slow_writes_are_spooled_and_replay_is_idempotent(tmp_path):
+    # Arrange
+    inner = KeyedStore()
+    inner.stall_sec = 0.2
+    store = SpoolStorage(inner, str(tmp_path / "spool"), write_timeout_sec=0.05, retry_interval_sec=0.01)
+
+    # Act
+    await store.write_usage_batch(cycle(0))
+    inner.stall_sec = 0.0
+    #the same readings already reached the store, e.g. a write which timed out after it committed
+    await inner.write_usage_batch(cycle(0))
+    await store._replay_task
+
+    # Assert
+    assert store.spooled_rows == 2
+    assert len(inner.rows) == 2
+    assert store._segments == []
+
+@pytest.mark.asyncio
+async def test_spool_left_by_previous_run_is_replayed(tmp_path):
+    # Arrange
+    inner = KeyedStore()
+    inner.failing = True
+    first_run = SpoolStorage(inner, str(tmp_path / "spool"), retry_interval_sec=60)
+    await first_run.write_usage_batch(cycle(0))
+    await first_run.close()
+    #a crash while appending left a torn row
+    with open(tmp_path / "spool" / f"{1:020d}.csv", "ab") as f:
+        f.write(b"A,2024-01-01 00:00:01+00")
+    inner.failing = False
+
+    # Act
+    store = SpoolStorage(inner, str(tmp_path / "spool"))
+    await store.write_usage_batch(cycle(1))
+    await store._replay_task
+
+    # Assert
+    assert sorted(key[1].second for key in inner.rows) == [0, 0, 1, 1]
+    assert list((tmp_path / "spool").iterdir()) == []
+
+@pytest.mark.asyncio
+async def test_spool_left_by_previous_run_is_replayed_without_new_writes(tmp_path):
+    # Arrange
+    inner = KeyedStore()
+    inner.failing = True
+    first_run = SpoolStorage(inner, str(tmp_path / "spool"), retry_interval_sec=60)
+    await first_run.write_usage_batch(cycle(0))
+    await first_run.write_usage_batch(cycle(1))
+    await first_run.close()
+    inner.failing = False
+
+    # Act
+    store = SpoolStorage(inner, str(tmp_path / "spool"))
+    store.start_replay()
+    await store._replay_task
+    drained = await SpoolStorage(inner, str(tmp_path / "spool")).drain()
+
+    # Assert
+    assert sorted(key[1].second for key in inner.rows) == [0, 0, 1, 1]
+    assert drained == 0
+    assert list((tmp_path / "spool").iterdir()) == []
+
+@pytest.mark.asyncio
+async def test_drain_replays_the_whole_spool(tmp_path):
+    # Arrange
+    inner = KeyedStore()
+    inner.failing = True
+    first_run = SpoolStorage(inner, str(tmp_path / "spool"), retry_interval_sec=60, replay_batch_rows=1)
+    for second in range(3):
+        await first_run.write_usage_batch(cycle(second))
+    await first_run.close()
+    inner.failing = False
+    store = SpoolStorage(inner, str(tmp_path / "spool"), replay_batch_rows=1)
+
+    # Act
+    replayed = await store.drain()
+
+    # Assert
+    assert replayed == 6
+    assert len(inner.rows) == 6
+    assert store.spooled_bytes == 0
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("overflow, kept", [("drop_oldest", [3, 4]), ("drop_newest", [0, 1])])
+async def test_overflow_policy_bounds_disk_use(tmp_path, overflow, kept):
+    # Arrange
+    inner = KeyedStore()
+    inner.failing = True
+    store = SpoolStorage(inner, str(tmp_path / "spool"), max_bytes=250, segment_bytes=1, overflow=overflow, retry_interval_sec=60)
+
+    # Act
+    for second in range(5):
+        await store.write_usage_batch(cycle(second))
+    spooled_bytes = store.spooled_bytes
+    store._replay_task.cancel()
+    inner.failing = False
+    while await store.replay():
+        pass
+
+    # Assert
+    assert spooled_bytes <= 250
+    assert store.dropped_rows == 6
+    assert sorted({key[1].second for key in inner.rows}) == kept
+    await store.close()
+
+@pytest.mark.asyncio
+async def test_batch_larger_than_the_spool_is_dropped_without_emptying_it(tmp_path):
+    # Arrange
+    inner = KeyedStore()
+    inner.failing = True
+    store = SpoolStorage(inner, str(tmp_path / "spool"), max_bytes=100, retry_interval_sec=60)
+
+    # Act
+    await store.write_usage_batch(cycle(0))
+    spooled_bytes = store.spooled_bytes
+    await store.write_usage_batch(cycle(1, devices=("A", "B", "C")))
+    await store.close()
+
+    # Assert
+    assert store.dropped_rows == 3
+    assert store.spooled_bytes == spooled_bytes
+    assert spooled_bytes == sum(path.stat().st_size for path in (tmp_path / "spool").iterdir())
+    assert len(SpoolStorage._read_rows(store._segment_path(store._segments[0]), 0, 10)[0]) == 2
+
+def failing_pool():
+    conn = AsyncMock()
+    conn.copy_records_to_table.side_effect = ConnectionRefusedError("database is down")
+    pool = MagicMock()
+    pool.acquire.return_value.__aenter__ = AsyncMock(return_value=conn)
+    pool.acquire.return_value.__aexit__ = AsyncMock(return_value=None)
+    pool.close = AsyncMock()
+    pool.expire_connections = AsyncMock()
+    return pool
+
+@pytest.mark.asyncio
+async def test_readings_buffered_by_the_store_are_spooled_when_closing_fails(tmp_path):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=10, manage_partitions=False)
+    store = SpoolStorage(db, str(tmp_path / "spool"), retry_interval_sec=60)
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=failing_pool()):
+        await store.write_usage_batch(cycle(0))
+        await store.close()
+
+    # Assert
+    assert db.buffer == []
+    assert store.spooled_rows == 2
+    assert len(SpoolStorage._read_rows(store._segment_path(store._segments[0]), 0, 10)[0]) == 2
+
+@pytest.mark.asyncio
+async def test_readings_buffered_by_the_store_are_spooled_when_a_write_fails(tmp_path):
+    # Arrange
+    db = Database({"user": "test", "password": "test", "database": "test", "host": "localhost"}, batch_size=3, manage_partitions=False)
+    store = SpoolStorage(db, str(tmp_path / "spool"), retry_interval_sec=60)
+
+    # Act
+    with patch('asyncpg.create_pool', new_callable=AsyncMock, return_value=failing_pool()):
+        await store.write_usage_batch(cycle(0))
+        await store.write_usage_batch(cycle(1))
+        await store.close()
+
+    # Assert
+    rows = SpoolStorage._read_rows(store._segment_path(store._segments[0]), 0, 10)[0]
+    assert db.buffer == []
+    assert store.spooled_rows == 4
+    assert [(row[0], row[1].second) for row in rows] == [("A", 0), ("B", 0), ("A", 1), ("B", 1)]
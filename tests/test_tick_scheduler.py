@@ -0,0 +1,45 @@
+import asyncio
+import pytest
+from kasa_carbon.modules.tick_scheduler import TickScheduler
+
+@pytest.mark.asyncio
+async def test_wait_next_returns_measured_interval():
+    # Arrange
+    scheduler = TickScheduler(0.05)
+    scheduler.start()
+
+    # Act
+    elapsed = await scheduler.wait_next()
+
+    # Assert
+    assert elapsed == pytest.approx(0.05, abs=0.02)
+    assert scheduler.overrun_ticks == 0
+
+@pytest.mark.asyncio
+async def test_wait_next_does_not_drift_with_work():
+    # Arrange
+    scheduler = TickScheduler(0.05)
+    scheduler.start()
+    start = scheduler.clock()
+
+    # Act
+    for _ in range(4):
+        await asyncio.sleep(0.02) # simulated work shorter than the interval
+        await scheduler.wait_next()
+
+    # Assert
+    assert scheduler.clock() - start == pytest.approx(0.2, abs=0.03)
+
+@pytest.mark.asyncio
+async def test_wait_next_skips_overrun_ticks():
+    # Arrange
+    scheduler = TickScheduler(0.05)
+    scheduler.start()
+
+    # Act
+    await asyncio.sleep(0.12) # overrun the ticks at 0.05 and 0.10
+    elapsed = await scheduler.wait_next()
+
+    # Assert
+    assert scheduler.overrun_ticks == 2
+    assert elapsed == pytest.approx(0.15, abs=0.02)